@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import os
+import rasterio
+import rasterio.shutil
+import numpy as np
+from rasterio.enums import Resampling
+
+COG_CODECS = ["zstd", "deflate", "lzw"]
+COG_BLOCKSIZE = 512
+
+def get_cog_options(profile, codec="zstd"):
+    """Returns the creation options of a tiled GeoTIFF with a predictor and the given codec for an image profile."""
+    if codec.lower() not in COG_CODECS:
+        raise ValueError(f"Codec {codec} is not supported; choose from {COG_CODECS}")
+
+    # Tiles are a multiple of 16 pixels, but no larger than needed for small images
+    largest_side = max(profile['width'], profile['height'])
+    blocksize = min(COG_BLOCKSIZE, max(16, -(-largest_side // 16) * 16))
+
+    return {
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'compress': codec.lower(),
+        # Floating point predictor for float data, horizontal differencing otherwise
+        'predictor': 3 if np.dtype(profile['dtype']).kind == 'f' else 2,
+        'num_threads': 'ALL_CPUS',
+        'bigtiff': 'IF_SAFER'
+    }
+
+def get_overview_factors(width, height, blocksize=COG_BLOCKSIZE):
+    """Returns the decimation factors of the overviews, down to the first one that fits in a single tile."""
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+def write_cog(path, data, profile, codec="zstd", overviews=False):
+    """Writes a (bands, height, width) array as a cloud-optimized GeoTIFF, optionally with overviews."""
+    cog_options = get_cog_options(profile, codec)
+    temp_path = f"{path}.tmp.tif"
+
+    try:
+        with rasterio.Env(GDAL_NUM_THREADS='ALL_CPUS'):
+            with rasterio.open(temp_path, 'w', **{**profile, **cog_options}) as dst:
+                dst.write(data)
+                factors = get_overview_factors(dst.width, dst.height) if overviews else []
+                if len(factors) > 0:
+                    dst.build_overviews(factors, Resampling.average)
+                    dst.update_tags(ns='rio_overview', resampling='average')
+
+            # Copy with the overviews ahead of the full resolution tiles, which is the layout of a COG.
+            # The size, data type, CRS and transform come from the source, so only the creation options are passed.
+            rasterio.shutil.copy(temp_path, path, copy_src_overviews=True, **cog_options)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -6,6 +6,7 @@ import rasterio
 import numpy as np
 import json
 from minio import Minio
+from cog import COG_CODECS, write_cog
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.windows import from_bounds
 from rasterio.mask import mask
@@ -82,8 +83,8 @@ def get_reference_info(minio_client, bucket_name, reference_object_name):
         print(f"Error reading reference image {reference_object_name}: {e}", file=sys.stderr)
         sys.exit(1)
 
-def crop_image_to_reference(minio_client, bucket_name, input_object_name, output_object_name, ref_info):
-    """Crop an image to match the reference CRS and bounds."""
+def crop_image_to_reference(minio_client, bucket_name, input_object_name, output_object_name, ref_info, codec="zstd", overviews=False):
+    """Crop an image to match the reference CRS and bounds, and write it as a cloud-optimized GeoTIFF."""
     try:
         # Download input image to temporary location
         input_temp_path = os.path.join('/tmp', os.path.basename(input_object_name))
@@ -188,14 +189,12 @@ def crop_image_to_reference(minio_client, bucket_name, input_object_name, output
                 'crs': ref_info['crs'],
                 'transform': new_transform,
                 'width': cropped_data.shape[2],
-                'height': cropped_data.shape[1],
-                'compress': 'lzw'  # Add compression to save space
+                'height': cropped_data.shape[1]
             })
             
             # Write cropped image to temporary file
             output_temp_path = os.path.join('/tmp', f"cropped_{os.path.basename(input_object_name)}")
-            with rasterio.open(output_temp_path, 'w', **output_profile) as dst:
-                dst.write(cropped_data)
+            write_cog(output_temp_path, cropped_data, output_profile, codec=codec, overviews=overviews)
             
             # Upload cropped image to Minio
             minio_client.fput_object(
@@ -219,6 +218,8 @@ def main():
     parser.add_argument("--output_prefix", required=True, help="Prefix for output TIF images in Minio bucket.")
     parser.add_argument("--suffix", default=".TIF", help="File suffix to process (case-sensitive). Default: .TIF")
     parser.add_argument("--credentials_file", default="resources/credentials.json", help="Path to Minio credentials JSON file. Default: resources/credentials.json.")
+    parser.add_argument("--codec", default="zstd", choices=COG_CODECS, help="Compression codec of the output COGs. Default: zstd.")
+    parser.add_argument("--overviews", action="store_true", help="Add overviews to the output COGs.")
 
     # Default run
     if len(sys.argv) == 1:
@@ -292,7 +293,8 @@ def main():
         
         print(f"[{i}/{len(input_files)}] Processing {filename}...")
         
-        success = crop_image_to_reference(minio_client, args.bucket_name, input_object_name, output_object_name, ref_info)
+        success = crop_image_to_reference(minio_client, args.bucket_name, input_object_name, output_object_name, ref_info,
+                                          codec=args.codec, overviews=args.overviews)
         
         if success:
             processed_count += 1
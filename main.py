@@ -2,58 +2,234 @@ import json
 import os
 import glob
 import sys
-import rasterio.transform
-from sentinelhub import CRS
-from typing import List, Text
-from stelar_spatiotemporal.preprocessing.preprocessing import max_partition_size, unpack_tif
-from src.preprocessing import combine_npys_into_eopatches
-from stelar_spatiotemporal.lib import load_bbox, get_filesystem, save_bbox
-from src.vista_preprocessing import unpack_vista_unzipped
-from src.timeseries import lai_to_csv_px, lai_to_csv_field
-import argparse
-import rasterio
-from rasterio.io import MemoryFile
-import re
-import datetime as dt
-import numpy as np
-from sentinelhub import BBox, CRS
 import time
+import pickle
+import importlib.util
+import datetime as dt
+from typing import List, Text
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Only lightweight modules (numpy and the standard library) are imported up front, so that a task is validated before any
+# heavy library is imported. The modules of the pipeline stages are imported by the stages that need them (see timed_imports).
+_startup = time.time()
+from src.grid_aggregation import DEFAULT_GRID_LEVELS, check_grid_levels
+from src.field_aggregation import DEFAULT_FIELD_STATS, check_field_stats, merge_field_partials
+from src.frames import DEFAULT_MERGE_RULE, check_merge_rule, clear_merge_state
+from src.compositing import DEFAULT_COMPOSITE_RULE, check_composite, composite_npys
+from src.px_selection import check_px_selection
+from src.codec import DEFAULT_CODEC, check_codec, get_eopatch_compress_level, is_encoded_frame, load_frame_file
+from src.storage import create_storage, add_artifact, artifact_ready, consume, remove_artifacts, storage_metrics, get_dir_size, delete_path
+
+# Seconds spent importing the modules of every stage since the last task (see collect_import_times)
+IMPORT_TIMES = {"startup": time.time() - _startup}
+
+RAS_EXTENSIONS = (".RAS", ".RHD", ".zip", ".ZIP")
+
+@contextmanager
+def timed_imports(stage:str):
+    """
+    Record the time spent by the (function-level) imports of a stage in IMPORT_TIMES.
+    Libraries shared by several stages are attributed to the first stage that imports them.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        IMPORT_TIMES[stage] = IMPORT_TIMES.get(stage, 0) + time.time() - start
+
+def collect_import_times() -> dict:
+    """
+    Get (and reset) the import times recorded since the last call, i.e. those of the current task.
+    """
+    times = dict(IMPORT_TIMES)
+    IMPORT_TIMES.clear()
+    return times
 
+# Field layers loaded by earlier tasks of the service mode, by path and version
+FIELD_CACHE = {}
+FIELD_CACHE_SIZE = 4
 
-def unpack_ras(ras_paths:List[str], rhd_paths:List[str], out_path:str):
+# Memory budget in bytes of a task, shared by the tiles that run concurrently
+DEFAULT_MAX_RAM = int(4 * 1e9)
+
+def unpack_ras(ras_paths:List[str], rhd_paths:List[str], out_path:str, crs:int, zip_paths:List[str] = [],
+               start_date:dt.datetime = None, end_date:dt.datetime = None, roi:tuple = None, zip_members:dict = None,
+               merge_rule:str = DEFAULT_MERGE_RULE, codec:str = DEFAULT_CODEC):
+    """
+    Unpack RAS files (and the RAS members of ZIP archives) of a tile with the given EPSG code (see src.catalog.get_tile_crs).
+    """
+    with timed_imports("vista"):
+        from sentinelhub import CRS
+        from src.vista_preprocessing import unpack_vista_unzipped, unpack_vista_zip
+
+    crs = CRS(crs)
     for ras_path, rhd_path in zip(ras_paths, rhd_paths):
-        unpack_vista_unzipped(ras_path, rhd_path, out_path, delete_after=False, crs=CRS('32630'))
+        unpack_vista_unzipped(ras_path, rhd_path, out_path, delete_after=False, crs=crs,
+                              start_date=start_date, end_date=end_date, roi=roi, merge_rule=merge_rule, codec=codec)
 
-def combining_npys(npy_dir:str, out_path:str): 
+    # Stream the RAS files of ZIP archives without extracting them
+    for zip_path in zip_paths:
+        members = zip_members.get(zip_path) if zip_members is not None else None
+        unpack_vista_zip(zip_path, out_path, crs=crs, start_date=start_date, end_date=end_date, roi=roi, members=members,
+                         merge_rule=merge_rule, codec=codec)
+
+def load_fields_cached(field_path:str):
+    """
+    Load a field layer, reusing the layer loaded by an earlier task (in service mode) if the file did not change since.
+    """
+    with timed_imports("fields"):
+        from stelar_spatiotemporal.lib import get_filesystem
+        from src.catalog import get_etag
+        from src.timeseries import load_fields
+
+    key = (field_path, get_etag(get_filesystem(field_path).info(field_path)))
+    if key not in FIELD_CACHE:
+        if len(FIELD_CACHE) >= FIELD_CACHE_SIZE:
+            FIELD_CACHE.pop(next(iter(FIELD_CACHE)))
+        FIELD_CACHE[key] = load_fields(field_path)
+    return FIELD_CACHE[key]
+
+def get_roi(roi, fields, crs = None):
+    """
+    Get the region of interest as (xmin, ymin, xmax, ymax) in the given crs.
+    The roi can be given explicitly, or as 'fields' to use the bounds of the (loaded) fields.
+    """
+    if roi is None:
+        return None
+    if roi == "fields":
+        if fields is None:
+            raise ValueError("The region of interest can only be derived from the fields if a field path is given.")
+        bounds = fields.to_crs(crs.ogc_string()).total_bounds
+        print("Using the bounds of the fields as region of interest:", bounds)
+        return tuple(float(b) for b in bounds)
+    if len(roi) != 4 or roi[0] >= roi[2] or roi[1] >= roi[3]:
+        raise ValueError("The region of interest should be given as [xmin, ymin, xmax, ymax], got {}.".format(roi))
+    return tuple(float(b) for b in roi)
+
+def parse_date(date:str, name:str) -> dt.datetime:
+    if date is None:
+        return None
+    try:
+        return dt.datetime.fromisoformat(str(date))
+    except ValueError:
+        raise ValueError(f"{name} {date} is not a valid date; use the YYYY-MM-DD format")
+
+def combining_npys(npy_dir:str, out_path:str, max_ram:int = int(4 * 1e9), codec:str = DEFAULT_CODEC, bands:List[str] = None): 
 
     if not os.path.exists(npy_dir):
         raise ValueError("Something went wrong in previous steps; no npys folder found in {}".format(out_path))
 
-    npy_paths = glob.glob(os.path.join(npy_dir, "*.npy"))
-    mps = max_partition_size(npy_paths[0], MAX_RAM=int(4 * 1e9))
-    bbox = load_bbox(os.path.join(npy_dir, "bbox.pkl"))
+    with timed_imports("eopatches"):
+        from stelar_spatiotemporal.lib import load_bbox
+        from stelar_spatiotemporal.preprocessing.preprocessing import max_partition_size
+        from src.preprocessing import combine_npys_into_eopatches, combine_band_npys_into_eopatches
+
+    # With bands, the frames of every band are in their own subfolder (see unpack_bands)
+    frames_dir = npy_dir if bands is None else os.path.join(npy_dir, bands[0])
+    npy_paths = glob.glob(os.path.join(frames_dir, "*.npy"))
+    if is_encoded_frame(npy_paths[0]):
+        # max_partition_size can only inspect plain npy files
+        mps = max(1, int(max_ram // load_frame_file(npy_paths[0]).nbytes))
+    else:
+        mps = max_partition_size(npy_paths[0], MAX_RAM=max_ram)
+    bbox = load_bbox(os.path.join(frames_dir, "bbox.pkl"))
+
+    if bands is not None:
+        # Every date of a partition holds a frame of every band
+        combine_band_npys_into_eopatches(band_dirs={band: os.path.join(npy_dir, band) for band in bands},
+                                         outpath=out_path,
+                                         bbox=bbox,
+                                         partition_size=max(1, mps // len(bands)),
+                                         delete_after=True,
+                                         compress_level=get_eopatch_compress_level(codec))
+        return
 
     combine_npys_into_eopatches(npy_paths=npy_paths, outpath=out_path,
                             feature_name="LAI",
                             bbox=bbox,
                             partition_size=mps,
-                            delete_after=True)
+                            delete_after=True,
+                            compress_level=get_eopatch_compress_level(codec))
+
+def create_px_ts(eop_dir:str, patchlet_dir:str, outpath:str, px_selection:dict = None, bands:List[str] = None):
+    with timed_imports("pixels"):
+        from src.timeseries import lai_to_csv_px
 
-def create_px_ts(eop_dir:str, patchlet_dir:str, outpath:str):
     eop_paths = glob.glob(os.path.join(eop_dir, "partition_*"))
     if len(eop_paths) == 0: eop_paths = [eop_dir]
 
-    # Turn the LAI values into a csv file
-    lai_to_csv_px(eop_paths, patchlet_dir=patchlet_dir, outdir=px_out, delete_patchlets=False)
+    # Turn the LAI values (or the values of every band, into a subfolder per band) into csv files
+    lai_to_csv_px(eop_paths, patchlet_dir=patchlet_dir, outdir=outpath, delete_patchlets=False, bands=bands, **(px_selection or {}))
+
+def create_grid_ts(eop_dir:str, outpath:str, grid_levels:List[int] = DEFAULT_GRID_LEVELS, bands:List[str] = None):
+    with timed_imports("grid"):
+        from src.timeseries import lai_to_csv_grid
+
+    eop_paths = glob.glob(os.path.join(eop_dir, "partition_*"))
+    if len(eop_paths) == 0: eop_paths = [eop_dir]
+
+    # Block-reduce the LAI values (or the values of every band) to every grid level and turn them into csv files named after the band
+    for band in bands or ["LAI"]:
+        lai_to_csv_grid(eop_paths, outdir=outpath, levels=grid_levels, band=band)
+
+def create_fused_ts(eop_dir:str, tmp_path:str, px_out:str = None, px_selection:dict = None,
+                    fields = None, field_out_path:str = None, field_stats:List[str] = DEFAULT_FIELD_STATS,
+                    grid_out_path:str = None, grid_levels:List[int] = DEFAULT_GRID_LEVELS,
+                    partial_ids:list = None, max_ram:int = int(4 * 1e9)):
+    with timed_imports("fused"):
+        from src.fused import fused_extraction
+
+    eop_paths = glob.glob(os.path.join(eop_dir, "partition_*"))
+    if len(eop_paths) == 0: eop_paths = [eop_dir]
+
+    # Read every band of rows once and feed it to the pixel, field and grid sinks
+    return fused_extraction(eop_paths, tmpdir=os.path.join(tmp_path, "fused"), px_out=px_out, px_selection=px_selection,
+                            fields=fields, field_out_path=field_out_path, field_stats=field_stats,
+                            grid_out_path=grid_out_path, grid_levels=grid_levels,
+                            max_ram=max_ram, partial_ids=partial_ids)
+
+def get_band_field_id(field_id, band:str) -> str:
+    return f"{field_id}_{band}"
+
+def create_field_ts(eop_dir:str, out_path:str, fields_path:str = None, field_stats:List[str] = DEFAULT_FIELD_STATS,
+                    fields = None, partial_ids:list = None, max_ram:int = int(2e9), bands:List[str] = None, tmp_path:str = "/tmp"):
+    """
+    Create the field-level time series of the eopatches. With bands, the time series of every band are written as
+    separate columns, named after the field id and the band (see get_band_field_id), and so are the partial aggregates
+    of the fields in partial_ids.
+    """
+    with timed_imports("fields"):
+        from src.timeseries import lai_to_csv_field_windowed, combine_field_csvs
 
-def create_field_ts(eop_dir:str, out_path:str, fields_path:str):
     eop_paths = glob.glob(os.path.join(eop_dir, "partition_*"))
     if len(eop_paths) == 0: eop_paths = [eop_dir]
 
     eop_paths.sort()
 
-    # Perform the process as described above
-    lai_to_csv_field(eop_paths, fields_path=fields_path, outpath=out_path, n_jobs=16, delete_tmp=True)
+    # Read the eopatches in bands of rows with the full time axis, instead of exporting every partition to tiff
+    if bands is None:
+        return lai_to_csv_field_windowed(eop_paths, outpath=out_path, fields_path=fields_path, fields=fields, stats=field_stats,
+                                         max_ram=max_ram, n_jobs=16, partial_ids=partial_ids, tmpdir=tmp_path)
+
+    # Every band is written to its own csv first, as appending to a csv requires the same columns
+    partials, band_csv_paths = {}, []
+    for band in bands:
+        band_csv_path = os.path.join(tmp_path, f"fields_{band}.csv")
+        delete_path(band_csv_path)
+        band_fields = fields.set_axis([get_band_field_id(field_id, band) for field_id in fields.index])
+        partials.update(lai_to_csv_field_windowed(eop_paths, outpath=band_csv_path, fields=band_fields, stats=field_stats,
+                                                  max_ram=max_ram, n_jobs=16, band=band, tmpdir=tmp_path,
+                                                  partial_ids=[get_band_field_id(field_id, band) for field_id in partial_ids]
+                                                  if partial_ids is not None else None))
+        if os.path.exists(band_csv_path):
+            band_csv_paths.append(band_csv_path)
+
+    if len(band_csv_paths) > 0:
+        combine_field_csvs(band_csv_paths, out_path)
+    for band_csv_path in band_csv_paths:
+        os.remove(band_csv_path)
+    return partials
 
 def cleanup(tmp_path:str):
     npy_dir = os.path.join(tmp_path, "npys")
@@ -63,11 +239,85 @@ def cleanup(tmp_path:str):
     for todel_path in todel:
         if os.path.exists(todel_path):
             print("Deleting {}".format(todel_path))
-            os.system("rm -rf {}".format(todel_path))
+            delete_path(todel_path)
+
+def unpack_images(images:List[dict], extension:str, npy_dir:str, start_date:dt.datetime = None, end_date:dt.datetime = None,
+                  roi:tuple = None, merge_rule:str = DEFAULT_MERGE_RULE, codec:str = DEFAULT_CODEC):
+    """
+    Unpack the images (catalog records, see src.catalog) of a tile into YYYY_MM_DD.npy frames in npy_dir.
+    """
+    os.makedirs(npy_dir, exist_ok=True)
+
+    if extension == "RAS":
+        # RAS files are described by their RHD header, ZIP members by the archive they are in
+        pairs = [(image["name"], image["file"]) for image in images if image["file"].endswith(".RHD")]
+        zip_members = {}
+        for image in images:
+            if not image["file"].endswith(".RHD"):
+                zip_members.setdefault(image["file"], []).append(image["name"][len(image["file"]) + 1:])
+
+        unpack_ras(ras_paths=[ras for ras, _ in pairs],
+                rhd_paths=[rhd for _, rhd in pairs],
+                out_path=npy_dir,
+                crs=images[0]["crs"],
+                zip_paths=list(zip_members.keys()),
+                start_date=start_date,
+                end_date=end_date,
+                roi=roi,
+                zip_members=zip_members,
+                merge_rule=merge_rule,
+                codec=codec)
+    else:
+        with timed_imports("tif"):
+            from stelar_spatiotemporal.preprocessing.preprocessing import unpack_tif
+            from src.preprocessing import unpack_tif_window
+
+        image_paths = [image["name"] for image in images]
+        dates = [d for image in images for d in image["dates"]]
+        if roi is None and len(set(dates)) == len(dates) and check_codec(codec) == "none":
+            unpack_tif(image_paths=image_paths,
+                        outdir=npy_dir,
+                        extension=extension,)
+        else:
+            # Only read the windows of the images within the region of interest, merge images that share a date and encode the frames
+            unpack_tif_window(image_paths=image_paths,
+                              outdir=npy_dir,
+                              roi=roi,
+                              merge_rule=merge_rule,
+                              codec=codec)
+
+    clear_merge_state(npy_dir)
+
+def unpack_bands(images:List[dict], bands:List[str], extension:str, npy_dir:str, **kwargs):
+    """
+    Unpack the images of every band (see src.catalog.group_by_band) concurrently, each into its own subfolder of npy_dir,
+    with the same options as unpack_images.
+    """
+    with timed_imports("catalog"):
+        from src.catalog import group_by_band
+
+    band_images = group_by_band(images, bands)
+    with ThreadPoolExecutor(max_workers=len(bands)) as executor:
+        futures = [executor.submit(unpack_images, band_images[band], extension, os.path.join(npy_dir, band), **kwargs) for band in bands]
+        for future in futures:
+            future.result()
+
+def check_bands(bands:List[str]) -> List[str]:
+    """
+    Validate a list of band names, removing duplicates while keeping the order.
+    """
+    if bands is None:
+        return None
+    if isinstance(bands, str):
+        bands = [bands]
+    if not isinstance(bands, list) or len(bands) == 0 or not all(isinstance(band, str) and band != "" for band in bands):
+        raise ValueError(f"bands should be a non-empty list of band names, e.g. ['B2', 'B3', 'B4', 'B8A'], got {bands}")
+    return list(dict.fromkeys(bands))
 
 def check_ras(input_paths: List[Text]):
     ras_paths = [p for p in input_paths if p.endswith(".RAS")]
-    rhd_paths = [p for p in input_paths if p.endswith(".RHD")]
+    rhd_paths = set(p for p in input_paths if p.endswith(".RHD"))
+    zip_paths = [p for p in input_paths if p.endswith((".zip", ".ZIP"))]
 
     ras_path_filtered = []
     rhd_path_filtered = []
@@ -76,8 +326,7 @@ def check_ras(input_paths: List[Text]):
     for ras_path in ras_paths:
         base_name = os.path.basename(ras_path)
         rhd_path = os.path.join(os.path.dirname(ras_path), base_name.replace(".RAS", ".RHD"))
-        rhd_path = rhd_paths.get(rhd_path)
-        if rhd_path:
+        if rhd_path in rhd_paths:
             ras_path_filtered.append(ras_path)
             rhd_path_filtered.append(rhd_path)
         else:
@@ -87,65 +336,83 @@ def check_ras(input_paths: List[Text]):
     if len(ras_path_filtered) != len(rhd_path_filtered):
         raise ValueError("Number of RAS and RHD files do not match. Please check the input paths.")
     
-    return ras_path_filtered, rhd_path_filtered
+    if len(ras_path_filtered) == 0 and len(zip_paths) == 0:
+        raise ValueError("No RAS/RHD pairs or ZIP archives found. Please check the input paths.")
 
-def image2ts_pipeline(input_paths: List[Text], extension:str,
-                      px_out:str, 
-                      field_path:str,
-                      field_out_path:str, 
-                      skip_pixel:bool
-                      ):
+    return ras_path_filtered, rhd_path_filtered, zip_paths
+
+def get_tile_output(path:str, tile_id:str) -> str:
     """
-    This function takes a directory of raster files and headers and converts them to time series dataset.
+    Output path of a single tile: a subfolder of an output folder, or a suffixed csv file.
+    """
+    if path is None:
+        return None
+    if path.endswith(".csv"):
+        return path[:-len(".csv")] + "_" + tile_id + ".csv"
+    return os.path.join(path, tile_id)
 
-    Parameters
-    ----------
-    input_paths : List[Text]
-        List of paths to the input files.
-    extension : str
-        Extension of the input files. Default is 'TIF'.
-    px_out : str
-        Path to the folder where the pixel-level output files will be saved.
-    field_path : str
-        Path to the shapefile containing the boundaries of the agricultural fields. If not given, field-level time series will not be created.
-    field_out_path : str
-        Path to the folder where the field-level output files will be saved. 
-    skip_pixel : bool
-        Skip creating pixel-level time series
+def get_tile_field_path(tmp_path:str, tile_id:str) -> str:
+    return os.path.join(tmp_path, "tiles", tile_id, "fields.csv")
+
+def combine_tile_fields(field_partials:List[dict], tile_csv_paths:List[str], out_path:str, field_stats:List[str] = DEFAULT_FIELD_STATS):
     """
-    total_start = time.time()
+    Merge the partial aggregates of the fields that span several tiles, and combine them with the fields of every tile.
+    """
+    with timed_imports("fields"):
+        from src.timeseries import partials_to_df, write_field_df, combine_field_csvs
 
-    # Check if we do pixel, field, or both
-    pixel = not skip_pixel
-    field = field_path is not None
+    merged = {}
+    for partials in field_partials:
+        for field_id, partial in partials.items():
+            merged.setdefault(field_id, []).append(partial)
 
-    # Check if the extension is supported
-    if extension not in ["RAS", "TIF", "TIFF"]:
-        raise ValueError("Extension {} is not supported.".format(extension))
-    
-    TMP_PATH = '/tmp'
-    npy_dir = os.path.join(TMP_PATH, "npys")
-    if not os.path.exists(npy_dir):
-        os.makedirs(npy_dir)
+    csv_paths = [p for p in tile_csv_paths if os.path.exists(p)]
+    if len(merged) > 0:
+        boundary_path = os.path.join(os.path.dirname(os.path.dirname(tile_csv_paths[0])), "boundary_fields.csv")
+        if os.path.exists(boundary_path):
+            os.remove(boundary_path)
+        df = partials_to_df({field_id: merge_field_partials(parts) for field_id, parts in merged.items()}, field_stats)
+        write_field_df(df, boundary_path, field_stats)
+        csv_paths.append(boundary_path)
 
-    partial_times = {}
+    if len(csv_paths) == 0:
+        print("No fields intersect with any of the tiles")
+        return
+    combine_field_csvs(csv_paths, out_path)
 
-    start = time.time()
+    for csv_path in csv_paths:
+        os.remove(csv_path)
+
+def list_inputs(input_paths:List[Text], extension:str, start_date:dt.datetime = None, end_date:dt.datetime = None):
+    """
+    List the input files (expanding wildcards and directories) within the date range. Returns the files that hold the headers
+    of the images (RHD files and ZIP archives for RAS, the files themselves for TIF) and the infos of the listed files.
+    """
+    with timed_imports("catalog"):
+        from stelar_spatiotemporal.lib import get_filesystem
+
+    input_paths = list(input_paths)
+    infos = {}
 
-            
     # Handle wildcards in the path
     for i, path in enumerate(input_paths):
         if "*" in path:  # If the path contains a wildcard, we can use glob to find the files
             print("The provided path contains a wildcard. Using glob to find the files...")
             fs = get_filesystem(path)
-            new_paths = fs.glob(path, recursive=True)
+            new_infos = fs.glob(path, recursive=True, detail=True)
+            # MinIO listings drop the protocol, which is needed to open the files later on
+            if path.startswith("s3://"):
+                new_infos = {p if p.startswith("s3://") else "s3://" + p: info for p, info in new_infos.items()}
+            # Keep the listing infos, so that the catalog does not need to request them again
+            infos.update(new_infos)
+            new_paths = list(new_infos.keys())
             # Remove the original path and add the new paths
             input_paths.pop(i)
             input_paths.extend(new_paths)
             print("Found {} files with the given extension.".format(len(input_paths)))
 
-    if extension == '.RAS':
-        parsed_paths = [path for path in input_paths if path.endswith((".RAS", '.RHD'))]
+    if extension == 'RAS':
+        parsed_paths = [path for path in input_paths if path.endswith(RAS_EXTENSIONS)]
     else:
         parsed_paths = [path for path in input_paths if path.endswith(extension)]
 
@@ -157,188 +424,875 @@ def image2ts_pipeline(input_paths: List[Text], extension:str,
         # If it's purely a directory, we can list the files in that directory
         if fs.isdir(path): 
             print("The provided path is a directory. Listing the files in that directory...")
-            parsed_paths = fs.glob(os.path.join(path, "*{}".format(extension)))
+            if extension == 'RAS':
+                parsed_paths = [p for p in fs.glob(os.path.join(path, "*")) if p.endswith(RAS_EXTENSIONS)]
+            else:
+                parsed_paths = fs.glob(os.path.join(path, "*{}".format(extension)))
         else:
             raise ValueError("No input files found. Please check the input paths.")
 
     if extension == "RAS":
-        ras_paths, rhd_paths = check_ras(parsed_paths)
+        _, rhd_paths, zip_paths = check_ras(parsed_paths)
+        header_paths = rhd_paths + zip_paths
+    else:
+        with timed_imports("tif"):
+            from src.preprocessing import filter_images_by_date
+
+        # Skip the files outside the date range
+        parsed_paths = filter_images_by_date(parsed_paths, start_date, end_date)
+        if len(parsed_paths) == 0:
+            raise ValueError("No input files found within the given date range.")
+        header_paths = parsed_paths
+
+    return header_paths, infos
+
+def plan_tiles(tiles:dict, fields, roi):
+    """
+    Validate the images of every tile, and route the fields and the region of interest to the tiles.
+    Returns the (images, fields, roi) of the tiles that overlap with the region of interest, and the boxes of these tiles.
+    """
+    with timed_imports("catalog"):
+        from shapely.geometry import box
+        from sentinelhub import CRS
+        from src.catalog import validate_alignment
+
+    plans = {}
+    tile_boxes = {}
+    for tile_id, tile_images in tiles.items():
+        validate_alignment(tile_images)
+        crs = CRS(tile_images[0]["crs"])
+        tile_box = box(*tile_images[0]["bbox"])
+
+        # Route the fields to the tiles they intersect
+        tile_fields = None
+        if fields is not None:
+            tile_fields = fields.to_crs(crs.ogc_string())
+            tile_fields = tile_fields[tile_fields.intersects(tile_box)]
 
-        # 1. Unpack the RAS files
-        print("1. Unpacking RAS files...")
-        unpack_ras(ras_paths=ras_paths, 
-                rhd_paths=rhd_paths, 
-                out_path=npy_dir)
+        if roi == "fields" and len(tile_fields) == 0:
+            print(f"No fields intersect with tile {tile_id}, skipping it")
+            continue
+
+        tile_roi = get_roi(roi, tile_fields, crs)
+        if tile_roi is not None and not box(*tile_roi).intersects(tile_box):
+            print(f"Tile {tile_id} does not overlap with the region of interest, skipping it")
+            continue
+        plans[tile_id] = (tile_images, tile_fields, tile_roi)
+        tile_boxes[tile_id] = tile_box
+
+    return plans, tile_boxes
+
+def save_field_partials(field_partials:List[dict], path:str):
+    """
+    Merge the partial aggregates of every field over the given dicts and save them to a local file.
+    """
+    merged = {}
+    for partials in field_partials:
+        for field_id, partial in partials.items():
+            merged.setdefault(field_id, []).append(partial)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump({field_id: merge_field_partials(parts) for field_id, parts in merged.items()}, f)
+
+def load_field_partials(path:str) -> dict:
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def sum_estimates(estimates:List[dict]) -> dict:
+    total = {key: sum(e[key] for e in estimates) for key in ["number_of_dates", "number_of_values", "read_bytes", "peak_disk_bytes", "cube_bytes"]}
+    total["number_of_dates"] = max(e["number_of_dates"] for e in estimates)
+    runtimes = [e["runtime_seconds"] for e in estimates]
+    total["runtime_seconds"] = None if None in runtimes else sum(runtimes)
+    return total
+
+def check_in_memory(in_memory):
+    if in_memory not in ["auto", True, False]:
+        raise ValueError(f"in_memory should be 'auto', true or false, got {in_memory}")
+    return in_memory
+
+def check_lazy(lazy:bool) -> bool:
+    # Only check that dask is installed, without importing it; the lazy backend imports it itself (see src.lazy_cube)
+    if lazy and importlib.util.find_spec("dask") is None:
+        raise ValueError("The lazy backend requires the dask package; install it or disable the lazy backend")
+    return bool(lazy)
+
+def use_in_memory(in_memory, cube_bytes:int, max_ram:int) -> bool:
+    """
+    Decide whether a tile is processed in memory; with 'auto', it is if its cube fits in half of the memory budget,
+    leaving the other half for the bands of rows that are being processed.
+    """
+    if in_memory == "auto":
+        return 2 * cube_bytes <= max_ram
+    return in_memory
+
+def tile_pipeline(tile_images:List[dict], extension:str, tmp_path:str,
+                  px_out:str, fields, field_out_path:str, grid_out_path:str, skip_pixel:bool,
+                  field_stats:List[str] = DEFAULT_FIELD_STATS, grid_levels:List[int] = DEFAULT_GRID_LEVELS,
+                  px_selection:dict = None, start_date:dt.datetime = None, end_date:dt.datetime = None,
+                  roi:tuple = None, max_ram:int = int(4 * 1e9), name:str = "", merge_rule:str = DEFAULT_MERGE_RULE,
+                  composite_days:int = None, composite_rule:str = DEFAULT_COMPOSITE_RULE, partial_ids:list = None,
+                  fused:bool = False, codec:str = DEFAULT_CODEC, in_memory:bool = False, storage:dict = None, reserve_bytes:int = 0,
+                  lazy:bool = False, bands:List[str] = None):
+    """
+    Run the pipeline for the (aligned) images of a single tile, using its own intermediate folders under tmp_path.
+    In memory, the unpacked images are stacked into a cube that all time series are created from directly (see src.fused),
+    without writing intermediate eopatches and patchlets. With the lazy backend, the unpacked images are opened as a lazy
+    cube instead, from which all time series are created by chunk-wise tasks of a local parallel scheduler (see src.lazy_cube).
+    With bands, the images of every band are unpacked concurrently and combined into eopatches with one feature per band,
+    from which the time series of all bands are created in the same passes.
+    The fields in partial_ids are not written; their partial aggregates are returned under 'field_partials' instead.
+    Every intermediate folder is registered in the storage manager (see src.storage) with the steps that read it,
+    reserving reserve_bytes before it is written, and deleted as soon as the last of these steps is done.
+    Returns the metrics of the tile.
+    """
+    storage = storage if storage is not None else create_storage()
+    partial_times = {}
+    npy_dir = os.path.join(tmp_path, "npys")
+    eopatches_dir = os.path.join(tmp_path, "lai_eopatch")
+    patchlets_dir = os.path.join(tmp_path, "patchlets")
+
+    # Remove intermediates left over by an interrupted run, so that they are not mixed into the results of this run
+    for leftover in [npy_dir, eopatches_dir, patchlets_dir]:
+        delete_path(leftover)
+
+    add_artifact(storage, npy_dir, ["lazy" if lazy else "stacking" if in_memory else "combining"], reserve_bytes, owner=tmp_path)
+    os.makedirs(npy_dir)
+
+    start = time.time()
+
+    # 1. Unpack the RAS or TIF files (of every band)
+    print(f"{name}1. Unpacking {extension} files" + (f" of bands {bands}..." if bands is not None else "..."))
+    unpack_kwargs = dict(start_date=start_date, end_date=end_date, roi=roi, merge_rule=merge_rule, codec=codec)
+    if bands is None:
+        unpack_images(tile_images, extension, npy_dir, **unpack_kwargs)
     else:
-        # 1. Unpack the TIF files
-        unpack_tif(image_paths=parsed_paths,
-                    outdir=npy_dir,
-                    extension=extension,)
-        pass
+        unpack_bands(tile_images, bands, extension, npy_dir, **unpack_kwargs)
 
     partial_times['files_unpacking'] = time.time() - start
 
-    npys = glob.glob(os.path.join(npy_dir, "*.npy"))
+    # With bands, every band has its own folder of frames
+    frame_dirs = [npy_dir] if bands is None else [os.path.join(npy_dir, band) for band in bands]
+
+    npys = glob.glob(os.path.join(frame_dirs[0], "*.npy"))
     n_images = len(npys)
+    if n_images == 0:
+        raise ValueError(f"{name}No images were unpacked; check the date range and region of interest.")
 
     # Get width and height of the images
-    arr = np.load(npys[0])
+    arr = load_frame_file(npys[0])
     height, width = arr.shape
 
-    # 2. Combining the images into eopatches
-    start = time.time()
+    # 1b. Composite the images to regular periods
+    if composite_days is not None:
+        start = time.time()
 
-    print("2. Combining the images into eopatches...")
-    eopatches_dir = os.path.join(TMP_PATH, "lai_eopatch")
-    combining_npys(npy_dir=npy_dir, out_path=eopatches_dir)
+        print(f"{name}1b. Compositing the images to periods of {composite_days} days...")
+        for frame_dir in frame_dirs:
+            composite_npys(frame_dir, period_days=composite_days, rule=composite_rule, codec=codec)
 
-    partial_times['eopatches_combining'] = time.time() - start
+        partial_times['temporal_compositing'] = time.time() - start
 
-    # 3. Create pixel-level time series
-    if pixel:
+    # Bytes written to intermediate storage, to compare codecs
+    artifact_ready(storage, npy_dir)
+    intermediate_bytes = {"frames": get_dir_size(npy_dir)}
+
+    field_partials = {}
+    if lazy:
+        with timed_imports("lazy"):
+            from src.lazy_cube import open_frames_cube, lazy_extraction
+
+        # 2. Create all time series from a lazy cube of the images, instead of writing eopatches and patchlets
         start = time.time()
 
-        patchlets_dir = os.path.join(TMP_PATH, "patchlets")
-        print("3. Creating pixel-level time series...")
-        create_px_ts(eop_dir=eopatches_dir,
-                     patchlet_dir=patchlets_dir,
-                     outpath=px_out)
+        print(f"{name}2. Creating all time series from a lazy cube of the images...")
+        dates, cube, bbox = open_frames_cube(npy_dir, max_ram=max_ram, levels=grid_levels if grid_out_path is not None else None)
+        field_partials = lazy_extraction(dates, cube, bbox,
+                                         tmpdir=os.path.join(tmp_path, "lazy"),
+                                         px_out=None if skip_pixel else px_out,
+                                         px_selection=px_selection,
+                                         fields=fields if fields is not None and len(fields) > 0 else None,
+                                         field_out_path=field_out_path,
+                                         field_stats=field_stats,
+                                         grid_out_path=grid_out_path,
+                                         grid_levels=grid_levels,
+                                         partial_ids=partial_ids,
+                                         max_ram=max_ram)
+        consume(storage, npy_dir, "lazy")
 
-        partial_times['pixel_level_timeseries_creation'] = time.time() - start
+        partial_times['lazy_timeseries_creation'] = time.time() - start
+    elif in_memory:
+        with timed_imports("in_memory"):
+            from src.preprocessing import stack_npys
+            from src.fused import fused_cube_extraction
 
-    # 4. Create field-level time series
-    if field:
+        # 2. Stack the images into an in-memory cube, instead of writing eopatches and patchlets and reading them back
         start = time.time()
 
-        print("4. Creating field-level time series...")
-        create_field_ts(eop_dir=eopatches_dir,
-                        out_path=field_out_path, 
-                        fields_path=field_path)
-        
-        partial_times['field_level_timeseries_creation'] = time.time() - start
-        
-        
-    # 5. Create the output json
+        print(f"{name}2. Stacking the images into an in-memory cube...")
+        dates, cube, bbox = stack_npys(npy_dir, delete_after=True)
+        consume(storage, npy_dir, "stacking")
+
+        partial_times['cube_stacking'] = time.time() - start
+
+        # 3. Create all time series from the cube in a single pass
+        start = time.time()
+
+        print(f"{name}3. Creating all time series from the in-memory cube...")
+        field_partials = fused_cube_extraction(dates, [cube], bbox,
+                                               px_out=None if skip_pixel else px_out,
+                                               px_selection=px_selection,
+                                               fields=fields if fields is not None and len(fields) > 0 else None,
+                                               field_out_path=field_out_path,
+                                               field_stats=field_stats,
+                                               grid_out_path=grid_out_path,
+                                               grid_levels=grid_levels,
+                                               partial_ids=partial_ids,
+                                               max_ram=max(max_ram - cube.nbytes, cube.nbytes))
+        del cube
+
+        partial_times['in_memory_timeseries_creation'] = time.time() - start
+    else:
+        # 2. Combining the images into eopatches
+        start = time.time()
+
+        print(f"{name}2. Combining the images into eopatches...")
+        if fused:
+            consumers = ["fused"]
+        else:
+            consumers = [step for step, needed in [("pixels", not skip_pixel), ("grid", grid_out_path is not None),
+                                                   ("fields", fields is not None and len(fields) > 0)] if needed]
+        add_artifact(storage, eopatches_dir, consumers, reserve_bytes, owner=tmp_path)
+        combining_npys(npy_dir=npy_dir, out_path=eopatches_dir, max_ram=max_ram, codec=codec, bands=bands)
+        consume(storage, npy_dir, "combining")
+        artifact_ready(storage, eopatches_dir)
+
+        partial_times['eopatches_combining'] = time.time() - start
+        intermediate_bytes["eopatches"] = get_dir_size(eopatches_dir)
+
+        if fused:
+            # 3. Create all time series in a single pass over the eopatches
+            start = time.time()
+
+            print(f"{name}3. Creating all time series in a single pass...")
+            field_partials = create_fused_ts(eop_dir=eopatches_dir,
+                                             tmp_path=tmp_path,
+                                             px_out=None if skip_pixel else px_out,
+                                             px_selection=px_selection,
+                                             fields=fields if fields is not None and len(fields) > 0 else None,
+                                             field_out_path=field_out_path,
+                                             field_stats=field_stats,
+                                             grid_out_path=grid_out_path,
+                                             grid_levels=grid_levels,
+                                             partial_ids=partial_ids,
+                                             max_ram=max_ram)
+            consume(storage, eopatches_dir, "fused")
+
+            partial_times['fused_timeseries_creation'] = time.time() - start
+        else:
+            # 3. Create pixel-level time series
+            if not skip_pixel:
+                start = time.time()
+
+                print(f"{name}3. Creating pixel-level time series...")
+                add_artifact(storage, patchlets_dir, ["pixels"], reserve_bytes, owner=tmp_path)
+                create_px_ts(eop_dir=eopatches_dir,
+                             patchlet_dir=patchlets_dir,
+                             outpath=px_out,
+                             px_selection=px_selection,
+                             bands=bands)
+                artifact_ready(storage, patchlets_dir)
+                consume(storage, patchlets_dir, "pixels")
+                consume(storage, eopatches_dir, "pixels")
+
+                partial_times['pixel_level_timeseries_creation'] = time.time() - start
+
+            # 3b. Create grid-level time series
+            if grid_out_path is not None:
+                start = time.time()
+
+                print(f"{name}3b. Creating grid-level time series...")
+                create_grid_ts(eop_dir=eopatches_dir,
+                               outpath=grid_out_path,
+                               grid_levels=grid_levels,
+                               bands=bands)
+                consume(storage, eopatches_dir, "grid")
+
+                partial_times['grid_level_timeseries_creation'] = time.time() - start
+
+            # 4. Create field-level time series
+            if fields is not None and len(fields) > 0:
+                start = time.time()
+
+                print(f"{name}4. Creating field-level time series...")
+                field_partials = create_field_ts(eop_dir=eopatches_dir,
+                                                 out_path=field_out_path,
+                                                 fields=fields,
+                                                 field_stats=field_stats,
+                                                 partial_ids=partial_ids,
+                                                 max_ram=max_ram,
+                                                 bands=bands,
+                                                 tmp_path=tmp_path)
+                consume(storage, eopatches_dir, "fields")
+
+                partial_times['field_level_timeseries_creation'] = time.time() - start
+
+    return {
+        "number_of_images": n_images,
+        "image_width": width,
+        "image_height": height,
+        "partial_runtimes": partial_times,
+        "intermediate_bytes": intermediate_bytes,
+        "in_memory": in_memory,
+        "lazy": lazy,
+        "field_partials": field_partials,
+    }
+
+def run_tile(storage:dict, **kwargs) -> dict:
+    """
+    Run the pipeline of a tile (see tile_pipeline), deleting the intermediates it left afterwards, also if it failed.
+    """
+    try:
+        return tile_pipeline(storage=storage, **kwargs)
+    finally:
+        remove_artifacts(storage, owner=kwargs["tmp_path"])
+
+def image2ts_pipeline(input_paths: List[Text], extension:str,
+                      px_out:str, 
+                      field_path:str,
+                      field_out_path:str, 
+                      skip_pixel:bool,
+                      field_stats:List[str] = DEFAULT_FIELD_STATS,
+                      grid_out_path:str = None,
+                      grid_levels:List[int] = DEFAULT_GRID_LEVELS,
+                      px_selection:dict = None,
+                      start_date:dt.datetime = None,
+                      end_date:dt.datetime = None,
+                      roi = None,
+                      catalog_path:str = None,
+                      dry_run:bool = False,
+                      tile_jobs:int = 4,
+                      merge_rule:str = DEFAULT_MERGE_RULE,
+                      composite_days:int = None,
+                      composite_rule:str = DEFAULT_COMPOSITE_RULE,
+                      fused:bool = False,
+                      intermediate_codec:str = DEFAULT_CODEC,
+                      in_memory = "auto",
+                      disk_quota:int = None,
+                      field_partials_path:str = None,
+                      lazy:bool = False,
+                      bands:List[str] = None,
+                      max_ram:int = DEFAULT_MAX_RAM
+                      ):
+    """
+    This function takes a directory of raster files and headers and converts them to time series dataset.
+
+    Parameters
+    ----------
+    input_paths : List[Text]
+        List of paths to the input files.
+    extension : str
+        Extension of the input files. Default is 'TIF'.
+    px_out : str
+        Path to the folder where the pixel-level output files will be saved.
+    field_path : str
+        Path to the shapefile containing the boundaries of the agricultural fields. If not given, field-level time series will not be created.
+    field_out_path : str
+        Path to the folder where the field-level output files will be saved. 
+    skip_pixel : bool
+        Skip creating pixel-level time series
+    field_stats : List[str]
+        Statistics to compute per field and date, e.g. ['median', 'mean', 'p90', 'count']. Default is ['median'].
+    grid_out_path : str
+        Path to the folder where the coarse grid time series will be saved. If not given, grid-level time series will not be created.
+    grid_levels : List[int]
+        Block sizes (in pixels) of the coarse grids, e.g. [2, 4, 10] for 2x2, 4x4 and 10x10 blocks.
+    px_selection : dict
+        Options to restrict the pixel-level time series to a subset of the pixels: 'roi_path' (polygons that pixels should fall in),
+        'min_valid_ratio' (minimum fraction of valid observations) and 'sample_n' and 'seed' (random sample of pixels per patchlet).
+        The 'px_format' option selects the output format of the pixel time series ('csv', 'sparse' or 'sharded').
+    start_date, end_date : datetime
+        Only the images within this date range (inclusive) are read. RAS frames outside the range are skipped
+        by seeking, and TIF files outside the range (according to the date in their filename) are not opened.
+    roi : list or str
+        Region of interest [xmin, ymin, xmax, ymax] in the crs of the images, or 'fields' to use the bounds of the field layer.
+        Only the rows (RAS) or windows (TIF) of the images within the roi are read, and the eopatches are shrunk accordingly.
+    catalog_path : str
+        Local file in which the headers of the inputs are cached between runs. Files are only scanned again if their ETag changed.
+        Default is the catalog in /tmp (see src.catalog).
+    dry_run : bool
+        Only scan the inputs, check their alignment and estimate the required resources, without creating any time series.
+    tile_jobs : int
+        Inputs that span several tiles (different bbox, shape or crs) are processed as independent pipelines, of which
+        at most tile_jobs run concurrently. Each tile writes to a subfolder of the pixel and grid outputs, named after
+        its Sentinel-2 tile name or its crs and upper left corner, and only gets the fields that intersect it.
+        Fields that span several tiles are aggregated per tile into partial aggregates that are merged afterwards,
+        so that the field-level time series of all tiles end up in a single csv file.
+    merge_rule : str
+        How images of the same tile and date (e.g. overlapping orbits or reprocessed versions) are merged while unpacking:
+        'max' (highest valid value), 'first' (first valid value) or 'mean' (mean of the valid values). Default is 'max'.
+    composite_days : int
+        If given, the images are composited to regular periods of this many days (e.g. 5, 10 or 16) before any time series
+        is extracted, so that all outputs have one (aligned) date per period, named after the first day of the period.
+    composite_rule : str
+        How the valid values of a pixel within a period are composited: 'max', 'median' or 'last'. Default is 'max'.
+    fused : bool
+        Create the pixel, field and grid time series in a single pass over the eopatches (see src.fused), instead of
+        reading them once per output. The pixel output files then cover bands of rows of at most 1128 x 1128 pixels.
+    intermediate_codec : str
+        Codec of the intermediate frames: 'none' (default), 'gzip', 'lz4', 'zstd' or 'blosc', optionally with a level,
+        e.g. 'zstd:3' (see src.codec). The intermediate eopatches are only compressed with 'gzip', the only codec they support.
+        The bytes written to intermediate storage are reported in the metrics.
+    in_memory : bool or str
+        Process the tiles in memory: the unpacked images are stacked into a cube from which all time series are created directly,
+        without writing intermediate eopatches and patchlets. With 'auto' (default), a tile is processed in memory if its
+        estimated cube fits in half of its memory budget.
+    disk_quota : int
+        Maximum number of bytes of intermediate files in /tmp. Tiles wait before writing an intermediate folder until
+        the intermediates of the other tiles, which are deleted as soon as they are no longer needed, leave enough room.
+        The peak usage is reported in the metrics.
+    field_partials_path : str
+        Local file to which the partial aggregates of the fields that are not within the region of interest are saved,
+        instead of writing them to the field csv, so that they can be merged with those of other shards (see src.sharding).
+    lazy : bool
+        Use the lazy backend (requires dask): the unpacked images of every tile are opened as a lazily evaluated, chunked
+        (t, y, x) array, from which all time series are created by chunk-wise tasks that a local scheduler runs in parallel
+        within the memory budget of the tile (see src.lazy_cube). Takes precedence over in_memory and fused.
+    bands : List[str]
+        Create the time series of several bands (e.g. ['B2', 'B3', 'B4', 'B8A']) in a single run, instead of one band (LAI).
+        The band of every input is the folder or ZIP archive it is in (e.g. B4/...RAS or B4.zip). The bands are unpacked
+        concurrently into eopatches with one feature per band; the pixel and grid time series of every band are written to
+        a subfolder or csv named after the band, and the field time series to columns named <field_id>_<band>.
+        Bands are processed through eopatches, so they cannot be combined with fused, in_memory or lazy.
+    max_ram : int
+        Memory budget of the task in bytes (default 4e9), split evenly over the tiles that run concurrently. The budget
+        of a tile decides whether it is processed in memory (see in_memory) and bounds the partitions and bands of rows
+        in which its eopatches are written and read.
+    """
+    total_start = time.time()
+
+    # Check if we do pixel, field, or both
+    pixel = not skip_pixel
+    field = field_path is not None
+    grid = grid_out_path is not None
+
+    # Check if the extension is supported
+    if extension not in ["RAS", "TIF", "TIFF"]:
+        raise ValueError("Extension {} is not supported.".format(extension))
+
+    # Check the field statistics before doing any work
+    field_stats = check_field_stats(field_stats)
+    grid_levels = check_grid_levels(grid_levels)
+    merge_rule = check_merge_rule(merge_rule)
+    intermediate_codec = check_codec(intermediate_codec)
+    in_memory = check_in_memory(in_memory)
+    lazy = check_lazy(lazy)
+    bands = check_bands(bands)
+    check_px_selection(px_selection)
+    if isinstance(tile_jobs, bool) or not isinstance(tile_jobs, int) or tile_jobs < 1:
+        raise ValueError(f"tile_jobs should be a positive integer, got {tile_jobs!r}")
+    if isinstance(max_ram, bool) or not isinstance(max_ram, (int, float)) or max_ram <= 0:
+        raise ValueError(f"max_ram should be a positive number of bytes, got {max_ram!r}")
+    if bands is not None:
+        if fused or lazy or in_memory is True:
+            raise ValueError("bands are processed through eopatches; they cannot be combined with fused, in_memory or lazy")
+        in_memory = False
+    storage = create_storage(disk_quota)
+    if composite_days is not None:
+        check_composite(composite_days, composite_rule)
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise ValueError("The start date {} is after the end date {}.".format(start_date, end_date))
+    if roi is not None and (roi != "fields" or not field):
+        # Raises for a malformed roi, or for a roi derived from the fields without a field path
+        get_roi(roi, None)
+
+    # Only import the libraries to scan the inputs once the task is known to be valid
+    with timed_imports("catalog"):
+        from shapely.geometry import box
+        from src.catalog import CATALOG_PATH, update_catalog, estimate_resources, record_run, group_by_tile, group_by_band
+    catalog_path = catalog_path if catalog_path is not None else CATALOG_PATH
+
+    TMP_PATH = '/tmp'
+
+    partial_times = {}
+
+    start = time.time()
+
+    header_paths, infos = list_inputs(input_paths, extension, start_date, end_date)
+
+    # 0. Scan the headers of the inputs, group them by tile and check that they are aligned before any heavy work starts
+    print("0. Scanning the input headers...")
+    images = update_catalog(header_paths, catalog_path=catalog_path, infos=infos)
+    tiles = group_by_tile(images)
+    fields = load_fields_cached(field_path) if field else None
+
+    plans, tile_boxes = plan_tiles(tiles, fields, roi)
+    if len(plans) == 0:
+        raise ValueError("None of the input tiles overlap with the region of interest.")
+    print("Found {} tile(s): {}".format(len(plans), list(plans.keys())))
+
+    # With bands, every band adds its own cube to a tile
+    estimates = {tile_id: sum_estimates([estimate_resources(images, start_date=start_date, end_date=end_date, roi=tile_roi, catalog_path=catalog_path)
+                                         for images in (group_by_band(tile_images, bands).values() if bands is not None else [tile_images])])
+                 for tile_id, (tile_images, _, tile_roi) in plans.items()}
+    total_estimates = sum_estimates(list(estimates.values()))
+    print("Estimated resources:", total_estimates)
+
+    partial_times['catalog_scanning'] = time.time() - start
+
+    if dry_run:
+        ref = next(iter(plans.values()))[0][0]
+        return {
+            "message": "Inputs are aligned; no time series were created (dry run).",
+            "output": {},
+            "metrics": {
+                "number_of_images": total_estimates["number_of_dates"],
+                "image_width": ref["shape"][1],
+                "image_height": ref["shape"][0],
+                "number_of_tiles": len(plans),
+                "estimates": total_estimates,
+                "total_runtime": time.time() - total_start,
+                "partial_runtimes": partial_times,
+                "import_times": collect_import_times(),
+            },
+            "status": "success"
+        }
+
+    # Run an independent pipeline per tile, each with its own intermediate files and outputs
+    single = len(plans) == 1
+    tile_jobs = max(1, min(tile_jobs, len(plans)))
+    tile_ram = int(max_ram) // tile_jobs
+
+    # Fields that are not within a single tile are aggregated per tile and merged afterwards;
+    # with a field_partials_path, so are the fields that are not within the region of interest
+    boundary_ids = {}
+    if field and (not single or field_partials_path is not None):
+        for tile_id, (_, tile_fields, tile_roi) in plans.items():
+            tile_box = tile_boxes[tile_id]
+            if field_partials_path is not None and tile_roi is not None:
+                tile_box = tile_box.intersection(box(*tile_roi))
+            boundary_ids[tile_id] = list(tile_fields.index[~tile_fields.within(tile_box)])
+            if os.path.exists(get_tile_field_path(TMP_PATH, tile_id)):
+                os.remove(get_tile_field_path(TMP_PATH, tile_id))
+
+    with ThreadPoolExecutor(max_workers=tile_jobs) as executor:
+        futures = {}
+        for tile_id, (tile_images, tile_fields, tile_roi) in plans.items():
+            futures[tile_id] = executor.submit(run_tile, storage,
+                                               tile_images=tile_images,
+                                               extension=extension,
+                                               tmp_path=TMP_PATH if single else os.path.join(TMP_PATH, "tiles", tile_id),
+                                               px_out=px_out if single else get_tile_output(px_out, tile_id),
+                                               fields=tile_fields if field else None,
+                                               field_out_path=field_out_path if single else get_tile_field_path(TMP_PATH, tile_id),
+                                               grid_out_path=grid_out_path if single else get_tile_output(grid_out_path, tile_id),
+                                               skip_pixel=skip_pixel,
+                                               field_stats=field_stats,
+                                               grid_levels=grid_levels,
+                                               px_selection=px_selection,
+                                               start_date=start_date,
+                                               end_date=end_date,
+                                               roi=tile_roi,
+                                               max_ram=tile_ram,
+                                               name="" if single else f"[{tile_id}] ",
+                                               merge_rule=merge_rule,
+                                               composite_days=composite_days,
+                                               composite_rule=composite_rule,
+                                               partial_ids=boundary_ids.get(tile_id),
+                                               fused=fused,
+                                               codec=intermediate_codec,
+                                               in_memory=not lazy and use_in_memory(in_memory, estimates[tile_id]["cube_bytes"], tile_ram),
+                                               lazy=lazy,
+                                               bands=bands,
+                                               reserve_bytes=estimates[tile_id]["cube_bytes"])
+        tile_metrics = {tile_id: future.result() for tile_id, future in futures.items()}
+
+    # Merge the partial aggregates of the fields that span several tiles and combine the field time series of all tiles
+    field_partials = [m.pop("field_partials") for m in tile_metrics.values()]
+    if field and field_partials_path is not None:
+        save_field_partials(field_partials, field_partials_path)
+        field_partials = []
+    if field and not single:
+        start = time.time()
+
+        print("5. Merging the field-level time series of all tiles...")
+        combine_tile_fields(field_partials, [get_tile_field_path(TMP_PATH, t) for t in plans], field_out_path, field_stats)
+
+        partial_times['field_level_timeseries_merging'] = time.time() - start
+
+    # Sum the partial runtimes over the tiles
+    for metrics in tile_metrics.values():
+        for key, value in metrics["partial_runtimes"].items():
+            partial_times[key] = partial_times.get(key, 0) + value
+
+    # Sum the intermediate bytes over the tiles
+    intermediate_bytes = {}
+    for metrics in tile_metrics.values():
+        for key, value in metrics["intermediate_bytes"].items():
+            intermediate_bytes[key] = intermediate_bytes.get(key, 0) + value
+
+    # 6. Create the output json
+    ref = next(iter(tile_metrics.values()))
     output_json = {
         "message": "Time series data has been created successfully.",
         "output": {},
         "metrics": {
-            "number_of_images": n_images,
-            "image_width": width,
-            "image_height": height,
+            "number_of_images": sum(m["number_of_images"] for m in tile_metrics.values()),
+            "image_width": ref["image_width"],
+            "image_height": ref["image_height"],
+            "estimates": total_estimates,
+            "in_memory": all(m["in_memory"] for m in tile_metrics.values()),
+            "lazy": lazy,
+            "bands": bands,
+            "intermediate_codec": intermediate_codec,
+            "intermediate_bytes": intermediate_bytes,
+            "storage": storage_metrics(storage),
             "total_runtime": time.time() - total_start,
             "partial_runtimes": partial_times,
+            "import_times": collect_import_times(),
         },
         "status": "success"
     }
+    if not single:
+        output_json["metrics"]["number_of_tiles"] = len(plans)
+        output_json["metrics"]["tiles"] = tile_metrics
+
+    # Record the throughput of this run to estimate the runtime of later tasks
+    record_run(total_estimates["number_of_values"], time.time() - total_start, catalog_path=catalog_path)
+
     if pixel:
         output_json["output"]["pixel_timeseries"] = px_out
     if field:
         output_json["output"]["field_timeseries"] = field_out_path
+    if grid:
+        output_json["output"]["grid_timeseries"] = grid_out_path
 
     return output_json
         
 
-if __name__ == "__main__":
+def error_response(e:Exception) -> dict:
+    return {
+        "message": str(e),
+        "error": "An error occurred during the image to time series conversion.",
+        "status": "failed",
+    }
 
+def parse_task(input_json:dict) -> dict:
+    """
+    Parse a task JSON (see the README) into the arguments of image2ts_pipeline.
+    MinIO credentials are parsed separately (see parse_credentials), as they should only be set while the task runs.
+    """
+    # Handle the new input format which includes a "result" section
+    if "result" in input_json:
+        input_data = input_json["result"]
+    else:
+        input_data = input_json
+
+    # Required parameters - now handling a list of image paths
     try:
-        if len(sys.argv) < 3: # If no arguments are given, use the default values
-            input_json_path = "resources/input.json"
-            output_json_path = "resources/output.json"
+        # The input images are now in result.input.images which is a list
+        input_paths = input_data["input"]["images"]
+        if not isinstance(input_paths, list):
+            input_paths = [input_paths]
+    except Exception as e:
+        raise ValueError(f"Input paths are required. See the documentation for the suggested input format. Error: {e}")
+    
+
+    try:
+        if isinstance(input_data["input"].get("field_path"), str):
+            # If field_path is a string, use it directly
+            field_path = input_data["input"]["field_path"]
+        elif isinstance(input_data["input"].get("field_path"), list):
+            # If field_path is already a list, use it as is
+            field_path = input_data["input"]["field_path"][0]
         else:
-            input_json_path = sys.argv[1]
-            output_json_path = sys.argv[2]
+            field_path = None
+    except Exception as e:
+        print("Field path is not provided, field-level time series will not be created.")
 
-        # Read and parse the input JSON file
-        with open(input_json_path, "r") as f:
-            input_json = json.load(f)
-        
-        # Handle the new input format which includes a "result" section
-        if "result" in input_json:
-            input_data = input_json["result"]
+    field_out_path = None
+    if "field_timeseries" in input_data["output"]:
+        field_out_path = input_data["output"].get("field_timeseries", None)
+    elif field_path is not None:
+        raise ValueError("Field path is provided but no output path for field-level time series is specified in the input JSON.")
+
+    grid_out_path = input_data["output"].get("grid_timeseries", None)
+
+    try:
+        # The output path is now in result.output.timeseries
+        px_out = input_data["output"]["pixel_timeseries"]
+    except Exception as e:
+        raise ValueError(f"Output path is required. See the documentation for the suggested input format. Error: {e}")
+    
+
+    # Optional parameters
+    file_extension = input_data.get("parameters", {}).get("extension", "TIF")
+    # This is now fetched through inputs
+    #field_path = input_data.get("parameters", {}).get("field_path", None)
+    skip_pixel = input_data.get("parameters", {}).get("skip_pixel", False)
+    field_stats = input_data.get("parameters", {}).get("field_stats", DEFAULT_FIELD_STATS)
+    grid_levels = input_data.get("parameters", {}).get("grid_levels", DEFAULT_GRID_LEVELS)
+    px_selection = {
+        "roi_path": input_data.get("parameters", {}).get("px_mask_path", None),
+        "min_valid_ratio": input_data.get("parameters", {}).get("min_valid_ratio", None),
+        "sample_n": input_data.get("parameters", {}).get("sample_pixels", None),
+        "seed": input_data.get("parameters", {}).get("sample_seed", 0),
+        "px_format": input_data.get("parameters", {}).get("px_format", "csv"),
+    }
+
+    start_date = parse_date(input_data.get("parameters", {}).get("start_date", None), "start_date")
+    end_date = parse_date(input_data.get("parameters", {}).get("end_date", None), "end_date")
+    roi = input_data.get("parameters", {}).get("roi", None)
+    if roi == "fields" and field_path is None:
+        raise ValueError("The region of interest can only be derived from the fields if a field path is given.")
+    catalog_path = input_data.get("parameters", {}).get("catalog_path", None)
+    dry_run = input_data.get("parameters", {}).get("dry_run", False)
+    tile_jobs = input_data.get("parameters", {}).get("tile_jobs", 4)
+    merge_rule = input_data.get("parameters", {}).get("merge_rule", DEFAULT_MERGE_RULE)
+    composite_days = input_data.get("parameters", {}).get("composite_days", None)
+    composite_rule = input_data.get("parameters", {}).get("composite_rule", DEFAULT_COMPOSITE_RULE)
+    fused = input_data.get("parameters", {}).get("fused", False)
+    intermediate_codec = input_data.get("parameters", {}).get("intermediate_codec", DEFAULT_CODEC)
+    in_memory = input_data.get("parameters", {}).get("in_memory", "auto")
+    disk_quota = input_data.get("parameters", {}).get("disk_quota", None)
+    lazy = input_data.get("parameters", {}).get("lazy", False)
+    bands = input_data.get("parameters", {}).get("bands", None)
+    max_ram = input_data.get("parameters", {}).get("max_ram", DEFAULT_MAX_RAM)
+
+    # Check the minio credentials before doing any work
+    parse_credentials(input_json)
+
+    return dict(input_paths=input_paths,
+                extension=file_extension,
+                px_out=px_out,
+                field_path=field_path,
+                field_out_path=field_out_path,
+                skip_pixel=skip_pixel,
+                field_stats=field_stats,
+                grid_out_path=grid_out_path,
+                grid_levels=grid_levels,
+                px_selection=px_selection,
+                start_date=start_date,
+                end_date=end_date,
+                roi=roi,
+                catalog_path=catalog_path,
+                dry_run=dry_run,
+                tile_jobs=tile_jobs,
+                merge_rule=merge_rule,
+                composite_days=composite_days,
+                composite_rule=composite_rule,
+                fused=fused,
+                intermediate_codec=intermediate_codec,
+                in_memory=in_memory,
+                disk_quota=disk_quota,
+                lazy=lazy,
+                bands=bands,
+                max_ram=max_ram)
+
+def parse_credentials(input_json:dict) -> dict:
+    """
+    Get the MinIO credentials of a task JSON as a dict of environment variables, or None if the task has none.
+    The session token is None if the task has none, so that it is unset while the task runs.
+    """
+    input_data = input_json.get("result", input_json)
+    if "minio" not in input_data:
+        return None
+
+    try:
+        credentials = {
+            "MINIO_ACCESS_KEY": input_data["minio"]["id"],
+            "MINIO_SECRET_KEY": input_data["minio"]["key"],
+            "MINIO_ENDPOINT_URL": input_data["minio"]["endpoint_url"],
+        }
+    except Exception as e:
+        raise ValueError(f"Access and secret keys are required if any path is on MinIO. Error: {e}")
+    credentials["MINIO_SESSION_TOKEN"] = input_data["minio"].get("skey") or None
+    return credentials
+
+def set_environ(variables:dict):
+    for name, value in variables.items():
+        if value is None:
+            os.environ.pop(name, None)
         else:
-            input_data = input_json
+            os.environ[name] = value
 
-        # Required parameters - now handling a list of image paths
-        try:
-            # The input images are now in result.input.images which is a list
-            input_paths = input_data["input"]["images"]
-            if not isinstance(input_paths, list):
-                input_paths = [input_paths]
-        except Exception as e:
-            raise ValueError(f"Input paths are required. See the documentation for the suggested input format. Error: {e}")
-        
+@contextmanager
+def task_credentials(credentials:dict):
+    """
+    Set the MinIO credentials of a task (see parse_credentials) as environment variables while it runs, and restore the
+    previous ones afterwards, so that a long-lived process (see src.service) never hands them to the next task.
+    """
+    if credentials is None:
+        yield
+        return
 
-        try:
-            if isinstance(input_data["input"].get("field_path"), str):
-                # If field_path is a string, use it directly
-                field_path = input_data["input"]["field_path"]
-            elif isinstance(input_data["input"].get("field_path"), list):
-                # If field_path is already a list, use it as is
-                field_path = input_data["input"]["field_path"][0]
-            else:
-                field_path = None
-        except Exception as e:
-            print("Field path is not provided, field-level time series will not be created.")
+    previous = {name: os.environ.get(name) for name in credentials}
+    set_environ(credentials)
+    try:
+        yield
+    finally:
+        set_environ(previous)
+
+def run_task(input_json:dict) -> dict:
+    """
+    Run a task JSON and return the output JSON; errors are reported in the output JSON instead of raised.
+    """
+    try:
+        kwargs = parse_task(input_json)
+        with task_credentials(parse_credentials(input_json)):
+            response = image2ts_pipeline(**kwargs)
+    except Exception as e:
+        response = error_response(e)
+
+    print(response)
+    return response
+
+if __name__ == "__main__":
 
-        field_out_path = None
-        if "field_timeseries" in input_data["output"]:
-            field_out_path = input_data["output"].get("field_timeseries", None)
-        elif field_path is not None:
-            raise ValueError("Field path is provided but no output path for field-level time series is specified in the input JSON.")
+    # python main.py serve [host:port] keeps a warm service running, see src.service
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from src.service import SERVICE_ADDRESS, serve
+        host, _, port = (sys.argv[2] if len(sys.argv) > 2 else SERVICE_ADDRESS).rpartition(":")
+        serve(host or "127.0.0.1", int(port))
+        sys.exit(0)
 
+    # python main.py plan input.json queue.db splits a task into shards, python main.py worker queue.db runs them (on any
+    # number of nodes) and python main.py merge queue.db output.json merges their results, see src.sharding
+    if len(sys.argv) > 2 and sys.argv[1] in ["plan", "worker", "merge"]:
+        from src.sharding import plan_shards, run_worker, merge_shards
+    if len(sys.argv) > 2 and sys.argv[1] == "plan":
+        with open(sys.argv[2], "r") as f:
+            print(json.dumps(plan_shards(json.load(f), sys.argv[3] if len(sys.argv) > 3 else "resources/queue.db"), indent=4))
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "merge":
+        output_json_path = sys.argv[3] if len(sys.argv) > 3 else "resources/output.json"
         try:
-            # The output path is now in result.output.timeseries
-            px_out = input_data["output"]["pixel_timeseries"]
+            response = merge_shards(sys.argv[2])
         except Exception as e:
-            raise ValueError(f"Output path is required. See the documentation for the suggested input format. Error: {e}")
-        
-
-        # Optional parameters
-        file_extension = input_data.get("parameters", {}).get("extension", "TIF")
-        # This is now fetched through inputs
-        #field_path = input_data.get("parameters", {}).get("field_path", None)
-        skip_pixel = input_data.get("parameters", {}).get("skip_pixel", False)
-
-        # Check if minio credentials are provided
-        if "minio" in input_data:
-            try:
-                id = input_data["minio"]["id"]
-                key = input_data["minio"]["key"]
-                token = input_data["minio"].get("skey")
-                url = input_data["minio"]["endpoint_url"]
-
-                os.environ["MINIO_ACCESS_KEY"] = id
-                os.environ["MINIO_SECRET_KEY"] = key
-                os.environ["MINIO_ENDPOINT_URL"] = url
-                if token:
-                    os.environ["MINIO_SESSION_TOKEN"] = token
-
-            except Exception as e:
-                raise ValueError(f"Access and secret keys are required if any path is on MinIO. Error: {e}")
-
-        response = image2ts_pipeline(input_paths=input_paths,
-                                    extension=file_extension,
-                                    px_out=px_out,
-                                    field_path=field_path,
-                                    field_out_path=field_out_path,
-                                    skip_pixel=skip_pixel)
-        
+            response = error_response(e)
         print(response)
-        
         with open(output_json_path, "w") as f:
             json.dump(response, f, indent=4)
-    
-    
-    except Exception as e:
+        sys.exit(0)
 
-        error_response = {
-            "message": str(e),
-            "error": "An error occurred during the image to time series conversion.",
-            "status": "failed",
-        }
+    if len(sys.argv) < 3: # If no arguments are given, use the default values
+        input_json_path = "resources/input.json"
+        output_json_path = "resources/output.json"
+    else:
+        input_json_path = sys.argv[1]
+        output_json_path = sys.argv[2]
 
-        print(error_response)
-        
-        with open(output_json_path, "w") as f:
-            json.dump(error_response, f, indent=4)
+    try:
+        # Read and parse the input JSON file
+        with open(input_json_path, "r") as f:
+            input_json = json.load(f)
+        response = run_task(input_json)
+    except Exception as e:
+        response = error_response(e)
+        print(response)
+
+    with open(output_json_path, "w") as f:
+        json.dump(response, f, indent=4)
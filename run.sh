@@ -33,8 +33,16 @@ printf "\n"
 # Store the "result" part into a file named "input.json"
 echo "$result" > input.json
 
-# Execute the tool and force stdout to be unbuffered
-python -u main.py input.json output.json
+# Execute the tool and force stdout to be unbuffered, or hand the task to a warm service (python main.py serve) if one is given
+if [ -n "$IMAGE2TS_SERVICE_URL" ]; then
+    echo "[STELAR INFO] Running the task on the service at $IMAGE2TS_SERVICE_URL..."
+    if ! curl -sf -X POST -H "Content-Type: application/json" --data-binary @input.json "$IMAGE2TS_SERVICE_URL/run" > output.json; then
+        echo "[STELAR INFO] cURL request to the service at $IMAGE2TS_SERVICE_URL has failed!. Aborting..."
+        exit 5
+    fi
+else
+    python -u main.py input.json output.json
+fi
 
 # Perform the second curl request with replacements and store the response in a variable
 output_json=$(<output.json)  # Read content of output.json file into a variable
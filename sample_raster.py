@@ -6,6 +6,7 @@ import rasterio
 import numpy as np
 import json
 from minio import Minio
+from cog import COG_CODECS, write_cog
 from rasterio.windows import Window
 
 def get_minio_client(credentials_file_path):
@@ -83,6 +84,8 @@ def main():
     parser.add_argument("--sample_size", type=int, default=100, help="Size (pixels) of the square sample to take from the center. Default: 100.")
     parser.add_argument("--output_dir", required=True, help="Minio subdirectory name within the original file\\'s path to save samples (e.g., \\'small\\').")
     parser.add_argument("--credentials_file", default="resources/credentials.json", help="Path to Minio credentials JSON file. Default: resources/credentials.json.")
+    parser.add_argument("--codec", default="zstd", choices=COG_CODECS, help="Compression codec of the sampled COGs. Default: zstd.")
+    parser.add_argument("--overviews", action="store_true", help="Add overviews to the sampled COGs.")
 
     # Default run
     if len(sys.argv) == 1:
@@ -195,14 +198,12 @@ def main():
                 new_profile.update({
                     'height': actual_height,
                     'width': actual_width,
-                    'transform': window_transform,
-                    'compress': new_profile.get('compress', 'lzw') 
+                    'transform': window_transform
                 })
                 
                 local_temp_sample_path = os.path.join('/tmp', sample_base_name)
 
-                with rasterio.open(local_temp_sample_path, 'w', **new_profile) as dst:
-                    dst.write(data)
+                write_cog(local_temp_sample_path, data, new_profile, codec=args.codec, overviews=args.overviews)
 
                 print(f"[{i}/{len(files_to_process)}] Uploading sample to Minio: {args.bucket_name}/{minio_output_object_name}")
                 minio_client.fput_object(
@@ -0,0 +1,376 @@
+import io
+import os
+import re
+import json
+import zipfile
+import datetime as dt
+import numpy as np
+import rasterio
+from sentinelhub import BBox, CRS
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from stelar_spatiotemporal.lib import get_filesystem
+
+from src.preprocessing import get_image_date, get_roi_window
+from src.vista_preprocessing import parse_rhd, get_zip_ras_pairs
+
+CATALOG_PATH = "/tmp/catalog/image_catalog.json"
+CATALOG_VERSION = 2
+
+# Data type of the values in RAS files
+RAS_DTYPE = "int16"
+
+# Sentinel-2 (MGRS) tile names in filenames, e.g. T30TXM
+TILE_PATTERN = re.compile(r"(?<![A-Z0-9])T(\d{2}[C-X][A-Z]{2})(?![A-Z0-9])")
+
+
+def get_etag(info:dict) -> str:
+    """
+    Get a version tag of a file from its listing info: the ETag for MinIO objects, the modification time and size otherwise.
+    """
+    for key in ["ETag", "etag"]:
+        if info.get(key) is not None:
+            return str(info[key]).strip('"')
+    return "{}-{}".format(info.get("mtime", info.get("LastModified", "")), info.get("size", ""))
+
+
+def load_catalog(catalog_path:str = CATALOG_PATH) -> dict:
+    """
+    Load the catalog of scanned inputs as a dict with the scanned files (by path) and the recorded runs.
+    """
+    if not os.path.exists(catalog_path):
+        return {"version": CATALOG_VERSION, "files": {}, "runs": []}
+
+    with open(catalog_path, "r") as f:
+        catalog = json.load(f)
+    if catalog.get("version") != CATALOG_VERSION:
+        print(f"Catalog {catalog_path} has an outdated version, rebuilding it")
+        return {"version": CATALOG_VERSION, "files": {}, "runs": []}
+    return catalog
+
+
+def save_catalog(catalog:dict, catalog_path:str = CATALOG_PATH):
+    os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+
+    # Write to a temporary file first, so that an interrupted run never leaves a corrupt catalog
+    tmp_path = catalog_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(catalog, f)
+    os.replace(tmp_path, catalog_path)
+
+
+def image_record(name:str, bbox:BBox, shape:tuple, dtype:str, dates:List[str], size:int = None) -> dict:
+    record = {
+        "name": name,
+        "bbox": [float(b) for b in bbox],
+        "crs": bbox.crs.epsg,
+        "shape": [int(shape[0]), int(shape[1])],
+        "dtype": str(dtype),
+        "dates": dates,
+    }
+    if size is not None:
+        record["size"] = int(size)
+    return record
+
+
+def ras_size(img_h:int, img_w:int, timestamps:List[str]) -> int:
+    # RAS files are uncompressed, so their size follows from the header
+    return img_h * img_w * np.dtype(RAS_DTYPE).itemsize * len(timestamps)
+
+
+def find_tile_name(path:str) -> str:
+    """
+    Find the Sentinel-2 (MGRS) tile name in a path, e.g. T30TXM, in the filename first and then in its folders or archives.
+    Returns None if the path names no tile.
+    """
+    for part in reversed(path.split("/")):
+        match = TILE_PATTERN.search(part)
+        if match is not None:
+            return match.group(0)
+    return None
+
+
+def get_tile_crs(path:str) -> CRS:
+    """
+    Get the UTM crs of the Sentinel-2 tile named in a path (see find_tile_name): EPSG:326<zone> for the northern
+    latitude bands (N-X) and EPSG:327<zone> for the southern ones (C-M), e.g. EPSG:32630 for T30TXM.
+    RHD headers carry no crs, so a RAS image is rejected with a ValueError if its path names no tile.
+    """
+    name = find_tile_name(path)
+    if name is None:
+        raise ValueError(f"Could not determine the crs of {path}; its filename, folder or archive should name its Sentinel-2 tile, e.g. T30TXM")
+    zone, band = int(name[1:3]), name[3]
+    if not 1 <= zone <= 60:
+        raise ValueError(f"Could not determine the crs of {path}; {name} is not a valid Sentinel-2 tile")
+    return CRS("{}{:02d}".format("326" if band >= "N" else "327", zone))
+
+
+def scan_rhd(path:str) -> List[dict]:
+    """
+    Describe the images of a RAS file based on its RHD header; the crs follows from the tile name in the path (see get_tile_crs).
+    """
+    crs = get_tile_crs(path)
+    with get_filesystem(path).open(path, "r") as f:
+        rhd = f.readlines()
+    img_h, img_w, timestamps, bbox = parse_rhd(rhd, path, crs=crs)
+    return [image_record(path[:-len(".RHD")] + ".RAS", bbox, (img_h, img_w), RAS_DTYPE, timestamps,
+                         size=ras_size(img_h, img_w, timestamps))]
+
+
+def scan_zip(path:str) -> List[dict]:
+    """
+    Describe the images of all RAS files in a ZIP archive; only the central directory and the RHD members are read.
+    The crs of every member follows from the tile name in its name or in the path of the archive (see get_tile_crs).
+    """
+    records = []
+    with get_filesystem(path).open(path, "rb") as zip_file, zipfile.ZipFile(zip_file) as archive:
+        for ras_member, rhd_member in get_zip_ras_pairs(archive, path):
+            crs = get_tile_crs(f"{path}/{rhd_member}")
+            with archive.open(rhd_member) as rhdfile:
+                rhd = io.TextIOWrapper(rhdfile).readlines()
+            img_h, img_w, timestamps, bbox = parse_rhd(rhd, f"{path}/{rhd_member}", crs=crs)
+            records.append(image_record(f"{path}/{ras_member}", bbox, (img_h, img_w), RAS_DTYPE, timestamps,
+                                        size=ras_size(img_h, img_w, timestamps)))
+    return records
+
+
+def scan_tif(path:str) -> List[dict]:
+    """
+    Describe a single-band TIF image based on its metadata; the date is inferred from the filename.
+    """
+    date = get_image_date(path)
+    dates = [date.strftime("%Y_%m_%d")] if date is not None else []
+
+    # Only the header is read; GDAL does not touch the pixel blocks
+    source = get_filesystem(path).open(path, "rb") if path.startswith("s3://") else path
+    with rasterio.open(source) as src:
+        bbox = BBox(tuple(src.bounds), crs=CRS(src.crs.to_epsg()))
+        return [image_record(path, bbox, (src.height, src.width), src.dtypes[0], dates)]
+
+
+def scan_file(path:str) -> List[dict]:
+    if path.endswith(".RHD"):
+        return scan_rhd(path)
+    if path.endswith((".zip", ".ZIP")):
+        return scan_zip(path)
+    return scan_tif(path)
+
+
+def get_file_infos(paths:List[str], n_jobs:int = 16) -> Dict[str, dict]:
+    """
+    Get the listing info (size, ETag) of files concurrently.
+    """
+    def info(path):
+        return get_filesystem(path).info(path)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return dict(zip(paths, executor.map(info, paths)))
+
+
+def update_catalog(paths:List[str], catalog_path:str = CATALOG_PATH, infos:Dict[str, dict] = None, n_jobs:int = 16) -> List[dict]:
+    """
+    Scan the headers of the input files (RHD, ZIP or TIF) and record their images in the catalog.
+    Files whose ETag did not change since the last scan are not read again; the others are scanned concurrently.
+    Listing infos (e.g. from a glob with detail=True) can be passed to avoid requesting them again.
+    Returns the image records of all given files.
+    """
+    catalog = load_catalog(catalog_path)
+    files = catalog["files"]
+
+    infos = dict(infos or {})
+    missing = [p for p in paths if p not in infos]
+    if len(missing) > 0:
+        infos.update(get_file_infos(missing, n_jobs=n_jobs))
+
+    # Only rescan new or modified files
+    to_scan = [p for p in paths if p not in files or files[p]["etag"] != get_etag(infos[p])]
+    if len(to_scan) > 0:
+        print(f"Scanning the headers of {len(to_scan)}/{len(paths)} input files...")
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for path, records in zip(to_scan, executor.map(scan_file, to_scan)):
+                files[path] = {
+                    "etag": get_etag(infos[path]),
+                    "size": int(infos[path].get("size", 0)),
+                    "scanned": dt.datetime.now().isoformat(timespec="seconds"),
+                    "images": records,
+                }
+        save_catalog(catalog, catalog_path)
+
+    # Images without a known data size (TIF) get the size of their file
+    images = []
+    for path in paths:
+        for record in files[path]["images"]:
+            images.append(dict({"size": files[path]["size"]}, **record, file=path))
+    return images
+
+
+def validate_alignment(images:List[dict]):
+    """
+    Check that all images share the same crs, shape and bounding box, and report the dates that occur more than once.
+    Raises a ValueError describing the mismatching images otherwise.
+    """
+    if len(images) == 0:
+        raise ValueError("No input images found to validate")
+
+    ref = images[0]
+    res = (ref["bbox"][2] - ref["bbox"][0]) / ref["shape"][1]
+
+    errors = []
+    for image in images[1:]:
+        if image["crs"] != ref["crs"]:
+            errors.append(f"{image['name']} has crs EPSG:{image['crs']} instead of EPSG:{ref['crs']}")
+        elif image["shape"] != ref["shape"]:
+            errors.append(f"{image['name']} has shape {image['shape']} instead of {ref['shape']}")
+        elif not np.allclose(image["bbox"], ref["bbox"], rtol=0, atol=res / 100):
+            errors.append(f"{image['name']} has bbox {image['bbox']} instead of {ref['bbox']}")
+
+    if len(errors) > 0:
+        shown = "\n".join(errors[:10])
+        raise ValueError(f"{len(errors)} input images are not aligned with {ref['name']}:\n{shown}")
+
+    dates = [d for image in images for d in image["dates"]]
+    unique, counts = np.unique(dates, return_counts=True)
+    if (counts > 1).any():
+        print(f"{int((counts > 1).sum())} dates occur in more than one input image and will be merged, e.g. {unique[counts > 1][:5].tolist()}")
+
+
+def get_tile_id(images:List[dict]) -> str:
+    """
+    Name a tile after the Sentinel-2 tile name shared by all its images, or after its crs and upper left corner.
+    """
+    names = set()
+    for image in images:
+        match = TILE_PATTERN.search(os.path.basename(image["name"]))
+        names.add(match.group(0) if match is not None else None)
+    if len(names) == 1 and None not in names:
+        return names.pop()
+
+    ref = images[0]
+    return "EPSG{}_{}_{}".format(ref["crs"], int(round(ref["bbox"][0])), int(round(ref["bbox"][3])))
+
+
+def is_shifted(image:dict, other:dict) -> bool:
+    """
+    Check whether two images of the same crs and shape are offset by less than half of their size in both directions.
+    Such images cover mostly the same area, so they are the same tile (misaligned or not), rather than neighbouring tiles,
+    which overlap by a small margin at most (e.g. the 9.8 km of Sentinel-2 tiles).
+    """
+    width, height = image["bbox"][2] - image["bbox"][0], image["bbox"][3] - image["bbox"][1]
+    return abs(image["bbox"][0] - other["bbox"][0]) < width / 2 and abs(image["bbox"][3] - other["bbox"][3]) < height / 2
+
+
+def group_by_tile(images:List[dict]) -> Dict[str, List[dict]]:
+    """
+    Group the images by tile, i.e. by crs, shape and (pixel-rounded) bbox, so that every group is aligned.
+    Groups of the same crs and shape whose bboxes mostly overlap (see is_shifted) are the same tile: they are merged
+    if they are aligned after all (within the tolerance of validate_alignment), and rejected as misaligned otherwise.
+    Returns a dict mapping tile ids to the images of the tile.
+    """
+    groups = {}
+    for image in images:
+        res = (image["bbox"][2] - image["bbox"][0]) / image["shape"][1]
+        key = (image["crs"], tuple(image["shape"]), tuple(int(round(b / res)) for b in image["bbox"]))
+        groups.setdefault(key, []).append(image)
+
+    keys = list(groups.keys())
+    for i, key in enumerate(keys):
+        for other in keys[i + 1:]:
+            if key not in groups or other not in groups or key[:2] != other[:2] or not is_shifted(groups[key][0], groups[other][0]):
+                continue
+            # Raises the alignment error for misaligned images
+            validate_alignment(groups[key] + groups[other])
+            groups[key].extend(groups.pop(other))
+
+    tiles = {}
+    for group in groups.values():
+        tile_id = get_tile_id(group)
+        # Tiles with the same name (e.g. different grids of the same MGRS tile) get a suffix
+        if tile_id in tiles:
+            tile_id = "{}_{}".format(tile_id, sum(t.startswith(tile_id) for t in tiles))
+        tiles[tile_id] = group
+    return dict(sorted(tiles.items()))
+
+
+def get_image_band(image:dict, bands:List[str]) -> str:
+    """
+    Get the band of an image from its path: the band whose name is a folder of the path (e.g. B4/...RAS) or the name of
+    the archive the image is in (e.g. B4.zip/...RAS). Raises a ValueError if the path names none or several of the bands.
+    """
+    parts = set()
+    for part in image["name"].split("/")[:-1]:
+        parts.update([part, os.path.splitext(part)[0]])
+    matches = [band for band in bands if band in parts]
+    if len(matches) != 1:
+        raise ValueError(f"Could not determine the band of {image['name']}; its folder or archive should be named after one of {bands}")
+    return matches[0]
+
+
+def group_by_band(images:List[dict], bands:List[str]) -> Dict[str, List[dict]]:
+    """
+    Group the images of a tile by band (see get_image_band); every band should have at least one image.
+    """
+    groups = {band: [] for band in bands}
+    for image in images:
+        groups[get_image_band(image, bands)].append(image)
+
+    missing = [band for band, band_images in groups.items() if len(band_images) == 0]
+    if len(missing) > 0:
+        raise ValueError(f"No input images found for band(s) {missing}")
+    return groups
+
+
+def in_range(date:str, start_date:dt.datetime = None, end_date:dt.datetime = None) -> bool:
+    date = dt.datetime.strptime(date, "%Y_%m_%d")
+    return (start_date is None or date >= start_date) and (end_date is None or date <= end_date)
+
+
+def estimate_resources(images:List[dict], start_date:dt.datetime = None, end_date:dt.datetime = None,
+                       roi:tuple = None, catalog_path:str = CATALOG_PATH) -> dict:
+    """
+    Estimate the work of a task from the catalog records of its (aligned) input images:
+    the number of dates and values to process, the bytes to read, the size of the stacked cube and the peak local disk usage.
+    The runtime is estimated from the throughput of earlier runs recorded in the catalog, if any.
+    """
+    ref = images[0]
+    h, w = ref["shape"]
+    if roi is not None:
+        bbox = BBox(tuple(ref["bbox"]), crs=CRS(ref["crs"]))
+        _, _, h, w, _ = get_roi_window(bbox, h, w, roi)
+
+    dates = set()
+    read_bytes = 0
+    for image in images:
+        image_dates = [d for d in image["dates"] if in_range(d, start_date, end_date)]
+        dates.update(image_dates)
+        if len(image["dates"]) > 0:
+            read_bytes += image["size"] * len(image_dates) / len(image["dates"]) * (h * w) / np.prod(image["shape"])
+
+    n_values = len(dates) * h * w
+    itemsize = np.dtype(ref["dtype"]).itemsize
+
+    # The frames are deleted once they are combined into eopatches, which are deleted once the patchlets are extracted,
+    # so at most two copies of the cube exist at the same time (see src.storage)
+    npy_bytes = n_values * itemsize
+    estimates = {
+        "number_of_dates": len(dates),
+        "number_of_values": int(n_values),
+        "read_bytes": int(read_bytes),
+        "peak_disk_bytes": int(2 * npy_bytes),
+        "cube_bytes": int(npy_bytes),
+        "runtime_seconds": None,
+    }
+
+    runs = load_catalog(catalog_path)["runs"]
+    if len(runs) > 0:
+        values_per_second = sum(r["number_of_values"] for r in runs) / max(sum(r["runtime"] for r in runs), 1e-9)
+        estimates["runtime_seconds"] = n_values / values_per_second
+    return estimates
+
+
+def record_run(n_values:int, runtime:float, catalog_path:str = CATALOG_PATH, max_runs:int = 20):
+    """
+    Record the size and runtime of a finished run, to estimate the runtime of later tasks.
+    """
+    catalog = load_catalog(catalog_path)
+    catalog["runs"] = (catalog["runs"] + [{"number_of_values": int(n_values), "runtime": float(runtime)}])[-max_runs:]
+    save_catalog(catalog, catalog_path)
@@ -0,0 +1,163 @@
+import json
+import zlib
+import numpy as np
+from typing import Tuple
+
+# Codecs for the intermediate frames, optionally with a level, e.g. "zstd:3"
+CODECS = ["none", "gzip", "lz4", "zstd", "blosc"]
+DEFAULT_CODEC = "none"
+DEFAULT_LEVELS = {"none": 0, "gzip": 6, "lz4": 0, "zstd": 3, "blosc": 5}
+
+# Encoded frames keep the .npy name, so that they are listed like plain frames, and start with this magic instead
+FRAME_MAGIC = b"\x93FRAME\x01"
+
+# Encoded frames are stored as independently encoded bands of this many rows, so that a band of rows can be read
+# without decoding the whole frame (see load_frame_rows)
+FRAME_BAND_ROWS = 256
+
+
+def get_codec_module(name:str):
+    """
+    Import the (optional) package of a codec; gzip and none only need the standard library.
+    """
+    try:
+        if name == "lz4":
+            import lz4.frame
+            return lz4.frame
+        if name == "zstd":
+            import zstandard
+            return zstandard
+        if name == "blosc":
+            import blosc
+            return blosc
+    except ImportError:
+        package = {"lz4": "lz4", "zstd": "zstandard", "blosc": "blosc"}[name]
+        raise ValueError(f"Codec {name} requires the {package} package; install it or choose another codec")
+    return None
+
+
+def parse_codec(codec:str) -> Tuple[str, int]:
+    """
+    Parse a codec setting such as "none", "lz4", "zstd:3" or "blosc:5" into its name and level,
+    checking that the codec is available.
+    """
+    name, _, level = str(codec or DEFAULT_CODEC).lower().partition(":")
+    if name not in CODECS:
+        raise ValueError(f"Codec {name} is not supported; choose from {CODECS}")
+    try:
+        level = int(level) if level != "" else DEFAULT_LEVELS[name]
+    except ValueError:
+        raise ValueError(f"The level of codec {codec} should be an integer")
+
+    get_codec_module(name)
+    return name, level
+
+
+def check_codec(codec:str) -> str:
+    name, level = parse_codec(codec)
+    return name if name == "none" else f"{name}:{level}"
+
+
+def get_eopatch_compress_level(codec:str) -> int:
+    """
+    EOPatches can only be saved with gzip; with any other codec they are saved uncompressed,
+    which keeps their features memory-mappable (see src.eopatch_windows).
+    """
+    name, level = parse_codec(codec)
+    return level if name == "gzip" else 0
+
+
+def encode(data:np.ndarray, codec:str) -> bytes:
+    name, level = parse_codec(codec)
+    raw = np.ascontiguousarray(data).tobytes()
+    if name == "gzip":
+        return zlib.compress(raw, level)
+    if name == "lz4":
+        return get_codec_module(name).compress(raw, compression_level=level)
+    if name == "zstd":
+        return get_codec_module(name).ZstdCompressor(level=level).compress(raw)
+    if name == "blosc":
+        # Byte shuffling groups the high and low bytes of the (int16) values, which compress very differently
+        blosc = get_codec_module(name)
+        return blosc.compress(raw, typesize=data.dtype.itemsize, clevel=level, shuffle=blosc.SHUFFLE, cname="lz4")
+    return raw
+
+
+def decode(payload:bytes, name:str) -> bytes:
+    if name == "gzip":
+        return zlib.decompress(payload)
+    if name == "lz4":
+        return get_codec_module(name).decompress(payload)
+    if name == "zstd":
+        return get_codec_module(name).ZstdDecompressor().decompress(payload)
+    if name == "blosc":
+        return get_codec_module(name).decompress(payload)
+    return payload
+
+
+def save_frame_file(path:str, frame:np.ndarray, codec:str = DEFAULT_CODEC):
+    """
+    Save a frame as a plain npy file, or encoded with the given codec as bands of FRAME_BAND_ROWS rows.
+    """
+    name, _ = parse_codec(codec)
+    if name == "none":
+        np.save(path, frame)
+        return
+
+    payloads = [encode(frame[row:row + FRAME_BAND_ROWS], codec) for row in range(0, max(frame.shape[0], 1), FRAME_BAND_ROWS)]
+    header = json.dumps({"codec": name, "dtype": frame.dtype.str, "shape": list(frame.shape),
+                         "band_rows": FRAME_BAND_ROWS, "band_sizes": [len(p) for p in payloads]}).encode()
+    with open(path, "wb") as f:
+        f.write(FRAME_MAGIC)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        for payload in payloads:
+            f.write(payload)
+
+
+def is_encoded_frame(path:str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(FRAME_MAGIC)) == FRAME_MAGIC
+
+
+def load_frame_file(path:str) -> np.ndarray:
+    """
+    Load a frame saved by save_frame_file, whatever its codec.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+            f.seek(0)
+            return np.load(f)
+    return load_frame_rows(path)
+
+
+def load_frame_rows(path:str, row_start:int = 0, row_stop:int = None) -> np.ndarray:
+    """
+    Load the rows [row_start, row_stop) of a frame saved by save_frame_file. Plain frames are memory-mapped and encoded
+    frames only decode the bands of rows that overlap them, so that reading a frame band by band decodes it once.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+            return np.array(np.load(path, mmap_mode="r")[row_start:row_stop])
+
+        header = json.loads(f.read(int.from_bytes(f.read(4), "little")))
+        dtype, shape = np.dtype(header["dtype"]), tuple(header["shape"])
+        row_stop = shape[0] if row_stop is None else min(row_stop, shape[0])
+        if row_stop <= row_start:
+            return np.empty((0,) + shape[1:], dtype=dtype)
+
+        # Frames encoded as a single block have no bands
+        band_rows = header.get("band_rows", max(shape[0], 1))
+        band_sizes = header.get("band_sizes", [None])
+        offsets = np.cumsum([f.tell()] + [size or 0 for size in band_sizes])
+
+        first, last = row_start // band_rows, -(-row_stop // band_rows)
+        bands = []
+        for band in range(first, last):
+            f.seek(offsets[band])
+            data = decode(f.read(band_sizes[band] if band_sizes[band] is not None else -1), header["codec"])
+            bands.append(np.frombuffer(data, dtype=dtype).reshape((-1,) + shape[1:]))
+
+    rows = np.concatenate(bands) if len(bands) > 1 else bands[0]
+    return rows[row_start - first * band_rows:row_stop - first * band_rows].copy()
+
@@ -0,0 +1,97 @@
+import os
+import glob
+import numbers
+import warnings
+import datetime as dt
+import numpy as np
+from typing import Dict, List
+
+from src.codec import DEFAULT_CODEC, save_frame_file, load_frame_file
+
+# Rules to composite the frames of a period
+COMPOSITE_RULES = ["max", "median", "last"]
+DEFAULT_COMPOSITE_RULE = "max"
+
+# Periods are counted from a fixed date, so that runs and tiles share the same periods
+COMPOSITE_ANCHOR = dt.datetime(2000, 1, 1)
+
+
+def check_composite(period_days:int, rule:str = DEFAULT_COMPOSITE_RULE):
+    if isinstance(period_days, bool) or not isinstance(period_days, numbers.Integral) or period_days < 1:
+        raise ValueError(f"The compositing period should be a whole number of at least 1 day, got {period_days!r}")
+    if rule not in COMPOSITE_RULES:
+        raise ValueError(f"Composite rule {rule} is not supported; choose from {COMPOSITE_RULES}")
+
+
+def get_period_start(date:dt.datetime, period_days:int, anchor:dt.datetime = COMPOSITE_ANCHOR) -> dt.datetime:
+    """
+    Get the first day of the period of period_days days that a date falls in.
+    """
+    offset = (date - anchor).days // period_days * period_days
+    return anchor + dt.timedelta(days=offset)
+
+
+def group_dates_by_period(dates:List[dt.datetime], period_days:int, anchor:dt.datetime = COMPOSITE_ANCHOR) -> Dict[dt.datetime, List[int]]:
+    """
+    Group the (indices of the) dates by the start of their period, in chronological order.
+    """
+    periods = {}
+    for i in np.argsort(dates):
+        periods.setdefault(get_period_start(dates[i], period_days, anchor), []).append(int(i))
+    return dict(sorted(periods.items()))
+
+
+def composite_frames(arr:np.ndarray, rule:str = DEFAULT_COMPOSITE_RULE) -> np.ndarray:
+    """
+    Composite a chronological (t, h, w) stack of frames into a single frame in one vectorized pass.
+    Values are valid if they are >= 0; 'max' takes the highest valid value, 'median' the median of the valid values
+    and 'last' the last valid value of every pixel. Pixels without any valid value keep their highest (invalid) value.
+    """
+    if rule == "max" or arr.shape[0] == 1:
+        # Invalid values are negative, so the maximum prefers valid values
+        return arr.max(axis=0)
+
+    valid = arr >= 0
+    any_valid = valid.any(axis=0)
+    fallback = arr.max(axis=0)
+
+    if rule == "last":
+        last = arr.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+        return np.where(any_valid, np.take_along_axis(arr, last[np.newaxis], axis=0)[0], fallback)
+
+    if rule == "median":
+        # nanmedian warns about pixels without any valid value, which get the fallback value
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(np.where(valid, arr, np.nan).astype(np.float32), axis=0)
+        if np.issubdtype(arr.dtype, np.integer):
+            median = np.round(median)
+        return np.where(any_valid, median, fallback).astype(arr.dtype)
+
+    raise ValueError(f"Composite rule {rule} is not supported; choose from {COMPOSITE_RULES}")
+
+
+def composite_npys(npy_dir:str, period_days:int, rule:str = DEFAULT_COMPOSITE_RULE, anchor:dt.datetime = COMPOSITE_ANCHOR,
+                   codec:str = DEFAULT_CODEC) -> int:
+    """
+    Replace the YYYY_MM_DD.npy frames in a folder by one composite frame per period of period_days days,
+    named after the first day of the period, encoded with the given codec. Only the frames of one period are loaded at a time.
+    Returns the number of periods.
+    """
+    check_composite(period_days, rule)
+
+    npy_paths = glob.glob(os.path.join(npy_dir, "*.npy"))
+    dates = [dt.datetime.strptime(os.path.basename(path).replace(".npy", ""), "%Y_%m_%d") for path in npy_paths]
+    periods = group_dates_by_period(dates, period_days, anchor)
+
+    print(f"Compositing {len(dates)} frames into {len(periods)} periods of {period_days} days ({rule})")
+    for i, (period_start, indices) in enumerate(periods.items()):
+        print(f"Compositing period {i+1}/{len(periods)}", end="\r")
+        arr = np.stack([load_frame_file(npy_paths[j]) for j in indices], axis=0)
+        frame = composite_frames(arr, rule)
+
+        for j in indices:
+            os.remove(npy_paths[j])
+        save_frame_file(os.path.join(npy_dir, period_start.strftime("%Y_%m_%d") + ".npy"), frame, codec)
+
+    return len(periods)
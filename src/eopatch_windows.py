@@ -0,0 +1,86 @@
+import os
+import gzip
+import tempfile
+import numpy as np
+from typing import List, Tuple
+from stelar_spatiotemporal.eolearn.core import EOPatch
+
+# Compressed features are decoded in chunks of this many bytes
+DECODE_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_feature_path(eop_path:str, band:str = 'LAI') -> str:
+    return os.path.join(eop_path, "data", band + ".npy")
+
+
+def decode_feature(gz_path:str, tmpdir:str = None) -> np.ndarray:
+    """
+    Decode a feature that was saved compressed (<band>.npy.gz) once, streaming it into a temporary .npy file that is
+    memory-mapped, so that it can be read in bands of rows like an uncompressed feature without holding all of it in memory.
+    The temporary file is unlinked right away; its disk space is freed once the array is no longer referenced.
+    """
+    with gzip.open(gz_path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+
+        fd, path = tempfile.mkstemp(suffix=".npy", dir=tmpdir)
+        os.close(fd)
+        try:
+            arr = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape, fortran_order=fortran_order)
+        finally:
+            os.remove(path)
+
+        view = memoryview(arr.reshape(-1, order="A")).cast("B")
+        n_read = 0
+        while n_read < len(view):
+            n = f.readinto(view[n_read:n_read + DECODE_CHUNK_BYTES])
+            if not n:
+                raise ValueError(f"Could not decode {gz_path}, the file is truncated")
+            n_read += n
+    return arr
+
+
+def open_eopatch_cube(eop_paths:List[str], band:str = 'LAI', tmpdir:str = None):
+    """
+    Open the given band of the (time partitions of an) eopatch without loading it, as a chronological list of
+    memory-mapped (t, h, w, 1) arrays. Features that were saved compressed are decoded once into temporary memory-mapped
+    files in tmpdir (see decode_feature). Open the cube once and pass the arrays on, rather than opening it per band of rows.
+    Returns the dates, the arrays and the bbox of the eopatch.
+    """
+    eops = [EOPatch.load(eop_path, lazy_loading=True) for eop_path in eop_paths]
+    order = np.argsort([min(eop.timestamp) for eop in eops])
+
+    dates, arrays = [], []
+    for i in order:
+        feature_path = get_feature_path(eop_paths[i], band)
+        if os.path.exists(feature_path):
+            arrays.append(np.load(feature_path, mmap_mode="r"))
+        elif os.path.exists(feature_path + ".gz"):
+            arrays.append(decode_feature(feature_path + ".gz", tmpdir))
+        else:
+            print(f"Warning: {feature_path} not found, loading the whole feature instead")
+            arrays.append(eops[i].data[band])
+        dates.extend(eops[i].timestamp)
+
+    shapes = set(arr.shape[1:3] for arr in arrays)
+    if len(shapes) > 1:
+        raise ValueError(f"The partitions of the eopatch have different shapes: {shapes}")
+    return dates, arrays, eops[order[0]].bbox
+
+
+def get_row_windows(shape:Tuple[int, int, int], itemsize:int, max_ram:int) -> List[Tuple[int, int]]:
+    """
+    Split a (t, h, w) cube into bands of full rows, each with the full time axis, that fit into max_ram bytes.
+    Full rows keep the reads of every date contiguous.
+    """
+    t, h, w = shape
+    rows = int(max(1, min(h, max_ram // max(1, t * w * itemsize))))
+    return [(r, min(r + rows, h)) for r in range(0, h, rows)]
+
+
+def read_rows(arrays:list, row_start:int, row_stop:int) -> np.ndarray:
+    """
+    Read a band of rows with the full time axis from the memory-mapped partitions, as a (t, rows, w) array.
+    """
+    return np.concatenate([np.asarray(arr[:, row_start:row_stop, :, 0]) for arr in arrays], axis=0)
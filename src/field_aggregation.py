@@ -0,0 +1,221 @@
+import re
+import numpy as np
+from typing import Dict, List
+
+# Statistics that can be requested per field and per date
+BASE_STATS = ["median", "mean", "std", "min", "max", "count", "valid_fraction", "cloud_fraction"]
+DEFAULT_FIELD_STATS = ["median"]
+
+# Statistics that describe pixel values (as opposed to pixel counts)
+VALUE_STATS = ["median", "mean", "std", "min", "max"]
+
+PERCENTILE_PATTERN = re.compile(r"^p(\d{1,2}(\.\d+)?|100)$")
+
+
+def parse_percentile(stat:str):
+    """
+    Return the percentile of a statistic name like 'p10' or 'p97.5', or None if it is not a percentile.
+    """
+    match = PERCENTILE_PATTERN.match(stat)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def check_field_stats(stats:List[str]) -> List[str]:
+    """
+    Validate a list of statistic names and remove duplicates while keeping the order.
+    """
+    if isinstance(stats, str):
+        stats = [stats]
+    if stats is None or len(stats) == 0:
+        raise ValueError("At least one field statistic should be given")
+
+    checked = []
+    for stat in stats:
+        if stat not in BASE_STATS and parse_percentile(stat) is None:
+            raise ValueError(f"Field statistic {stat} is not supported; choose from {BASE_STATS} or percentiles like 'p10'")
+        if stat not in checked:
+            checked.append(stat)
+    return checked
+
+
+def is_value_stat(stat:str) -> bool:
+    return stat in VALUE_STATS or parse_percentile(stat) is not None
+
+
+def field_stat_column(field_id, stat:str, stats:List[str]) -> str:
+    """
+    Name of the output column of a field statistic.
+    The default (median only) output keeps the plain field id as column name.
+    """
+    if list(stats) == DEFAULT_FIELD_STATS:
+        return field_id
+    return f"{field_id}_{stat}"
+
+
+def compress_histogram(date_idx:np.ndarray, values:np.ndarray, counts:np.ndarray = None):
+    """
+    Sum the counts (one per entry by default) of duplicate (date index, value) histogram entries, sorted by date index and value.
+    Integer values, like the int16 LAI values, are counted with a bincount over a combined (date, value) key: on a dense
+    grid of all keys if it is not much larger than the number of entries, and over the unique keys otherwise.
+    Other values are sorted. The values keep their dtype; the counts are int64.
+    """
+    if len(values) == 0 or not np.issubdtype(values.dtype, np.integer):
+        counts = np.ones(len(values), dtype=np.int64) if counts is None else counts
+        order = np.lexsort((values, date_idx))
+        date_idx, values, counts = date_idx[order], values[order], counts[order]
+
+        new = np.ones(len(values), dtype=bool)
+        new[1:] = (date_idx[1:] != date_idx[:-1]) | (values[1:] != values[:-1])
+        starts = np.flatnonzero(new)
+        return date_idx[starts], values[starts], np.add.reduceat(counts, starts) if len(starts) > 0 else counts[:0]
+
+    vmin = int(values.min())
+    width = int(values.max()) - vmin + 1
+    keys = date_idx.astype(np.int64) * width + (values.astype(np.int64) - vmin)
+
+    if (int(date_idx.max()) + 1) * width <= 4 * len(keys) + 4096:
+        hist = np.bincount(keys, weights=counts)
+        keys = np.flatnonzero(hist)
+        hist = hist[keys]
+    else:
+        keys, inverse = np.unique(keys, return_inverse=True)
+        hist = np.bincount(inverse, weights=counts)
+    return keys // width, (keys % width + vmin).astype(values.dtype), hist.astype(np.int64)
+
+
+def field_partials(arr:np.ndarray, dates:list) -> Dict[str, np.ndarray]:
+    """
+    Compute mergeable partial aggregates of the pixels of (a part of) a field, per date.
+    arr is a (n_times, n_pixels) array with the values of the pixels inside the field. Values <= 0 are considered invalid
+    (nodata or cloud), in line with the nodata value used when exporting eopatches to tiff.
+    The partials hold the number of pixels, the count, sum, sum of squares, min and max of the valid values, and a sparse
+    histogram of the valid values per date. LAI values are bounded integers, so the histograms are small, and the quantiles
+    computed from them are exact. Partials of the same field from other tiles, windows or partitions can be combined
+    with merge_field_partials and turned into statistics with finalize_field_partials.
+    """
+    n_times, n_pixels = arr.shape
+    valid = arr > 0
+
+    # The other aggregates follow from the histogram, so the values are never copied to a wider dtype
+    date_idx, px_idx = np.nonzero(valid)
+    hist_dates, hist_values, hist_counts = compress_histogram(date_idx, arr[date_idx, px_idx])
+    weighted = hist_values.astype(np.float64) * hist_counts
+
+    # Every date is a contiguous range of the histogram, sorted by value
+    counts = valid.sum(axis=1).astype(np.int64)
+    bounds = np.searchsorted(hist_dates, np.arange(n_times + 1))
+    has_values = counts > 0
+    mins, maxs = np.full(n_times, np.inf), np.full(n_times, -np.inf)
+    mins[has_values] = hist_values[bounds[:-1][has_values]]
+    maxs[has_values] = hist_values[bounds[1:][has_values] - 1]
+
+    return {
+        "dates": np.array(dates, dtype="datetime64[D]"),
+        "n_pixels": np.full(n_times, n_pixels, dtype=np.int64),
+        "counts": counts,
+        "sums": np.bincount(hist_dates, weights=weighted, minlength=n_times),
+        "sumsq": np.bincount(hist_dates, weights=weighted * hist_values, minlength=n_times),
+        "mins": mins,
+        "maxs": maxs,
+        "hist_dates": hist_dates,
+        "hist_values": hist_values,
+        "hist_counts": hist_counts,
+    }
+
+
+def merge_field_partials(partials:List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """
+    Merge the partial aggregates of the parts of a field (e.g. from different tiles, windows or partitions).
+    Dates that occur in several parts are combined; the other dates are concatenated.
+    """
+    if len(partials) == 1:
+        return partials[0]
+
+    dates = np.unique(np.concatenate([p["dates"] for p in partials]))
+    n_times = len(dates)
+
+    merged = {
+        "dates": dates,
+        "n_pixels": np.zeros(n_times, dtype=np.int64),
+        "counts": np.zeros(n_times, dtype=np.int64),
+        "sums": np.zeros(n_times),
+        "sumsq": np.zeros(n_times),
+        "mins": np.full(n_times, np.inf),
+        "maxs": np.full(n_times, -np.inf),
+    }
+    hist_dates, hist_values, hist_counts = [], [], []
+    for p in partials:
+        idx = np.searchsorted(dates, p["dates"])
+        for key in ["n_pixels", "counts", "sums", "sumsq"]:
+            np.add.at(merged[key], idx, p[key])
+        np.minimum.at(merged["mins"], idx, p["mins"])
+        np.maximum.at(merged["maxs"], idx, p["maxs"])
+        # Empty histograms (e.g. of parts without pixels) are left out, so that they do not change the dtype of the values
+        if len(p["hist_values"]) > 0:
+            hist_dates.append(idx[p["hist_dates"]])
+            hist_values.append(p["hist_values"])
+            hist_counts.append(p["hist_counts"])
+    if len(hist_values) == 0:
+        hist_dates, hist_values, hist_counts = [partials[0]["hist_dates"]], [partials[0]["hist_values"]], [partials[0]["hist_counts"]]
+
+    hist = compress_histogram(np.concatenate(hist_dates), np.concatenate(hist_values), np.concatenate(hist_counts))
+    merged["hist_dates"], merged["hist_values"], merged["hist_counts"] = hist
+    return merged
+
+
+def histogram_quantiles(values:np.ndarray, counts:np.ndarray, qs:np.ndarray) -> np.ndarray:
+    """
+    Compute the quantiles (in [0, 100]) of the values described by a sorted histogram,
+    with the same linear interpolation as np.percentile.
+    """
+    cum = np.cumsum(counts)
+    k = cum[-1]
+    pos = qs / 100 * (k - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, k - 1)
+
+    # The i-th order statistic is the first value whose cumulative count exceeds i
+    vlo = values[np.searchsorted(cum, lo, side="right")]
+    vhi = values[np.searchsorted(cum, hi, side="right")]
+    return vlo + (vhi - vlo) * (pos - lo)
+
+
+def finalize_field_partials(partial:Dict[str, np.ndarray], stats:List[str] = DEFAULT_FIELD_STATS) -> Dict[str, np.ndarray]:
+    """
+    Compute the requested statistics per date from the (merged) partial aggregates of a field.
+    Returns a dict mapping each statistic to an array of shape (n_times,).
+    """
+    stats = check_field_stats(stats)
+    counts = partial["counts"]
+    n_times = len(counts)
+    has_values = counts > 0
+
+    result = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(has_values, partial["sums"] / counts, np.nan)
+        var = np.where(has_values, partial["sumsq"] / counts - mean**2, np.nan)
+        valid_fraction = np.where(partial["n_pixels"] > 0, counts / partial["n_pixels"], np.nan)
+    result["mean"] = mean
+    result["std"] = np.sqrt(np.maximum(var, 0))
+    result["min"] = np.where(has_values, partial["mins"], np.nan)
+    result["max"] = np.where(has_values, partial["maxs"], np.nan)
+    result["count"] = counts
+    result["valid_fraction"] = valid_fraction
+    result["cloud_fraction"] = 1 - valid_fraction
+
+    qstats = [s for s in stats if s == "median" or parse_percentile(s) is not None]
+    if len(qstats) > 0:
+        qs = np.array([50.0 if s == "median" else parse_percentile(s) for s in qstats])
+        quantiles = np.full((len(qs), n_times), np.nan)
+
+        # The histogram is sorted by date, so every date is a contiguous range
+        bounds = np.searchsorted(partial["hist_dates"], np.arange(n_times + 1))
+        for t in np.flatnonzero(has_values):
+            start, stop = bounds[t], bounds[t + 1]
+            quantiles[:, t] = histogram_quantiles(partial["hist_values"][start:stop], partial["hist_counts"][start:stop], qs)
+        for s, q in zip(qstats, quantiles):
+            result[s] = q
+
+    return {s: result[s] for s in stats}
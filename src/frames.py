@@ -0,0 +1,90 @@
+import os
+import glob
+import numpy as np
+
+from src.codec import DEFAULT_CODEC, save_frame_file, load_frame_file
+
+# Rules to merge frames that share a date
+MERGE_RULES = ["max", "first", "mean"]
+DEFAULT_MERGE_RULE = "max"
+
+# Running sums and counts of the 'mean' rule are kept next to the frames until the merging is done
+MERGE_STATE_EXTENSION = ".merge"
+
+
+def check_merge_rule(rule:str) -> str:
+    if rule not in MERGE_RULES:
+        raise ValueError(f"Merge rule {rule} is not supported; choose from {MERGE_RULES}")
+    return rule
+
+
+def merge_frames(old:np.ndarray, new:np.ndarray, rule:str = DEFAULT_MERGE_RULE) -> np.ndarray:
+    """
+    Merge two frames of the same date in a single vectorized pass; values are valid if they are >= 0.
+    'max' keeps the highest valid value, 'first' keeps the value of the old frame wherever it is valid.
+    Pixels that are invalid in one frame always get the value of the other one.
+    """
+    if old.shape != new.shape:
+        raise ValueError(f"Cannot merge frames of shape {old.shape} and {new.shape}")
+
+    if rule == "max":
+        # Invalid values are negative, so the maximum prefers valid values
+        return np.maximum(old, new)
+    if rule == "first":
+        return np.where(old >= 0, old, new)
+    raise ValueError(f"Frames cannot be merged pairwise with rule {rule}")
+
+
+def get_state_path(frame_path:str) -> str:
+    return frame_path[:-len(".npy")] + MERGE_STATE_EXTENSION
+
+
+def save_frame(outdir:str, name:str, frame:np.ndarray, rule:str = DEFAULT_MERGE_RULE, codec:str = DEFAULT_CODEC):
+    """
+    Save a frame as <name>.npy, merging it with the frame that is already saved under that name (if any).
+    Only the saved frame is loaded, so at most one merged frame is held in memory besides the new one.
+    For the 'mean' rule, the running sums and counts of the valid values are kept in a .merge file
+    next to the frame until clear_merge_state is called. Frames are encoded with the given codec (see src.codec).
+    """
+    path = os.path.join(outdir, name + ".npy")
+    if not os.path.exists(path):
+        save_frame_file(path, frame, codec)
+        return
+
+    old = load_frame_file(path)
+    print(f"Merging the frames of {name} ({rule})")
+    if rule != "mean":
+        save_frame_file(path, merge_frames(old, frame, rule), codec)
+        return
+
+    state_path = get_state_path(path)
+    if os.path.exists(state_path):
+        with open(state_path, "rb") as f:
+            state = np.load(f)
+            sums, counts = state["sums"], state["counts"]
+    else:
+        valid = old >= 0
+        sums = np.where(valid, old, 0).astype(np.float64)
+        counts = valid.astype(np.uint16)
+
+    valid = frame >= 0
+    sums += np.where(valid, frame, 0)
+    counts += valid
+
+    with open(state_path, "wb") as f:
+        np.savez(f, sums=sums, counts=counts)
+
+    # Pixels without any valid value keep the (invalid) value of the old frame
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(counts > 0, sums / np.maximum(counts, 1), old)
+    if np.issubdtype(old.dtype, np.integer):
+        mean = np.round(mean)
+    save_frame_file(path, mean.astype(old.dtype), codec)
+
+
+def clear_merge_state(outdir:str):
+    """
+    Remove the running sums and counts of merged frames, once all frames are saved.
+    """
+    for path in glob.glob(os.path.join(outdir, "*" + MERGE_STATE_EXTENSION)):
+        os.remove(path)
@@ -0,0 +1,207 @@
+import os
+import math
+import zlib
+import numpy as np
+import pandas as pd
+import tqdm
+from typing import List, Tuple
+from sentinelhub import BBox
+from shapely.geometry import box
+from concurrent.futures import ThreadPoolExecutor
+from stelar_spatiotemporal.lib import get_filesystem
+
+from src.eopatch_windows import open_eopatch_cube, read_rows
+from src.grid_aggregation import DEFAULT_GRID_LEVELS, check_grid_levels, grid_pyramid
+from src.field_aggregation import DEFAULT_FIELD_STATS, check_field_stats
+from src.reader import px_index_entry, write_index
+from src.px_selection import check_px_format
+from src.timeseries import extract_px_array, rasterize_roi, load_fields, get_px_extension, cube_field_partials, \
+    assign_fields_to_windows, collect_field_partials, partials_to_df, write_field_df, write_grid_pyramid
+
+# Width (and maximum height) of the pixel output files, as the patchlets of lai_to_csv_px
+PATCH_SIZE = 1128
+
+
+def get_fused_windows(shape:Tuple[int, int, int], itemsize:int, max_ram:int, levels:List[int] = None) -> List[Tuple[int, int]]:
+    """
+    Split a (t, h, w) cube into bands of full rows with the full time axis that fit into max_ram bytes.
+    Bands are at most PATCH_SIZE rows high, and a multiple of all grid levels so that no grid cell spans two bands.
+    """
+    t, h, w = shape
+    step = 1
+    for level in levels or []:
+        step = step * level // math.gcd(step, level)
+
+    rows = min(PATCH_SIZE, h, max_ram // max(1, t * w * itemsize))
+    rows = max(step, rows // step * step)
+    return [(r, min(r + rows, h)) for r in range(0, h, rows)]
+
+
+def get_rows_bbox(bbox:BBox, shape:Tuple[int, int], row_start:int, row_stop:int, col_start:int = 0, col_stop:int = None) -> BBox:
+    h, w = shape
+    col_stop = w if col_stop is None else col_stop
+    xmin, ymin, xmax, ymax = list(bbox)
+    res_x, res_y = (xmax - xmin) / w, (ymax - ymin) / h
+    return BBox((xmin + col_start * res_x, ymax - row_stop * res_y, xmin + col_stop * res_x, ymax - row_start * res_y), crs=bbox.crs)
+
+
+def px_sink(cube:np.ndarray, row_start:int, dates:list, bbox:BBox, shape:Tuple[int, int], outdir:str, roi = None,
+            min_valid_ratio:float = None, sample_n:int = None, seed:int = 0, px_format:str = "csv") -> list:
+    """
+    Write the pixel timeseries of a band of rows, split into patches of PATCH_SIZE columns.
+    Returns the index entries of the written files.
+    """
+    extension = get_px_extension(px_format)
+    row_stop = row_start + cube.shape[1]
+
+    entries = []
+    for col_start in range(0, shape[1], PATCH_SIZE):
+        patch = cube[:, :, col_start:col_start + PATCH_SIZE]
+        patch_bbox = get_rows_bbox(bbox, shape, row_start, row_stop, col_start, col_start + patch.shape[2])
+        name = f"patchlet_{row_start}_{col_start}"
+
+        mask = rasterize_roi(roi, patch_bbox, patch.shape[1:]) if roi is not None else None
+        outpath = os.path.join(outdir, name + extension)
+        extract_px_array(patch, dates, outpath=outpath, mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n,
+                         seed=[seed, zlib.crc32(name.encode())], px_format=px_format)
+
+        if get_filesystem(outpath).exists(outpath):
+            entries.append(px_index_entry(outpath, patch_bbox, patch.shape[1:], dates))
+    return entries
+
+
+def grid_sink(cube:np.ndarray, row_start:int, levels:List[int], grids:dict):
+    """
+    Block-reduce a band of rows to every grid level and store the cell means in the (memory-mapped) grids.
+    """
+    for level, grid in grid_pyramid(cube, levels).items():
+        start = row_start // level
+        grids[level][:, start:start + grid.shape[1]] = grid
+
+
+def field_sink(cube:np.ndarray, row_start:int, window_fields:list, dates:list, bbox:BBox, shape:Tuple[int, int]) -> dict:
+    return cube_field_partials(cube, row_start, window_fields, dates, bbox, shape)
+
+
+def fused_extraction(eop_paths:list, tmpdir:str, px_out:str = None, px_selection:dict = None,
+                     fields = None, field_out_path:str = None, field_stats:list = DEFAULT_FIELD_STATS,
+                     grid_out_path:str = None, grid_levels:list = DEFAULT_GRID_LEVELS,
+                     max_ram:int = int(4e9), band:str = 'LAI', partial_ids:list = None) -> dict:
+    """
+    Create the pixel, field and grid timeseries of an eopatch in a single pass over its data.
+    The eopatch is opened once; every band of rows (with the full time axis) is read once from the memory-mapped
+    partitions (compressed ones are decoded into tmpdir, see open_eopatch_cube), while the next band is
+    read ahead, and fanned out to all requested sinks, which run concurrently:
+    - pixels: written per patch of PATCH_SIZE columns (with an index, see src.reader), with the options of px_selection;
+    - fields: partial aggregates per band, merged and written once the last band of a field is done;
+    - grids: cell means of every level, stored in memory-mapped arrays and written per chunk of dates at the end.
+    The fields in partial_ids are not written; their partial aggregates are returned instead.
+    """
+    os.makedirs(tmpdir, exist_ok=True)
+    dates, arrays, bbox = open_eopatch_cube(eop_paths, band, tmpdir=tmpdir)
+    return fused_cube_extraction(dates, arrays, bbox, tmpdir, px_out=px_out, px_selection=px_selection,
+                                 fields=fields, field_out_path=field_out_path, field_stats=field_stats,
+                                 grid_out_path=grid_out_path, grid_levels=grid_levels,
+                                 max_ram=max_ram, band=band, partial_ids=partial_ids)
+
+
+def fused_cube_extraction(dates:list, arrays:List[np.ndarray], bbox:BBox, tmpdir:str = None, px_out:str = None, px_selection:dict = None,
+                          fields = None, field_out_path:str = None, field_stats:list = DEFAULT_FIELD_STATS,
+                          grid_out_path:str = None, grid_levels:list = DEFAULT_GRID_LEVELS,
+                          max_ram:int = int(4e9), band:str = 'LAI', partial_ids:list = None) -> dict:
+    """
+    Create the pixel, field and grid timeseries of a chronological list of (t, h, w, 1) arrays (see fused_extraction).
+    The arrays can be memory-mapped or in memory; without a tmpdir, the grids are kept in memory as well.
+    """
+    px_selection = dict(px_selection or {})
+    px_format = px_selection.pop("px_format", "csv")
+    check_px_format(px_format)
+    field_stats = check_field_stats(field_stats)
+    grid_levels = check_grid_levels(grid_levels) if grid_out_path is not None else []
+
+    n_times, shape = len(dates), arrays[0].shape[1:3]
+    itemsize = arrays[0].dtype.itemsize
+
+    # Two bands are in memory at once: the one being processed and the one being read ahead
+    windows = get_fused_windows((n_times, *shape), itemsize, max_ram // 2, grid_levels)
+    print(f"Extracting all timeseries in a single pass over {len(windows)} bands of rows")
+
+    # Prepare the sinks
+    roi = None
+    if px_out is not None:
+        os.makedirs(px_out, exist_ok=True)
+        roi_path = px_selection.pop("roi_path", None)
+        if roi_path is not None:
+            roi = load_fields(roi_path)
+    px_entries = []
+
+    grids = {}
+    if grid_out_path is not None:
+        for level in grid_levels:
+            grid_shape = (n_times, math.ceil(shape[0] / level), math.ceil(shape[1] / level))
+            if tmpdir is None:
+                grids[level] = np.empty(grid_shape, dtype=np.float32)
+                continue
+            os.makedirs(tmpdir, exist_ok=True)
+            grids[level] = np.lib.format.open_memmap(os.path.join(tmpdir, f"grid_{level}.npy"), mode="w+",
+                                                     dtype=np.float32, shape=grid_shape)
+
+    window_fields = [[] for _ in windows]
+    pending, remaining, out_partials, field_dfs = {}, {}, {}, []
+    if fields is not None:
+        if fields.crs != bbox.crs:
+            fields = fields.to_crs(bbox.crs.ogc_string())
+        fields = fields[fields.intersects(box(*bbox))]
+        if len(fields) > 0:
+            items, remaining = assign_fields_to_windows(fields, bbox, shape[0], windows)
+            window_fields = [item[2] for item in items]
+
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=3) as executor:
+        next_cube = reader.submit(read_rows, arrays, *windows[0])
+        for i, (row_start, row_stop) in enumerate(tqdm.tqdm(windows, desc="Extracting timeseries")):
+            cube = next_cube.result()
+            if i + 1 < len(windows):
+                next_cube = reader.submit(read_rows, arrays, *windows[i + 1])
+
+            # Fan the band out to all sinks
+            px_future = field_future = grid_future = None
+            if px_out is not None:
+                px_future = executor.submit(px_sink, cube, row_start, dates, bbox, shape, px_out, roi=roi, px_format=px_format, **px_selection)
+            if len(window_fields[i]) > 0:
+                field_future = executor.submit(field_sink, cube, row_start, window_fields[i], dates, bbox, shape)
+            if len(grids) > 0:
+                grid_future = executor.submit(grid_sink, cube, row_start, grid_levels, grids)
+
+            if px_future is not None:
+                px_entries.extend(px_future.result())
+            if field_future is not None:
+                for field_id, partial in collect_field_partials(window_fields[i], field_future.result(), pending, remaining, dates):
+                    if partial_ids is not None and field_id in partial_ids:
+                        out_partials[field_id] = partial
+                    else:
+                        field_dfs.append(partials_to_df({field_id: partial}, field_stats))
+            if grid_future is not None:
+                grid_future.result()
+            del cube
+
+    del arrays
+
+    # Finish the sinks
+    if px_out is not None:
+        write_index(px_out, px_entries)
+
+    if len(field_dfs) > 0:
+        write_field_df(pd.concat(field_dfs, axis=0), field_out_path, field_stats)
+
+    if len(grids) > 0:
+        os.makedirs(grid_out_path, exist_ok=True)
+        for level, grid in grids.items():
+            # Write the grid per chunk of dates, appending to the csv file
+            step = max(1, int(max_ram // max(1, grid[0].nbytes * 8)))
+            for start in range(0, n_times, step):
+                write_grid_pyramid({level: np.asarray(grid[start:start + step])}, dates[start:start + step], outdir=grid_out_path, band=band)
+            del grid
+            if tmpdir is not None:
+                os.remove(os.path.join(tmpdir, f"grid_{level}.npy"))
+
+    return out_partials
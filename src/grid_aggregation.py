@@ -0,0 +1,71 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+DEFAULT_GRID_LEVELS = [2, 4, 10]
+
+
+def check_grid_levels(levels:List[int]) -> List[int]:
+    """
+    Validate the block sizes of the grid levels and return them sorted and without duplicates.
+    """
+    if isinstance(levels, int):
+        levels = [levels]
+    if levels is None or len(levels) == 0:
+        raise ValueError("At least one grid level should be given")
+
+    checked = sorted(set(int(level) for level in levels))
+    if checked[0] < 1:
+        raise ValueError(f"Grid levels should be positive integers, got {levels}")
+    return checked
+
+
+def block_sum(arr:np.ndarray, factor:int) -> np.ndarray:
+    """
+    Sum (t, h, w) values over non-overlapping factor x factor blocks.
+    The last row and column of blocks are padded with zeros if h or w are not a multiple of the factor.
+    """
+    t, h, w = arr.shape
+    ph, pw = -h % factor, -w % factor
+    if ph > 0 or pw > 0:
+        arr = np.pad(arr, ((0, 0), (0, ph), (0, pw)))
+    return arr.reshape(t, (h + ph) // factor, factor, (w + pw) // factor, factor).sum(axis=(2, 4))
+
+
+def grid_sums(arr:np.ndarray, levels:List[int]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Compute the sum and count of the valid (>= 0) values of a (t, h, w) array for every grid level.
+    Coarser levels are reduced from the sums of a finer level whenever their block size is a multiple of it,
+    so the full resolution array is only reduced once per chain of nested levels.
+    """
+    levels = check_grid_levels(levels)
+
+    valid = arr >= 0
+    acc_dtype = np.float64 if np.issubdtype(arr.dtype, np.floating) else np.int64
+    base_sums = np.where(valid, arr, 0).astype(acc_dtype, copy=False)
+    base_counts = valid.astype(np.int32)
+
+    result = {}
+    for level in levels:
+        # Start from the coarsest already computed level that nests into this one
+        parents = [p for p in result if level % p == 0]
+        if len(parents) > 0:
+            parent = max(parents)
+            sums, counts = result[parent]
+            factor = level // parent
+        else:
+            sums, counts = base_sums, base_counts
+            factor = level
+        result[level] = (block_sum(sums, factor), block_sum(counts, factor))
+    return result
+
+
+def grid_pyramid(arr:np.ndarray, levels:List[int]) -> Dict[int, np.ndarray]:
+    """
+    Block-reduce a (t, h, w) array to the mean of the valid (>= 0) values for every grid level.
+    Cells without any valid value are nan.
+    """
+    result = {}
+    for level, (sums, counts) in grid_sums(arr, levels).items():
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[level] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return result
@@ -0,0 +1,189 @@
+import os
+import glob
+import shutil
+import datetime as dt
+import numpy as np
+import pandas as pd
+from typing import List
+from contextlib import contextmanager
+from shapely.geometry import box
+from stelar_spatiotemporal.lib import load_bbox
+
+from src.codec import load_frame_file, load_frame_rows
+from src.grid_aggregation import DEFAULT_GRID_LEVELS, check_grid_levels, grid_pyramid
+from src.field_aggregation import DEFAULT_FIELD_STATS, check_field_stats
+from src.fused import get_fused_windows, px_sink, field_sink
+from src.reader import write_index
+from src.px_selection import check_px_format
+from src.timeseries import load_fields, assign_fields_to_windows, collect_field_partials, partials_to_df, \
+    write_field_df, write_grid_pyramid
+
+
+def get_dask():
+    """
+    Import the (optional) dask package of the lazy backend.
+    """
+    try:
+        import dask
+        import dask.array
+        return dask
+    except ImportError:
+        raise ValueError("The lazy backend requires the dask package; install it or disable the lazy backend")
+
+
+def get_n_workers(n_workers:int = None) -> int:
+    return max(1, n_workers or os.cpu_count() or 1)
+
+
+def open_frames_cube(npy_dir:str, max_ram:int = int(4e9), n_workers:int = None, levels:List[int] = None):
+    """
+    Open the YYYY_MM_DD.npy frames of a folder (plain or encoded) as a lazily evaluated, chronological (t, h, w) dask array,
+    without reading them. Every frame is chunked into bands of rows, so that a band of rows with the full time axis
+    of every worker fits into max_ram at once; bands are a multiple of all grid levels (see src.fused.get_fused_windows).
+    Every chunk only reads (or decodes) its own rows of a frame, see src.codec.load_frame_rows.
+    Returns the dates, the cube and the bbox of the frames.
+    """
+    dask = get_dask()
+
+    dateformat = "%Y_%m_%d"
+    npy_paths = sorted(glob.glob(os.path.join(npy_dir, "*.npy")))
+    if len(npy_paths) == 0:
+        raise ValueError(f"No frames found in {npy_dir}")
+    dates = [dt.datetime.strptime(os.path.basename(file).replace(".npy",""), dateformat) for file in npy_paths]
+
+    first = load_frame_file(npy_paths[0])
+    h, w = first.shape
+    # Every worker holds a band and the results of its sinks
+    windows = get_fused_windows((len(npy_paths), h, w), first.dtype.itemsize, max_ram // (2 * get_n_workers(n_workers)), levels)
+
+    frames = []
+    for path in npy_paths:
+        chunks = [dask.array.from_delayed(dask.delayed(load_frame_rows)(path, row_start, row_stop),
+                                          shape=(row_stop - row_start, w), dtype=first.dtype)
+                  for row_start, row_stop in windows]
+        frames.append(dask.array.concatenate(chunks, axis=0))
+
+    return dates, dask.array.stack(frames), load_bbox(os.path.join(npy_dir, "bbox.pkl"))
+
+
+@contextmanager
+def lazy_scheduler(n_workers:int, max_ram:int, spill_dir:str):
+    """
+    Get the arguments of dask.compute for a local scheduler with n_workers.
+    With the (optional) distributed package, this is a local cluster of worker processes, each of which spills its data
+    to spill_dir when it exceeds its share of max_ram. Otherwise, it is the threaded scheduler, whose memory is bounded
+    by the size of the chunks only.
+    """
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        yield {"scheduler": "threads", "num_workers": n_workers}
+        return
+
+    os.makedirs(spill_dir, exist_ok=True)
+    with LocalCluster(n_workers=n_workers, threads_per_worker=1, memory_limit=max_ram // n_workers,
+                      local_directory=spill_dir, dashboard_address=None) as cluster, Client(cluster):
+        yield {}
+
+
+def grid_band(cube:np.ndarray, row_start:int, levels:List[int], tmpdir:str) -> dict:
+    """
+    Block-reduce a band of rows to every grid level and save the cell means to tmpdir; returns the paths per level.
+    """
+    paths = {}
+    for level, grid in grid_pyramid(cube, levels).items():
+        paths[level] = os.path.join(tmpdir, f"grid_{level}_{row_start}.npy")
+        np.save(paths[level], grid.astype(np.float32))
+    return paths
+
+
+def lazy_extraction(dates:list, cube, bbox, tmpdir:str, px_out:str = None, px_selection:dict = None,
+                    fields = None, field_out_path:str = None, field_stats:list = DEFAULT_FIELD_STATS,
+                    grid_out_path:str = None, grid_levels:list = DEFAULT_GRID_LEVELS,
+                    max_ram:int = int(4e9), n_workers:int = None, band:str = 'LAI', partial_ids:list = None) -> dict:
+    """
+    Create the pixel, field and grid timeseries of a lazy (t, h, w) cube (see open_frames_cube) as chunk-wise tasks,
+    which a local scheduler (see lazy_scheduler) runs in parallel: every row chunk of the cube is read with the full
+    time axis, fanned out to the pixel, grid and field sinks (see src.fused), and released.
+    The grids of every chunk are kept in tmpdir until they are written, which also holds the data that workers spill.
+    The fields in partial_ids are not written; their partial aggregates are returned instead (see fused_cube_extraction).
+    """
+    dask = get_dask()
+
+    px_selection = dict(px_selection or {})
+    px_format = px_selection.pop("px_format", "csv")
+    check_px_format(px_format)
+    field_stats = check_field_stats(field_stats)
+    grid_levels = check_grid_levels(grid_levels) if grid_out_path is not None else []
+    n_workers = get_n_workers(n_workers)
+
+    n_times, shape = len(dates), cube.shape[1:3]
+    row_stops = np.cumsum(cube.chunks[1]).tolist()
+    windows = list(zip([0] + row_stops[:-1], row_stops))
+    for level in grid_levels:
+        if any(row_start % level != 0 for row_start, _ in windows):
+            raise ValueError(f"The row chunks of the cube should be a multiple of grid level {level}")
+    print(f"Extracting all timeseries from a lazy cube of {len(windows)} row chunks with {n_workers} workers")
+
+    # Prepare the sinks
+    roi = None
+    if px_out is not None:
+        os.makedirs(px_out, exist_ok=True)
+        roi_path = px_selection.pop("roi_path", None)
+        if roi_path is not None:
+            roi = load_fields(roi_path)
+
+    window_fields = [[] for _ in windows]
+    pending, remaining, out_partials, field_dfs = {}, {}, {}, []
+    if fields is not None:
+        if fields.crs != bbox.crs:
+            fields = fields.to_crs(bbox.crs.ogc_string())
+        fields = fields[fields.intersects(box(*bbox))]
+        if len(fields) > 0:
+            items, remaining = assign_fields_to_windows(fields, bbox, shape[0], windows)
+            window_fields = [item[2] for item in items]
+
+    os.makedirs(tmpdir, exist_ok=True)
+
+    # Every chunk of rows is read once and shared by the tasks of its sinks
+    tasks = []
+    for i, (row_start, row_stop) in enumerate(windows):
+        rows = cube[:, row_start:row_stop]
+        tasks.append((
+            dask.delayed(px_sink)(rows, row_start, dates, bbox, shape, px_out, roi=roi, px_format=px_format, **px_selection)
+            if px_out is not None else None,
+            dask.delayed(grid_band)(rows, row_start, grid_levels, tmpdir) if len(grid_levels) > 0 else None,
+            dask.delayed(field_sink)(rows, row_start, window_fields[i], dates, bbox, shape) if len(window_fields[i]) > 0 else None,
+        ))
+
+    with lazy_scheduler(n_workers, max_ram, os.path.join(tmpdir, "spill")) as compute_kwargs:
+        results = dask.compute(tasks, **compute_kwargs)[0]
+
+    # Finish the sinks
+    if px_out is not None:
+        write_index(px_out, [entry for px_entries, _, _ in results for entry in px_entries])
+
+    for i, (_, _, partials) in enumerate(results):
+        if partials is None:
+            continue
+        for field_id, partial in collect_field_partials(window_fields[i], partials, pending, remaining, dates):
+            if partial_ids is not None and field_id in partial_ids:
+                out_partials[field_id] = partial
+            else:
+                field_dfs.append(partials_to_df({field_id: partial}, field_stats))
+    if len(field_dfs) > 0:
+        write_field_df(pd.concat(field_dfs, axis=0), field_out_path, field_stats)
+
+    if len(grid_levels) > 0:
+        os.makedirs(grid_out_path, exist_ok=True)
+        for level in grid_levels:
+            # Write the grid per chunk of dates, appending to the csv file
+            paths = [grid_paths[level] for _, grid_paths, _ in results]
+            row_bytes = sum(np.load(p, mmap_mode="r")[0].nbytes for p in paths)
+            step = max(1, int(max_ram // max(1, row_bytes * 8)))
+            for start in range(0, n_times, step):
+                grid = np.concatenate([np.load(p, mmap_mode="r")[start:start + step] for p in paths], axis=1)
+                write_grid_pyramid({level: grid}, dates[start:start + step], outdir=grid_out_path, band=band)
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    return out_partials
@@ -1,8 +1,17 @@
 import numpy as np
-from sentinelhub import BBox
+import math
+import rasterio
+from rasterio.windows import Window
+from sentinelhub import BBox, CRS
 from stelar_spatiotemporal.eolearn.core import EOPatch, OverwritePermission
+from stelar_spatiotemporal.lib import save_bbox, load_bbox, get_filesystem
+from src.frames import DEFAULT_MERGE_RULE, save_frame
+from src.codec import DEFAULT_CODEC, load_frame_file
 import os
+import re
+import glob
 import datetime as dt
+from typing import Dict, Tuple
 
 def combine_npys_into_eopatches(npy_paths: list, 
                  outpath: str,
@@ -10,10 +19,12 @@ def combine_npys_into_eopatches(npy_paths: list,
                  bbox: BBox,
                  dates:list = None,
                  delete_after:bool = False,
-                 partition_size:int = 10):
+                 partition_size:int = 10,
+                 compress_level:int = 0):
     """
     Combine multiple numpy arrays into one eopatch by stacking them along the time axis.
     If dates are not given, infer the dates from the filenames.
+    The arrays may be encoded frames (see src.codec); the eopatches are saved with the given (gzip) compress_level.
     """
     dateformat = "%Y_%m_%d"
 
@@ -35,7 +46,7 @@ def combine_npys_into_eopatches(npy_paths: list,
         end = min(start+partition_size, len(npy_paths))
 
         # Stack data
-        arrays = [np.load(npy_paths[i]) for i in range(start, end)]
+        arrays = [load_frame_file(npy_paths[i]) for i in range(start, end)]
         part_data = np.stack(arrays, axis=0)
         part_dates = dates[start:end]
         
@@ -48,9 +59,187 @@ def combine_npys_into_eopatches(npy_paths: list,
         # Save eopatch
         print(f"Saving eopatch {i+1}/{len(partitions)}", end="\r")
         part_outpath = outpath if len(partitions) == 1 else os.path.join(outpath, f"partition_{i+1}")
-        eopatch.save(part_outpath, overwrite_permission=OverwritePermission.OVERWRITE_PATCH)
+        eopatch.save(part_outpath, overwrite_permission=OverwritePermission.OVERWRITE_PATCH, compress_level=compress_level)
 
     # (Optional) Delete all the individual files
         if delete_after:
             for file in npy_paths[start:end]:
-                os.remove(file)
\ No newline at end of file
+                os.remove(file)
+
+def stack_npys(npy_dir: str, delete_after: bool = False) -> Tuple[list, np.ndarray, BBox]:
+    """
+    Stack the YYYY_MM_DD.npy frames of a folder (plain or encoded, see src.codec) into a chronological in-memory
+    (t, h, w, 1) cube, the in-memory counterpart of combine_npys_into_eopatches.
+    Returns the dates, the cube and the bbox of the frames.
+    """
+    dateformat = "%Y_%m_%d"
+    npy_paths = sorted(glob.glob(os.path.join(npy_dir, "*.npy")))
+    dates = [dt.datetime.strptime(os.path.basename(file).replace(".npy",""), dateformat) for file in npy_paths]
+    if len(npy_paths) == 0:
+        raise ValueError(f"No frames found in {npy_dir}")
+
+    # Fill a preallocated cube, so that the frames are not held twice
+    first = load_frame_file(npy_paths[0])
+    cube = np.empty((len(npy_paths), *first.shape, 1), dtype=first.dtype)
+    for i, path in enumerate(npy_paths):
+        print(f"Stacking image {i+1}/{len(npy_paths)}", end="\r")
+        cube[i, ..., 0] = first if i == 0 else load_frame_file(path)
+        if delete_after:
+            os.remove(path)
+
+    return dates, cube, load_bbox(os.path.join(npy_dir, "bbox.pkl"))
+
+
+def combine_band_npys_into_eopatches(band_dirs: Dict[str, str],
+                 outpath: str,
+                 bbox: BBox,
+                 delete_after:bool = False,
+                 partition_size:int = 10,
+                 compress_level:int = 0):
+    """
+    Combine the numpy arrays of multiple bands into one eopatch with one data feature per band.
+    band_dirs maps each band (feature name) to a directory with one YYYY_MM_DD.npy file per date.
+    Only the dates that have info for all bands are kept.
+    """
+    dateformat = "%Y_%m_%d"
+
+    # Get all the dates that have info for all bands
+    band_paths = {band: {os.path.basename(p).replace(".npy",""): p for p in glob.glob(os.path.join(band_dir, "*.npy"))}
+                  for band, band_dir in band_dirs.items()}
+    date_strs = sorted(set.intersection(*[set(paths.keys()) for paths in band_paths.values()]))
+    if len(date_strs) == 0:
+        raise ValueError("No dates with info for all bands")
+    dates = [dt.datetime.strptime(date_str, dateformat) for date_str in date_strs]
+
+    # Process each partition
+    if partition_size > len(dates): partition_size = len(dates)
+    partitions = np.arange(0, len(dates), partition_size)
+    print(f"Processing {len(partitions)} partitions of {partition_size} dates each for bands {list(band_dirs.keys())}")
+
+    for i,start in enumerate(partitions):
+        print(f"Processing partition {i+1}/{len(partitions)}", end="\r")
+
+        end = min(start+partition_size, len(dates))
+
+        # Create eopatch with one feature per band
+        eopatch = EOPatch()
+        for band, paths in band_paths.items():
+            arrays = [load_frame_file(paths[date_str]) for date_str in date_strs[start:end]]
+            eopatch.data[band] = np.stack(arrays, axis=0)[..., np.newaxis]
+        eopatch.bbox = bbox
+        eopatch.timestamp = dates[start:end]
+
+        # Save eopatch
+        print(f"Saving eopatch {i+1}/{len(partitions)}", end="\r")
+        part_outpath = outpath if len(partitions) == 1 else os.path.join(outpath, f"partition_{i+1}")
+        eopatch.save(part_outpath, overwrite_permission=OverwritePermission.OVERWRITE_PATCH, compress_level=compress_level)
+
+        # (Optional) Delete all the individual files
+        if delete_after:
+            for paths in band_paths.values():
+                for date_str in date_strs[start:end]:
+                    os.remove(paths[date_str])
+
+
+DATE_PATTERNS = [
+    (re.compile(r"(?<!\d)(\d{4})[_-](\d{2})[_-](\d{2})(?!\d)"), "%Y%m%d"),
+    (re.compile(r"(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)"), "%Y%m%d"),
+    (re.compile(r"(?<!\d)(\d{2})(\d{2})(\d{2})(?!\d)"), "%y%m%d"),
+]
+
+
+def get_image_date(path: str) -> dt.datetime:
+    """
+    Infer the acquisition date of an image from its filename, e.g. 2022_06_22, 20220622 or 220622.
+    Returns None if no valid date is found.
+    """
+    name = os.path.basename(path)
+    for pattern, dateformat in DATE_PATTERNS:
+        for match in pattern.finditer(name):
+            try:
+                return dt.datetime.strptime("".join(match.groups()), dateformat)
+            except ValueError:
+                continue
+    return None
+
+
+def filter_images_by_date(image_paths: list, start_date: dt.datetime = None, end_date: dt.datetime = None) -> list:
+    """
+    Only keep the images whose filename date falls within the date range (inclusive), so that the others are never read.
+    Images without a recognizable date are kept.
+    """
+    if start_date is None and end_date is None:
+        return image_paths
+
+    filtered = []
+    for path in image_paths:
+        date = get_image_date(path)
+        if date is None:
+            print(f"Warning: Could not infer the date of {path} from its filename, keeping it")
+        elif (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+            continue
+        filtered.append(path)
+    return filtered
+
+
+def get_roi_window(bbox: BBox, img_h: int, img_w: int, roi: tuple) -> Tuple[int, int, int, int, BBox]:
+    """
+    Convert a region of interest (xmin, ymin, xmax, ymax), in the crs of the image, into a pixel window of the image.
+    The window is snapped outwards to whole pixels and clipped to the image.
+    Returns the row offset, column offset, height and width of the window and the bbox of the window.
+    """
+    xmin, ymin, xmax, ymax = list(bbox)
+    res_x = (xmax - xmin) / img_w
+    res_y = (ymax - ymin) / img_h
+
+    col_start = max(0, int(math.floor((roi[0] - xmin) / res_x)))
+    col_stop = min(img_w, int(math.ceil((roi[2] - xmin) / res_x)))
+    row_start = max(0, int(math.floor((ymax - roi[3]) / res_y)))
+    row_stop = min(img_h, int(math.ceil((ymax - roi[1]) / res_y)))
+
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError(f"Region of interest {roi} does not overlap with the image bbox {list(bbox)}")
+
+    window_bbox = BBox((xmin + col_start * res_x, ymax - row_stop * res_y, xmin + col_stop * res_x, ymax - row_start * res_y), crs=bbox.crs)
+    return row_start, col_start, row_stop - row_start, col_stop - col_start, window_bbox
+
+
+def unpack_tif_window(image_paths: list, outdir: str, roi: tuple = None, start_date: dt.datetime = None, end_date: dt.datetime = None,
+                      merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC):
+    """
+    Unpack single-band TIF images into YYYY_MM_DD.npy files using windowed reads, so that only the part of
+    each image within the region of interest (xmin, ymin, xmax, ymax) is read and decoded.
+    The dates are inferred from the filenames; the bbox of the window is saved as bbox.pkl.
+    Images that share a date are merged with the merge_rule (see src.frames), and frames are encoded with the codec (see src.codec).
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    image_paths = filter_images_by_date(image_paths, start_date, end_date)
+
+    bbox = None
+    for i, image_path in enumerate(image_paths):
+        date = get_image_date(image_path)
+        if date is None:
+            raise ValueError(f"Could not infer the date of {image_path} from its filename")
+
+        # Local files are opened by path, so that GDAL only reads the blocks of the window
+        source = get_filesystem(image_path).open(image_path, 'rb') if image_path.startswith("s3://") else image_path
+        with rasterio.open(source) as src:
+            img_bbox = BBox(tuple(src.bounds), crs=CRS(src.crs.to_epsg()))
+            if roi is None:
+                window = Window(0, 0, src.width, src.height)
+                window_bbox = img_bbox
+            else:
+                row_off, col_off, height, width, window_bbox = get_roi_window(img_bbox, src.height, src.width, roi)
+                window = Window(col_off, row_off, width, height)
+
+            if bbox is None:
+                bbox = window_bbox
+
+            print(f"Saving image {i+1}/{len(image_paths)}", end='\r')
+            img = src.read(1, window=window)
+            save_frame(outdir, date.strftime("%Y_%m_%d"), img, rule=merge_rule, codec=codec)
+
+    if bbox is None:
+        raise ValueError("No images found to unpack")
+    save_bbox(bbox, os.path.join(outdir, 'bbox.pkl'))
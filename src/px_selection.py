@@ -0,0 +1,69 @@
+import numbers
+import numpy as np
+
+# Output formats of the pixel time series
+PX_FORMATS = ["csv", "sparse", "sharded"]
+
+
+def check_px_format(px_format:str):
+    if px_format not in PX_FORMATS:
+        raise ValueError(f"Pixel output format {px_format} is not supported; choose from {PX_FORMATS}")
+
+
+def is_int(value) -> bool:
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def check_px_selection(px_selection:dict):
+    """
+    Check the options of the pixel time series (see select_pixels): 'roi_path', 'min_valid_ratio', 'sample_n', 'seed'
+    and 'px_format'. Missing options are left to their defaults.
+    """
+    px_selection = px_selection or {}
+    unknown = set(px_selection) - {"roi_path", "min_valid_ratio", "sample_n", "seed", "px_format"}
+    if unknown:
+        raise ValueError(f"Unknown pixel selection options {sorted(unknown)}")
+
+    check_px_format(px_selection.get("px_format", "csv"))
+
+    roi_path = px_selection.get("roi_path")
+    if roi_path is not None and not isinstance(roi_path, str):
+        raise ValueError(f"The pixel mask path should be a path, got {roi_path!r}")
+
+    ratio = px_selection.get("min_valid_ratio")
+    if ratio is not None and (isinstance(ratio, bool) or not isinstance(ratio, numbers.Real) or not 0 <= ratio <= 1):
+        raise ValueError(f"min_valid_ratio should be a number between 0 and 1, got {ratio!r}")
+
+    sample_n = px_selection.get("sample_n")
+    if sample_n is not None and (not is_int(sample_n) or sample_n < 1):
+        raise ValueError(f"The number of sampled pixels should be a positive integer, got {sample_n!r}")
+
+    seed = px_selection.get("seed", 0)
+    if seed is not None and (not is_int(seed) or seed < 0):
+        raise ValueError(f"The sample seed should be a non-negative integer, got {seed!r}")
+
+
+def select_pixels(arr:np.ndarray, mask:np.ndarray = None, min_valid_ratio:float = None, sample_n:int = None, seed = 0) -> np.ndarray:
+    """
+    Select the pixels of a flattened (t, h*w) array that should be extracted.
+    Pixels can be restricted to a (h, w) boolean mask, to pixels with at least min_valid_ratio valid (>= 0) observations,
+    and to a deterministic random sample of sample_n pixels. Returns the sorted indices of the selected pixels.
+    """
+    keep = np.ones(arr.shape[1], dtype=bool)
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).ravel()
+        if mask.shape[0] != arr.shape[1]:
+            raise ValueError(f"Mask with {mask.shape[0]} pixels does not match image with {arr.shape[1]} pixels")
+        keep &= mask
+
+    if min_valid_ratio is not None and arr.shape[0] > 0:
+        keep &= (arr >= 0).mean(axis=0) >= min_valid_ratio
+
+    idxs = np.flatnonzero(keep)
+
+    if sample_n is not None and sample_n < len(idxs):
+        rng = np.random.default_rng(seed)
+        idxs = np.sort(rng.choice(idxs, size=sample_n, replace=False))
+
+    return idxs
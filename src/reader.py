@@ -0,0 +1,236 @@
+import os
+import json
+import datetime as dt
+import numpy as np
+import pandas as pd
+from typing import List, Tuple, Union
+from stelar_spatiotemporal.lib import get_filesystem, multiprocess_map
+
+from src.sparse_storage import SPARSE_EXTENSION, load_sparse_arrays
+from src.sharded_storage import SHARD_EXTENSION, load_shard_arrays
+
+INDEX_NAME = "_index.json"
+
+
+def get_index_path(outdir:str) -> str:
+    return os.path.join(outdir, INDEX_NAME)
+
+
+def px_index_entry(outpath:str, bbox, shape:Tuple[int, int], timestamps:list) -> dict:
+    """
+    Describe a pixel output file for the index: its format, the bbox and shape of its patchlet and its date range.
+    """
+    return {
+        "file": os.path.basename(outpath),
+        "patch": get_patch_name(outpath),
+        "format": get_px_file_format(outpath),
+        "bbox": list(bbox) if bbox is not None else None,
+        "crs": bbox.crs.epsg if bbox is not None else None,
+        "shape": [int(shape[0]), int(shape[1])] if shape is not None else None,
+        "start": min(timestamps).date().isoformat() if len(timestamps) > 0 else None,
+        "end": max(timestamps).date().isoformat() if len(timestamps) > 0 else None,
+    }
+
+
+def get_px_file_format(path:str) -> str:
+    if path.endswith(SPARSE_EXTENSION):
+        return "sparse"
+    if path.endswith(SHARD_EXTENSION):
+        return "sharded"
+    return "csv"
+
+
+def get_patch_name(path:str) -> str:
+    name = os.path.basename(path)
+    for ext in [".csv", SPARSE_EXTENSION, SHARD_EXTENSION]:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def write_index(outdir:str, entries:List[dict]):
+    """
+    Write (or update) the index of the output files in a directory.
+    Entries of files that are already in the index are replaced; dates ranges are widened for appended files.
+    """
+    entries = [e for e in entries if e is not None]
+    index = load_index(outdir, build=False) or {}
+    for entry in entries:
+        old = index.get(entry["file"])
+        if old is not None and old.get("start") is not None and entry.get("start") is not None:
+            entry["start"] = min(old["start"], entry["start"])
+            entry["end"] = max(old["end"], entry["end"])
+        index[entry["file"]] = entry
+
+    fs = get_filesystem(outdir)
+    with fs.open(get_index_path(outdir), "w") as f:
+        json.dump({"files": list(index.values())}, f, indent=1)
+
+
+def build_index(outdir:str) -> dict:
+    """
+    Build an index of the pixel output files in a directory that were written without one.
+    Such entries lack the patchlet bbox and dates, so they only support queries by pixel id.
+    """
+    fs = get_filesystem(outdir)
+    files = [f for f in fs.ls(outdir, detail=False) if f.endswith((".csv", SPARSE_EXTENSION, SHARD_EXTENSION))]
+    entries = [px_index_entry(f, None, None, []) for f in sorted(files)]
+    write_index(outdir, entries)
+    return {e["file"]: e for e in entries}
+
+
+def load_index(outdir:str, build:bool = True) -> Union[dict, None]:
+    """
+    Load the index of the output files in a directory as a dict mapping file names to entries.
+    """
+    fs = get_filesystem(outdir)
+    index_path = get_index_path(outdir)
+    if not fs.exists(index_path):
+        return build_index(outdir) if build else None
+
+    with fs.open(index_path, "r") as f:
+        files = json.load(f)["files"]
+    return {e["file"]: e for e in files}
+
+
+def parse_px_id(px_id:str) -> Tuple[int, int]:
+    x, y = px_id.split("_")
+    return int(x), int(y)
+
+
+def bbox_to_px_ids(entry:dict, bbox:Tuple[float, float, float, float]) -> List[str]:
+    """
+    Get the ids of the pixels of an output file whose centers fall inside a bbox (xmin, ymin, xmax, ymax).
+    """
+    xmin, ymin, xmax, ymax = entry["bbox"]
+    h, w = entry["shape"]
+    xres, yres = (xmax - xmin) / w, (ymax - ymin) / h
+
+    # Pixel x is the column (from the west) and y is the row (from the north)
+    cols = np.arange(w)
+    rows = np.arange(h)
+    cols = cols[(xmin + (cols + 0.5) * xres >= bbox[0]) & (xmin + (cols + 0.5) * xres <= bbox[2])]
+    rows = rows[(ymax - (rows + 0.5) * yres >= bbox[1]) & (ymax - (rows + 0.5) * yres <= bbox[3])]
+
+    xs, ys = np.meshgrid(cols, rows)
+    return [f"{x}_{y}" for x, y in zip(xs.ravel(), ys.ravel())]
+
+
+def overlaps(entry:dict, startdate, enddate) -> bool:
+    if entry.get("start") is None:
+        return True
+    if startdate is not None and entry["end"] < pd.Timestamp(startdate).date().isoformat():
+        return False
+    if enddate is not None and entry["start"] > pd.Timestamp(enddate).date().isoformat():
+        return False
+    return True
+
+
+def read_csv_columns(path:str, columns:List[str] = None, startdate = None, enddate = None, ignore_missing:bool = False) -> pd.DataFrame:
+    """
+    Read only the requested columns of a date x series csv file, and only keep the requested dates.
+    """
+    fs = get_filesystem(path)
+
+    usecols = None
+    if columns is not None:
+        # Read the header to find the positions of the requested columns
+        with fs.open(path, "r") as f:
+            header = f.readline().rstrip("\n").split(",")
+        positions = pd.Index(header).get_indexer(columns)
+        if (positions < 0).any():
+            if not ignore_missing:
+                raise ValueError(f"Columns {np.asarray(columns)[positions < 0][:5]} not in {path}")
+            columns = [c for c, p in zip(columns, positions) if p >= 0]
+            positions = positions[positions >= 0]
+        usecols = [0] + sorted(set(positions.tolist()))
+
+    with fs.open(path, "r") as f:
+        df = pd.read_csv(f, index_col=0, usecols=usecols, parse_dates=True)
+
+    df = df.sort_index().loc[startdate:enddate]
+    df.index = df.index.date
+    return df if columns is None else df[columns]
+
+
+def read_px_file(data:Tuple[str, List[str]], outdir:str, startdate = None, enddate = None) -> pd.DataFrame:
+    """
+    Read the (requested pixels of an) output file as a (n_pixels, n_dates) dataframe indexed by patch, x and y.
+    """
+    entry, px_ids = data
+    path = os.path.join(outdir, entry["file"])
+
+    if entry["format"] == "sparse":
+        dates, columns, arr = load_sparse_arrays(path, columns=px_ids, startdate=startdate, enddate=enddate, ignore_missing=True)
+        df = pd.DataFrame(arr.T, index=columns, columns=pd.DatetimeIndex(dates).date)
+    elif entry["format"] == "sharded":
+        # Only the byte ranges of the requested pixels are read
+        dates, columns, arr = load_shard_arrays(path, columns=px_ids, startdate=startdate, enddate=enddate, ignore_missing=True)
+        df = pd.DataFrame(arr.T, index=columns, columns=pd.DatetimeIndex(dates).date)
+    else:
+        df = read_csv_columns(path, columns=px_ids, startdate=startdate, enddate=enddate, ignore_missing=True).T
+
+    xys = [parse_px_id(c) for c in df.index]
+    df.index = pd.MultiIndex.from_tuples([(entry["patch"], x, y) for x, y in xys], names=["patch", "x", "y"])
+    return df
+
+
+def read_px_matrix(outdir:str, pixels:List[Tuple[str, int, int]] = None,
+                   bbox:Tuple[float, float, float, float] = None,
+                   startdate: dt.datetime = None, enddate: dt.datetime = None,
+                   n_jobs:int = 8) -> pd.DataFrame:
+    """
+    Read the pixel timeseries of an output directory as a (n_series, n_dates) dataframe, indexed by patch, x and y.
+    The series can be selected by a list of (patch, x, y) pixels and/or a bbox (xmin, ymin, xmax, ymax) in the crs of the images,
+    and restricted to a date range. The index of the directory is used to only open the files that can contain the requested series,
+    and only the requested columns of those files are parsed. Requested pixels that were not extracted are left out.
+    Use .to_numpy() on the result to get a plain matrix.
+    """
+    index = load_index(outdir)
+
+    # Determine which pixels to read from which file
+    requests = []
+    for entry in index.values():
+        if not overlaps(entry, startdate, enddate):
+            continue
+
+        px_ids = None
+        if pixels is not None:
+            px_ids = [f"{x}_{y}" for patch, x, y in pixels if patch == entry["patch"]]
+            if len(px_ids) == 0:
+                continue
+        if bbox is not None:
+            if entry.get("bbox") is None:
+                raise ValueError(f"No bbox known for {entry['file']}; cannot select pixels by bbox")
+            ebox = entry["bbox"]
+            if ebox[0] > bbox[2] or ebox[2] < bbox[0] or ebox[1] > bbox[3] or ebox[3] < bbox[1]:
+                continue
+            in_bbox = bbox_to_px_ids(entry, bbox)
+            px_ids = in_bbox if px_ids is None else sorted(set(px_ids) & set(in_bbox))
+            if len(px_ids) == 0:
+                continue
+        requests.append((entry, px_ids))
+
+    if len(requests) == 0:
+        return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=["patch", "x", "y"]))
+
+    dfs = multiprocess_map(func=read_px_file, object_list=requests, outdir=outdir, startdate=startdate, enddate=enddate, n_jobs=n_jobs)
+    df = pd.concat(dfs, axis=0)
+
+    # Sort the columns by date
+    df.sort_index(axis=1, inplace=True)
+    return df
+
+
+def read_field_matrix(csv_path:str, field_ids:List[str] = None, startdate: dt.datetime = None, enddate: dt.datetime = None) -> pd.DataFrame:
+    """
+    Read the field timeseries csv as a (n_fields, n_dates) dataframe indexed by field id (or field id and statistic column).
+    Only the requested fields are parsed.
+    """
+    columns = None if field_ids is None else [str(f) for f in field_ids]
+    df = read_csv_columns(csv_path, columns=columns, startdate=startdate, enddate=enddate).T
+    df.index.name = "field_id"
+
+    # Sort the columns by date
+    df.sort_index(axis=1, inplace=True)
+    return df
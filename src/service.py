@@ -0,0 +1,43 @@
+import json
+from wsgiref.simple_server import make_server
+
+# The service runs the tasks through the functions of main, which keeps the imported libraries, the catalog and the
+# field layers (see main.load_fields_cached) warm between tasks
+from main import run_task, error_response
+
+# Default address of the service mode (python main.py serve)
+SERVICE_ADDRESS = "127.0.0.1:8080"
+
+
+def service_app(environ, start_response):
+    """
+    WSGI application of the service mode: POST a task JSON to /run to get its output JSON in the response body;
+    GET /health checks that the service is up.
+    """
+    path, method = environ.get("PATH_INFO", ""), environ["REQUEST_METHOD"]
+    if method == "GET" and path == "/health":
+        status, response = "200 OK", {"status": "ok"}
+    elif method == "POST" and path == "/run":
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            input_json = json.loads(environ["wsgi.input"].read(length))
+        except ValueError as e:
+            status, response = "400 Bad Request", error_response(e)
+        else:
+            status, response = "200 OK", run_task(input_json)
+    else:
+        status, response = "404 Not Found", {"message": f"Unknown endpoint {method} {path}", "status": "failed"}
+
+    body = json.dumps(response, indent=4).encode()
+    start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def serve(host:str = "127.0.0.1", port:int = 8080):
+    """
+    Run as a long-lived service that keeps the imported libraries, MinIO clients, the catalog and the field layers warm
+    between tasks. Tasks are run one at a time, as they share the intermediate folders in /tmp.
+    """
+    with make_server(host, port, service_app) as server:
+        print(f"Serving tasks on http://{host}:{port}/run")
+        server.serve_forever()
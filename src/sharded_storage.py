@@ -0,0 +1,173 @@
+import json
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+from stelar_spatiotemporal.lib import get_filesystem
+
+SHARD_EXTENSION = ".pxs"
+SHARD_VERSION = 1
+
+# Requested pixels whose series are less than this many bytes apart are read in a single request
+MAX_GAP = 1 << 16
+
+
+def get_shard_index_path(path:str) -> str:
+    return path + ".json"
+
+
+def encode_pixels(columns:np.ndarray) -> dict:
+    """
+    Describe the "x_y" pixel ids of a shard compactly: only the shape of the block if they are all its pixels in row-major order,
+    their flat (row-major) positions otherwise. Other ids are stored as they are.
+    """
+    try:
+        xs, ys = np.array([c.split("_") for c in columns], dtype=np.int64).reshape(-1, 2).T
+    except ValueError:
+        return {"columns": columns.tolist()}
+
+    w, h = int(xs.max(initial=-1)) + 1, int(ys.max(initial=-1)) + 1
+    flat = ys * w + xs
+    if len(flat) == h * w and np.array_equal(flat, np.arange(len(flat))):
+        return {"shape": [h, w]}
+    return {"shape": [h, w], "pixels": flat.tolist()}
+
+
+def decode_pixels(index:dict) -> np.ndarray:
+    if "columns" in index:
+        return np.asarray(index["columns"]).astype(str)
+
+    h, w = index["shape"]
+    flat = np.arange(h * w) if index.get("pixels") is None else np.asarray(index["pixels"], dtype=np.int64)
+    return np.char.add(np.char.add((flat % w).astype(str), "_"), (flat // w).astype(str))
+
+
+def load_shard_index(path:str) -> dict:
+    fs = get_filesystem(path)
+    index_path = get_shard_index_path(path)
+    if not fs.exists(index_path):
+        raise ValueError(f"No offset index found for shard {path}")
+
+    with fs.open(index_path, "r") as f:
+        index = json.load(f)
+    if index.get("version") != SHARD_VERSION:
+        raise ValueError(f"Shard {path} has version {index.get('version')}, expected {SHARD_VERSION}")
+    return index
+
+
+def save_shard_index(path:str, index:dict):
+    with get_filesystem(path).open(get_shard_index_path(path), "w") as f:
+        json.dump(index, f)
+
+
+def get_shard_columns(path:str) -> np.ndarray:
+    return decode_pixels(load_shard_index(path))
+
+
+def save_shard_px(outpath:str, arr:np.ndarray, dates:list, columns:np.ndarray, append:bool = True):
+    """
+    Save the (t, n) pixel timeseries to a shard: a single binary file of segments, each holding the series of all pixels
+    for a range of dates (pixel after pixel), with a json index of the segment offsets next to it.
+    If the shard exists and append is True, the new dates are written as a new segment at the end of the file;
+    earlier segments are never rewritten.
+    """
+    fs = get_filesystem(outpath)
+    columns = np.asarray(columns).astype(str)
+    dates = [pd.Timestamp(d).date().isoformat() for d in dates]
+
+    append = append and fs.exists(outpath) and fs.exists(get_shard_index_path(outpath))
+    if append:
+        index = load_shard_index(outpath)
+        if not np.array_equal(decode_pixels(index), columns):
+            raise ValueError(f"Cannot append to {outpath}; the pixels do not match")
+        # Bytes of an interrupted earlier write are left unreferenced at the end of the file
+        offset = fs.size(outpath)
+    else:
+        index = dict(version=SHARD_VERSION, dtype=arr.dtype.str, segments=[], **encode_pixels(columns))
+        offset = 0
+
+    # Pixel-major order keeps the series of a pixel within a segment contiguous
+    data = np.ascontiguousarray(arr.astype(np.dtype(index["dtype"]), copy=False).T)
+    with fs.open(outpath, "ab" if append else "wb") as f:
+        f.write(data.tobytes())
+
+    # Update the index only after the data is written, so that it never points to missing bytes
+    if len(dates) > 0:
+        index["segments"].append({"offset": int(offset), "dates": dates})
+    save_shard_index(outpath, index)
+
+
+def read_segment(f, offset:int, n_times:int, dtype:np.dtype, pixels:np.ndarray) -> np.ndarray:
+    """
+    Read the series of the given pixels (positions) from a segment as a (n_pixels, n_times) array.
+    Pixels that lie close together are read with a single request.
+    """
+    row_bytes = n_times * dtype.itemsize
+    out = np.empty((len(pixels), n_times), dtype=dtype)
+    if len(pixels) == 0 or n_times == 0:
+        return out
+
+    order = np.argsort(pixels, kind="stable")
+    sorted_pixels = pixels[order]
+    breaks = np.where(np.diff(sorted_pixels) * row_bytes > MAX_GAP)[0] + 1
+
+    for run in np.split(np.arange(len(pixels)), breaks):
+        first, last = int(sorted_pixels[run[0]]), int(sorted_pixels[run[-1]])
+        f.seek(offset + first * row_bytes)
+        block = np.frombuffer(f.read((last - first + 1) * row_bytes), dtype=dtype).reshape(-1, n_times)
+        out[order[run]] = block[sorted_pixels[run] - first]
+    return out
+
+
+def load_shard_arrays(path:str, columns:List[str] = None, startdate = None, enddate = None,
+                      ignore_missing:bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load the dates, pixel ids and (t, n) array of a shard.
+    Only the byte ranges of the requested pixels in the segments of the requested dates are read.
+    """
+    index = load_shard_index(path)
+    dtype = np.dtype(index["dtype"])
+    all_columns = decode_pixels(index)
+
+    pixels = np.arange(len(all_columns))
+    if columns is not None:
+        pixels = pd.Index(all_columns).get_indexer(np.asarray(columns).astype(str))
+        if (pixels < 0).any():
+            if not ignore_missing:
+                raise ValueError(f"Pixels {np.asarray(columns)[pixels < 0][:5]} not in {path}")
+            pixels = pixels[pixels >= 0]
+        all_columns = all_columns[pixels]
+
+    start = np.datetime64(pd.Timestamp(startdate).date()) if startdate is not None else None
+    end = np.datetime64(pd.Timestamp(enddate).date()) if enddate is not None else None
+
+    dates, parts = [], []
+    with get_filesystem(path).open(path, "rb") as f:
+        for segment in index["segments"]:
+            seg_dates = np.array(segment["dates"], dtype="datetime64[D]")
+            keep = np.ones(len(seg_dates), dtype=bool)
+            if start is not None:
+                keep &= seg_dates >= start
+            if end is not None:
+                keep &= seg_dates <= end
+            if not keep.any():
+                continue
+
+            values = read_segment(f, segment["offset"], len(seg_dates), dtype, pixels)
+            dates.append(seg_dates[keep])
+            parts.append(values[:, keep])
+
+    if len(parts) == 0:
+        return np.array([], dtype="datetime64[D]"), all_columns, np.empty((0, len(pixels)), dtype=dtype)
+
+    # Segments are usually appended in chronological order, but do not rely on it
+    dates = np.concatenate(dates)
+    order = np.argsort(dates, kind="stable")
+    return dates[order], all_columns, np.concatenate(parts, axis=1).T[order]
+
+
+def load_shard_px(path:str, columns:List[str] = None, startdate = None, enddate = None, ignore_missing:bool = False) -> pd.DataFrame:
+    """
+    Load a shard as a dataframe with the same layout as the pixel csv files (i.e. each row is a date and each column is a pixel).
+    """
+    dates, columns, arr = load_shard_arrays(path, columns=columns, startdate=startdate, enddate=enddate, ignore_missing=ignore_missing)
+    return pd.DataFrame(arr, columns=columns, index=pd.DatetimeIndex(dates).date)
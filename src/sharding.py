@@ -0,0 +1,313 @@
+import os
+import math
+import time
+import socket
+import threading
+import datetime as dt
+from typing import List
+
+from src.compositing import COMPOSITE_ANCHOR, check_composite
+from src.grid_aggregation import check_grid_levels
+from src.field_aggregation import check_field_stats
+from src.storage import delete_path
+from src.work_queue import DEFAULT_LEASE, create_queue, load_task, claim_shard, renew_lease, complete_shard, fail_shard, \
+    get_queue_status, load_shards
+
+# The shards run the pipeline of main; like main, this module only imports lightweight modules up front
+from main import parse_task, parse_credentials, task_credentials, parse_date, image2ts_pipeline, timed_imports, \
+    collect_import_times, load_fields_cached, list_inputs, plan_tiles, get_tile_output, combine_tile_fields, load_field_partials
+
+# Size in pixels of the spatial blocks of the shards of a task (see plan_shards), i.e. 2 x 2 patchlets
+DEFAULT_SHARD_SIZE = 2256
+
+
+def get_shard_blocks(image:dict, block_size:int, roi:tuple = None) -> List[tuple]:
+    """
+    Split an image into blocks of block_size x block_size pixels, within the region of interest (if any).
+    Returns the id and bounds of every block. The bounds lie a quarter pixel within the edges of the block, so that they
+    snap (see src.preprocessing.get_roi_window) to exactly the pixels of the block and blocks never share a pixel.
+    """
+    h, w = image["shape"]
+    xmin, ymin, xmax, ymax = image["bbox"]
+    res_x, res_y = (xmax - xmin) / w, (ymax - ymin) / h
+
+    blocks = []
+    for row in range(0, h, block_size):
+        for col in range(0, w, block_size):
+            bounds = (xmin + (col + 0.25) * res_x, ymax - (min(row + block_size, h) - 0.25) * res_y,
+                      xmin + (min(col + block_size, w) - 0.25) * res_x, ymax - (row + 0.25) * res_y)
+            if roi is not None:
+                bounds = (max(bounds[0], roi[0]), max(bounds[1], roi[1]), min(bounds[2], roi[2]), min(bounds[3], roi[3]))
+                if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+                    continue
+            blocks.append((f"{row}_{col}", bounds))
+    return blocks
+
+
+def get_date_ranges(dates:List[str], shard_days:int = None, start_date:dt.datetime = None, end_date:dt.datetime = None) -> List[tuple]:
+    """
+    Split the (YYYY_MM_DD) dates of the images into ranges of shard_days days, counted from the same day as the composite
+    periods (see src.compositing), so that a range never splits a period of a multiple of days. Only ranges with images are kept.
+    Without shard_days, the whole date range is a single range.
+    """
+    if shard_days is None:
+        return [(start_date, end_date)]
+
+    ranges = []
+    for k in sorted(set((dt.datetime.strptime(d, "%Y_%m_%d") - COMPOSITE_ANCHOR).days // shard_days for d in dates)):
+        range_start = COMPOSITE_ANCHOR + dt.timedelta(days=k * shard_days)
+        range_end = range_start + dt.timedelta(days=shard_days - 1)
+        ranges.append((max(range_start, start_date) if start_date is not None else range_start,
+                       min(range_end, end_date) if end_date is not None else range_end))
+    return ranges
+
+
+def get_image_files(images:List[dict]) -> List[str]:
+    """
+    Get the input files of images: the RAS and RHD files of RAS images, the ZIP archives or the TIF files.
+    """
+    files = set()
+    for image in images:
+        files.add(image["file"])
+        if image["file"].endswith(".RHD"):
+            files.add(image["name"])
+    return sorted(files)
+
+
+def plan_shards(input_json:dict, queue_path:str) -> dict:
+    """
+    Split a task into independent shards (tiles x spatial blocks x date ranges) and write them to a work queue
+    (see src.work_queue), from which workers on any number of nodes claim and run them (see run_worker).
+    Every shard runs the pipeline on the images of its tile, with its block as region of interest and its date range,
+    and writes its pixel and grid time series to a subfolder of the outputs named after the shard. Fields that are not
+    within a block are aggregated into partial aggregates that merge_shards merges into the single field csv.
+    The planner options are read from the parameters of the task: shard_size (block size in pixels), shard_days
+    (length of the date ranges in days; by default, the date range is not split) and shard_work_dir (a folder shared by
+    all nodes for the field aggregates of the shards). Returns a summary of the plan.
+    """
+    kwargs = parse_task(input_json)
+    parameters = input_json.get("result", input_json).get("parameters", {})
+    shard_size = int(parameters.get("shard_size", DEFAULT_SHARD_SIZE))
+    shard_days = parameters.get("shard_days", None)
+    work_dir = parameters.get("shard_work_dir", os.path.splitext(os.path.abspath(queue_path))[0] + "_work")
+
+    # Check the planner options before doing any work
+    if shard_size <= 0:
+        raise ValueError(f"shard_size should be a positive number of pixels, got {shard_size}")
+    if shard_days is not None and int(shard_days) <= 0:
+        raise ValueError(f"shard_days should be a positive number of days, got {shard_days}")
+    if kwargs["composite_days"] is not None:
+        check_composite(kwargs["composite_days"], kwargs["composite_rule"])
+    if shard_days is not None and kwargs["composite_days"] is not None and int(shard_days) % int(kwargs["composite_days"]) != 0:
+        raise ValueError(f"shard_days ({shard_days}) should be a multiple of composite_days ({kwargs['composite_days']})")
+    shard_days = int(shard_days) if shard_days is not None else None
+
+    # Blocks are a multiple of all grid levels, so that no grid cell spans two shards
+    if kwargs["grid_out_path"] is not None:
+        step = 1
+        for level in check_grid_levels(kwargs["grid_levels"]):
+            step = step * level // math.gcd(step, level)
+        shard_size = math.ceil(shard_size / step) * step
+
+    with timed_imports("catalog"):
+        from shapely.geometry import box
+        from src.catalog import CATALOG_PATH, update_catalog, group_by_tile, in_range
+
+    start_date, end_date = kwargs["start_date"], kwargs["end_date"]
+    field = kwargs["field_path"] is not None
+    with task_credentials(parse_credentials(input_json)):
+        header_paths, infos = list_inputs(kwargs["input_paths"], kwargs["extension"], start_date, end_date)
+        images = update_catalog(header_paths, catalog_path=kwargs["catalog_path"] or CATALOG_PATH, infos=infos)
+        fields = load_fields_cached(kwargs["field_path"]) if field else None
+    plans, _ = plan_tiles(group_by_tile(images), fields, kwargs["roi"])
+    if len(plans) == 0:
+        raise ValueError("None of the input tiles overlap with the region of interest.")
+
+    # Blocks without fields are skipped if the fields are the only output
+    fields_only = field and kwargs["skip_pixel"] and kwargs["grid_out_path"] is None
+
+    shards = []
+    for tile_id, (tile_images, tile_fields, tile_roi) in plans.items():
+        input_paths = get_image_files(tile_images)
+        dates = [d for image in tile_images for d in image["dates"] if in_range(d, start_date, end_date)]
+        for block_id, bounds in get_shard_blocks(tile_images[0], shard_size, tile_roi):
+            if fields_only and not tile_fields.intersects(box(*bounds)).any():
+                continue
+            for range_start, range_end in get_date_ranges(dates, shard_days, start_date, end_date):
+                shard_id = f"{tile_id}_{block_id}" + (f"_{range_start:%Y%m%d}" if shard_days is not None else "")
+                shards.append({
+                    "shard_id": shard_id,
+                    "tile_id": tile_id,
+                    "image_shape": tile_images[0]["shape"],
+                    "input_paths": input_paths,
+                    "roi": list(bounds),
+                    "start_date": range_start.isoformat() if range_start is not None else None,
+                    "end_date": range_end.isoformat() if range_end is not None else None,
+                    "px_out": get_tile_output(kwargs["px_out"], shard_id),
+                    "grid_out_path": get_tile_output(kwargs["grid_out_path"], shard_id),
+                    "field_out_path": os.path.join(work_dir, shard_id, "fields.csv") if field else None,
+                    "field_partials_path": os.path.join(work_dir, shard_id, "field_partials.pkl") if field else None,
+                })
+
+    if len(shards) == 0:
+        raise ValueError("No shards to run; none of the blocks contain any fields.")
+    create_queue(queue_path, input_json, shards)
+    print(f"Planned {len(shards)} shard(s) of {len(plans)} tile(s) in {queue_path}")
+
+    return {"queue_path": queue_path, "number_of_tiles": len(plans), "number_of_shards": len(shards),
+            "status": get_queue_status(queue_path), "import_times": collect_import_times()}
+
+
+def clear_shard_outputs(spec:dict):
+    """
+    Delete what an earlier attempt of a shard wrote, as some outputs (e.g. the grid csv files) are appended to.
+    """
+    with timed_imports("catalog"):
+        from stelar_spatiotemporal.lib import get_filesystem
+
+    for key in ["px_out", "grid_out_path"]:
+        if spec[key] is not None:
+            fs = get_filesystem(spec[key])
+            if fs.exists(spec[key]):
+                fs.rm(spec[key], recursive=True)
+    for key in ["field_out_path", "field_partials_path"]:
+        if spec[key] is not None:
+            delete_path(spec[key])
+
+
+def run_shard(task:dict, spec:dict) -> dict:
+    """
+    Run the pipeline for a shard (see plan_shards) of a task JSON; returns its output JSON.
+    """
+    kwargs = parse_task(task)
+    kwargs.update(input_paths=spec["input_paths"],
+                  roi=spec["roi"],
+                  start_date=parse_date(spec["start_date"], "start_date"),
+                  end_date=parse_date(spec["end_date"], "end_date"),
+                  px_out=spec["px_out"],
+                  grid_out_path=spec["grid_out_path"],
+                  field_out_path=spec["field_out_path"],
+                  field_partials_path=spec["field_partials_path"],
+                  dry_run=False)
+
+    with task_credentials(parse_credentials(task)):
+        clear_shard_outputs(spec)
+        return image2ts_pipeline(**kwargs)
+
+
+def keep_lease(queue_path:str, shard_id:str, worker:str, interval:float, stop:threading.Event):
+    while not stop.wait(interval):
+        if not renew_lease(queue_path, shard_id, worker):
+            print(f"Warning: the lease of {worker} on shard {shard_id} expired; the shard may run twice")
+
+
+def run_worker(queue_path:str, worker:str = None, lease:float = DEFAULT_LEASE, max_shards:int = None, poll:float = 30) -> int:
+    """
+    Claim shards from a work queue, run them and report their results, until no shards are left.
+    While shards of other workers are still running (and may fail or expire), the worker waits for them.
+    The claim on a shard is renewed in the background, so that shards of failed nodes are handed out again after the lease.
+    Workers of the same node share /tmp, so run a single worker per node (the tiles of a shard run concurrently).
+    Returns the number of shards the worker ran.
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    task = load_task(queue_path)["spec"]
+
+    n_shards = 0
+    while max_shards is None or n_shards < max_shards:
+        spec = claim_shard(queue_path, worker, lease)
+        if spec is None:
+            if get_queue_status(queue_path, lease)["running"] == 0:
+                break
+            time.sleep(poll)
+            continue
+
+        print(f"[{worker}] Running shard {spec['shard_id']}...")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease, args=(queue_path, spec["shard_id"], worker, lease / 3, stop), daemon=True)
+        heartbeat.start()
+        try:
+            response = run_shard(task, spec)
+        except Exception as e:
+            print(f"[{worker}] Shard {spec['shard_id']} failed: {e}")
+            fail_shard(queue_path, spec["shard_id"], worker, str(e))
+        else:
+            complete_shard(queue_path, spec["shard_id"], worker, response)
+        finally:
+            stop.set()
+            heartbeat.join()
+        n_shards += 1
+
+    print(f"[{worker}] Ran {n_shards} shard(s); queue status: {get_queue_status(queue_path, lease)}")
+    return n_shards
+
+
+def merge_shards(queue_path:str) -> dict:
+    """
+    Merge the results of the shards of a work queue (see plan_shards) once all of them are done:
+    the field time series of all shards are combined into the field csv (merging the partial aggregates of fields that
+    span several blocks), and the metrics of the shards into the output JSON of the task.
+    """
+    task = load_task(queue_path)
+    kwargs = parse_task(task["spec"])
+    shards = load_shards(queue_path)
+
+    unfinished = [shard["shard_id"] for shard in shards if shard["status"] != "done"]
+    if len(unfinished) > 0:
+        raise ValueError(f"{len(unfinished)} of {len(shards)} shards are not done ({get_queue_status(queue_path)}), e.g. {unfinished[:5]}")
+
+    partial_times = {}
+    if kwargs["field_path"] is not None:
+        start = time.time()
+
+        print("Merging the field-level time series of all shards...")
+        field_partials = [load_field_partials(shard["spec"]["field_partials_path"]) for shard in shards
+                          if os.path.exists(shard["spec"]["field_partials_path"])]
+        with task_credentials(parse_credentials(task["spec"])):
+            combine_tile_fields(field_partials, [shard["spec"]["field_out_path"] for shard in shards],
+                                kwargs["field_out_path"], check_field_stats(kwargs["field_stats"]))
+
+        partial_times['field_level_timeseries_merging'] = time.time() - start
+
+    # Sum the partial runtimes over the shards
+    shard_metrics = {shard["shard_id"]: shard["result"]["metrics"] for shard in shards}
+    for metrics in shard_metrics.values():
+        for key, value in metrics["partial_runtimes"].items():
+            partial_times[key] = partial_times.get(key, 0) + value
+
+    # Blocks of the same tile and date range share their images
+    n_images = {}
+    for shard in shards:
+        key = (shard["spec"]["tile_id"], shard["spec"]["start_date"])
+        n_images[key] = max(n_images.get(key, 0), shard["result"]["metrics"]["number_of_images"])
+
+    workers = {}
+    for shard in shards:
+        workers[shard["worker"]] = workers.get(shard["worker"], 0) + 1
+
+    ref = shards[0]["spec"]
+    output_json = {
+        "message": "Time series data has been created successfully.",
+        "output": {},
+        "metrics": {
+            "number_of_images": sum(n_images.values()),
+            "image_width": ref["image_shape"][1],
+            "image_height": ref["image_shape"][0],
+            "number_of_tiles": len(set(shard["spec"]["tile_id"] for shard in shards)),
+            "number_of_shards": len(shards),
+            "shard_attempts": sum(shard["attempts"] for shard in shards),
+            "workers": workers,
+            "total_runtime": time.time() - task["created"],
+            "partial_runtimes": partial_times,
+            "shards": shard_metrics,
+        },
+        "status": "success"
+    }
+
+    if not kwargs["skip_pixel"]:
+        output_json["output"]["pixel_timeseries"] = kwargs["px_out"]
+    if kwargs["field_path"] is not None:
+        output_json["output"]["field_timeseries"] = kwargs["field_out_path"]
+    if kwargs["grid_out_path"] is not None:
+        output_json["output"]["grid_timeseries"] = kwargs["grid_out_path"]
+
+    return output_json
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+from stelar_spatiotemporal.lib import get_filesystem
+
+SPARSE_EXTENSION = ".npz"
+
+
+def to_sparse(arr:np.ndarray, valid:np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Turn a (t, n) array of pixel timeseries into a per-pixel validity bitmask and the valid values only.
+    Values are considered valid if they are >= 0, unless a validity mask is given.
+    Returns the (n, ceil(t/8)) packed bitmask and the valid values in pixel-major order.
+    """
+    if valid is None:
+        valid = arr >= 0
+
+    # Pixel-major order keeps the values of a single pixel contiguous
+    valid = valid.T
+    bitmask = np.packbits(valid, axis=1)
+    values = arr.T[valid]
+    return bitmask, values
+
+
+def from_sparse(bitmask:np.ndarray, values:np.ndarray, n_times:int, pixels:np.ndarray = None, fill_value = np.nan) -> np.ndarray:
+    """
+    Reconstruct the dense (t, n) array from a bitmask and the valid values.
+    If pixels (indices) are given, only the timeseries of those pixels are reconstructed.
+    Invalid observations are set to fill_value.
+    """
+    valid = np.unpackbits(bitmask, axis=1, count=n_times).astype(bool)
+
+    if pixels is not None:
+        # Find where the values of every selected pixel start
+        counts = valid.sum(axis=1)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        pixels = np.asarray(pixels)
+        sel_counts = counts[pixels]
+
+        # Gather the value ranges of the selected pixels without a python loop
+        starts = np.repeat(offsets[pixels] - np.concatenate([[0], np.cumsum(sel_counts)[:-1]]), sel_counts)
+        values = values[starts + np.arange(sel_counts.sum())]
+        valid = valid[pixels]
+
+    if isinstance(fill_value, float) and np.isnan(fill_value):
+        dtype = np.result_type(values.dtype, np.float32)
+    else:
+        dtype = np.result_type(values.dtype, fill_value)
+    dense = np.full(valid.shape, fill_value, dtype=dtype)
+    dense[valid] = values
+    return dense.T
+
+
+def save_sparse_px(outpath:str, arr:np.ndarray, dates:list, columns:np.ndarray, append:bool = True, compress:bool = True):
+    """
+    Save the (t, n) pixel timeseries as a sparse npz file with a validity bitmask and the valid values only.
+    If the file exists and append is True, the new dates are appended to the existing timeseries.
+    """
+    fs = get_filesystem(outpath)
+    dates = np.array(dates, dtype="datetime64[D]")
+    columns = np.asarray(columns).astype(str)
+
+    if append and fs.exists(outpath):
+        old_dates, old_columns, old_arr = load_sparse_arrays(outpath, fill_value=-1)
+        if not np.array_equal(old_columns, columns):
+            raise ValueError(f"Cannot append to {outpath}; the pixels do not match")
+        arr = np.concatenate([old_arr.astype(arr.dtype), arr], axis=0)
+        dates = np.concatenate([old_dates, dates])
+
+    bitmask, values = to_sparse(arr)
+
+    savefunc = np.savez_compressed if compress else np.savez
+    with fs.open(outpath, "wb") as f:
+        savefunc(f, dates=dates, columns=columns, bitmask=bitmask, values=values, n_times=np.array(len(dates)))
+
+
+def load_sparse_arrays(path:str, columns:List[str] = None, startdate = None, enddate = None, fill_value = np.nan, ignore_missing:bool = False):
+    """
+    Load the dates, pixel ids and dense (t, n) array of a sparse npz file.
+    Only the requested pixels (ids) and dates are reconstructed.
+    """
+    fs = get_filesystem(path)
+    with fs.open(path, "rb") as f:
+        data = np.load(f)
+        dates = data["dates"]
+        all_columns = data["columns"]
+        n_times = int(data["n_times"])
+
+        pixels = None
+        if columns is not None:
+            lookup = pd.Index(all_columns)
+            pixels = lookup.get_indexer(np.asarray(columns).astype(str))
+            if (pixels < 0).any():
+                if not ignore_missing:
+                    raise ValueError(f"Pixels {np.asarray(columns)[pixels < 0][:5]} not in {path}")
+                pixels = pixels[pixels >= 0]
+            all_columns = all_columns[pixels]
+
+        arr = from_sparse(data["bitmask"], data["values"], n_times, pixels=pixels, fill_value=fill_value)
+
+    # Only keep the requested dates
+    keep = np.ones(len(dates), dtype=bool)
+    if startdate is not None:
+        keep &= dates >= np.datetime64(pd.Timestamp(startdate).date())
+    if enddate is not None:
+        keep &= dates <= np.datetime64(pd.Timestamp(enddate).date())
+
+    return dates[keep], all_columns, arr[keep]
+
+
+def load_sparse_px(path:str, columns:List[str] = None, startdate = None, enddate = None, fill_value = np.nan) -> pd.DataFrame:
+    """
+    Load a sparse npz file as a dense dataframe with the same layout as the pixel csv files
+    (i.e. each row is a date and each column is a pixel). Invalid observations are set to fill_value.
+    """
+    dates, columns, arr = load_sparse_arrays(path, columns=columns, startdate=startdate, enddate=enddate, fill_value=fill_value)
+    return pd.DataFrame(arr, columns=columns, index=pd.DatetimeIndex(dates).date)
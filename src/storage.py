@@ -0,0 +1,136 @@
+import os
+import time
+import numbers
+import shutil
+import threading
+from typing import List
+
+
+def get_dir_size(path:str) -> int:
+    """
+    Get the total size in bytes of a file or of the files in a directory (recursively).
+    """
+    if not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def delete_path(path:str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def create_storage(quota_bytes:int = None) -> dict:
+    """
+    Create a manager of the intermediate artifacts (files or folders) of a run, shared by all its pipelines.
+    Every artifact is registered with the consumers that still need it, and deleted as soon as the last one is done.
+    With a quota, producers wait before creating an artifact until the artifacts of the others leave enough room.
+    """
+    if quota_bytes is not None and (isinstance(quota_bytes, bool) or not isinstance(quota_bytes, numbers.Integral) or quota_bytes <= 0):
+        raise ValueError(f"The disk quota should be a positive whole number of bytes, got {quota_bytes!r}")
+    return {
+        "quota": int(quota_bytes) if quota_bytes is not None else None,
+        "artifacts": {},
+        "waiting": set(),
+        "peak": 0,
+        "wait_time": 0.0,
+        "condition": threading.Condition(),
+    }
+
+
+def get_used_bytes(storage:dict) -> int:
+    # Artifacts that are still being produced count with their reserved size, the others with their size on disk
+    return sum(a["bytes"] for a in storage["artifacts"].values())
+
+
+def can_reserve(storage:dict, n_bytes:int, owner:str) -> bool:
+    """
+    Check whether n_bytes fit in the quota. If they do not, but no other owner is able to free any room
+    (because it has no artifacts or is waiting itself), the reservation is granted anyway to avoid a deadlock.
+    """
+    if storage["quota"] is None or get_used_bytes(storage) + n_bytes <= storage["quota"]:
+        return True
+    others = set(a["owner"] for a in storage["artifacts"].values()) - {owner}
+    return len(others - storage["waiting"]) == 0
+
+
+def add_artifact(storage:dict, path:str, consumers:List[str], n_bytes:int = 0, owner:str = None):
+    """
+    Register an artifact that is about to be produced, with the names of its consumers and its expected size.
+    Blocks while the expected size does not fit in the quota (backpressure).
+    """
+    condition = storage["condition"]
+    with condition:
+        start = time.time()
+        if not can_reserve(storage, n_bytes, owner):
+            print(f"Waiting for {n_bytes / 1e9:.2f} GB of intermediate storage for {path} (quota {storage['quota'] / 1e9:.2f} GB)")
+            storage["waiting"].add(owner)
+            condition.notify_all()
+            while not can_reserve(storage, n_bytes, owner):
+                condition.wait()
+            storage["waiting"].discard(owner)
+        storage["wait_time"] += time.time() - start
+
+        if storage["quota"] is not None and get_used_bytes(storage) + n_bytes > storage["quota"]:
+            print(f"Warning: {path} may exceed the disk quota, but no other intermediates can be freed")
+
+        storage["artifacts"][path] = {"owner": owner, "consumers": set(consumers), "bytes": int(n_bytes), "ready": False}
+        storage["peak"] = max(storage["peak"], get_used_bytes(storage))
+
+
+def artifact_ready(storage:dict, path:str):
+    """
+    Mark an artifact as produced; from now on it counts with its actual size on disk.
+    """
+    size = get_dir_size(path)
+    with storage["condition"]:
+        artifact = storage["artifacts"][path]
+        artifact["bytes"], artifact["ready"] = size, True
+        storage["peak"] = max(storage["peak"], get_used_bytes(storage))
+        storage["condition"].notify_all()
+
+
+def consume(storage:dict, path:str, consumer:str):
+    """
+    Mark a consumer of an artifact as done, and delete the artifact if it was the last one.
+    """
+    with storage["condition"]:
+        artifact = storage["artifacts"].get(path)
+        if artifact is None:
+            return
+        artifact["consumers"].discard(consumer)
+        if len(artifact["consumers"]) > 0:
+            return
+
+    delete_path(path)
+    with storage["condition"]:
+        storage["artifacts"].pop(path, None)
+        storage["condition"].notify_all()
+
+
+def remove_artifacts(storage:dict, owner:str = None):
+    """
+    Delete the remaining artifacts of an owner (or of all owners), e.g. at the end of its pipeline or after a failure.
+    """
+    with storage["condition"]:
+        paths = [p for p, a in storage["artifacts"].items() if owner is None or a["owner"] == owner]
+
+    for path in paths:
+        delete_path(path)
+    with storage["condition"]:
+        for path in paths:
+            storage["artifacts"].pop(path, None)
+        storage["waiting"].discard(owner)
+        storage["condition"].notify_all()
+
+
+def storage_metrics(storage:dict) -> dict:
+    return {
+        "quota_bytes": storage["quota"],
+        "peak_disk_bytes": int(storage["peak"]),
+        "wait_time": storage["wait_time"],
+    }
@@ -6,18 +6,32 @@ import pandas as pd
 import tqdm
 import glob
 import shutil
+import tempfile
 from shapely.geometry import Polygon, box
 import rasterio
-from rasterio.mask import mask as mask_func
+from rasterio.mask import mask as mask_func, raster_geometry_mask
 import geopandas as gpd
-from typing import Union
+from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
 import fiona
 import time
+import zlib
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
 
 from stelar_spatiotemporal.eolearn.core import EOPatch, FeatureType, OverwritePermission
 from stelar_spatiotemporal.lib import check_types, multiprocess_map, export_eopatch_to_tiff, df_to_csv_manual, load_bbox, get_filesystem
 from stelar_spatiotemporal.preprocessing.preprocessing import split_array_into_patchlets, split_patch_into_patchlets, combine_dates_for_eopatch
 
+from src.px_selection import check_px_format, select_pixels
+from src.sparse_storage import SPARSE_EXTENSION, save_sparse_px
+from src.sharded_storage import SHARD_EXTENSION, save_shard_px, get_shard_columns, load_shard_px
+from src.reader import px_index_entry, write_index
+from src.eopatch_windows import open_eopatch_cube, get_row_windows, read_rows
+from src.grid_aggregation import DEFAULT_GRID_LEVELS, check_grid_levels, grid_pyramid
+from src.field_aggregation import DEFAULT_FIELD_STATS, check_field_stats, field_stat_column, is_value_stat, field_partials, \
+    merge_field_partials, finalize_field_partials
+
 
 def get_px_csv_path(outdir:str, prefix:str, x:str, y:str):
         dirname = "LAI_px_ts"
@@ -25,7 +39,11 @@ def get_px_csv_path(outdir:str, prefix:str, x:str, y:str):
                 return os.path.join(outdir, dirname, x, y + '.csv')
         else:
                 return os.path.join(outdir, dirname, prefix, x, y + '.csv')
-        
+
+
+def get_px_shard_path(outdir:str, prefix:str):
+    return os.path.join(outdir, "LAI_px_ts", prefix + SHARD_EXTENSION)
+
 
 def save_long_csv(csv_path:str, dates:list, values:list):
     # Create the directory if necessary
@@ -35,20 +53,109 @@ def save_long_csv(csv_path:str, dates:list, values:list):
     df.to_csv(csv_path, index=False)
 
 
-def extract_px_timeseries_wrapper(eop_path:str, outdir:str = None, band:str='LAI') -> Union[None, pd.DataFrame]:
+def get_px_columns(h:int, w:int) -> np.ndarray:
+    """
+    Get the "x_y" ids of the pixels of a (h, w) image, in the order of the flattened image.
+    x is the column and y is the row of the pixel.
+    """
+    # Get x and y coordinates
+    xs, ys = np.meshgrid(np.arange(w), np.arange(h))
+
+    # Turn xs into "x0 x1 x2 ... xn" and ys into "y0 y1 y2 ... yn
+    xs = np.char.add(xs.ravel().astype(str), "_")
+    ys = ys.ravel().astype(str)
+    return np.char.add(xs, ys)
+
+
+def rasterize_roi(roi:gpd.GeoDataFrame, bbox, shape:tuple) -> np.ndarray:
+    """
+    Get a (h, w) boolean mask of the pixels of an image with the given bbox that fall inside the geometries of the roi.
+    """
+    if roi.crs != bbox.crs:
+        roi = roi.to_crs(bbox.crs.ogc_string())
+
+    roi = roi[roi.intersects(box(*bbox))]
+    if len(roi) == 0:
+        return np.zeros(shape, dtype=bool)
+
+    transform = rasterio.transform.from_bounds(*bbox, width=shape[1], height=shape[0])
+    return geometry_mask(roi.geometry, out_shape=shape, transform=transform, invert=True)
+
+
+def get_px_extension(px_format:str) -> str:
+    return {"sparse": SPARSE_EXTENSION, "sharded": SHARD_EXTENSION}.get(px_format, ".csv")
+
+
+def extract_px_timeseries_wrapper(eop_path:str, outdir:str = None, band:str='LAI', roi:gpd.GeoDataFrame = None,
+                                  min_valid_ratio:float = None, sample_n:int = None, seed:int = 0, px_format:str = "csv") -> Union[None, pd.DataFrame]:
     eopatch = EOPatch.load(eop_path, lazy_loading=True)
 
+    # Get the mask of the pixels inside the roi
+    mask = None
+    if roi is not None:
+        mask = rasterize_roi(roi, eopatch.bbox, eopatch.data[band].shape[1:3])
+
+    # Sample each patchlet with its own, reproducible random state
+    seed = [seed, zlib.crc32(os.path.basename(eop_path).encode())]
+
     if outdir is None:
-        return extract_px_timeseries(eopatch, band=band)
+        return extract_px_timeseries(eopatch, band=band, mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed)
     else:
         os.makedirs(outdir, exist_ok=True)
-        outpath = os.path.join(outdir, os.path.basename(eop_path) + ".csv")
-        return extract_px_timeseries(eopatch, outpath=outpath, band=band)
-
-def extract_px_timeseries(eopatch:EOPatch, outpath:str = None, band:str='LAI') -> Union[None, pd.DataFrame]:
+        extension = get_px_extension(px_format)
+        outpath = os.path.join(outdir, os.path.basename(eop_path) + extension)
+        bbox, shape, timestamps = eopatch.bbox, eopatch.data[band].shape[1:3], eopatch.timestamp
+        extract_px_timeseries(eopatch, outpath=outpath, band=band, mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed,
+                              px_format=px_format)
+
+        # Return the description of the output file for the index
+        if not get_filesystem(outpath).exists(outpath):
+            return None
+        return px_index_entry(outpath, bbox, shape, timestamps)
+
+def extract_px_timeseries_bands_wrapper(eop_path:str, outdir:str, bands:list, roi:gpd.GeoDataFrame = None,
+                                        min_valid_ratio:float = None, sample_n:int = None, seed:int = 0, px_format:str = "csv") -> dict:
+    """
+    Extract the timeseries of multiple bands of a patchlet in a single pass, saving every band to its own directory outdir/<band>.
+    The eopatch is loaded once, and the same pixels are selected for all bands (based on the first band).
+    Returns a dict mapping each band to the index entry of its output file.
+    """
+    eopatch = EOPatch.load(eop_path, lazy_loading=True)
+    bbox, timestamps = eopatch.bbox, eopatch.timestamp
+
+    # Select the pixels once for all bands
+    first = eopatch.data[bands[0]][...,0]
+    shape = first.shape[1:3]
+    mask = None
+    if roi is not None:
+        mask = rasterize_roi(roi, bbox, shape)
+    if mask is not None or min_valid_ratio is not None or sample_n is not None:
+        seed = [seed, zlib.crc32(os.path.basename(eop_path).encode())]
+        idxs = select_pixels(first.reshape(first.shape[0], -1), mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed)
+        mask = np.zeros(shape[0] * shape[1], dtype=bool)
+        mask[idxs] = True
+    del first
+
+    extension = get_px_extension(px_format)
+    entries = {}
+    for band in bands:
+        band_outdir = os.path.join(outdir, band)
+        os.makedirs(band_outdir, exist_ok=True)
+        outpath = os.path.join(band_outdir, os.path.basename(eop_path) + extension)
+        extract_px_timeseries(eopatch, outpath=outpath, band=band, mask=mask, px_format=px_format)
+        entries[band] = px_index_entry(outpath, bbox, shape, timestamps) if get_filesystem(outpath).exists(outpath) else None
+    return entries
+
+def extract_px_timeseries(eopatch:EOPatch, outpath:str = None, band:str='LAI', mask:np.ndarray = None,
+                          min_valid_ratio:float = None, sample_n:int = None, seed = 0, px_format:str = "csv") -> Union[None, pd.DataFrame]:
     """
     This function extracts the timeseries of a given band for an eopatch and saves it as a csv file.
+    The output can be restricted to a subset of the pixels, see select_pixels.
+    With px_format 'sparse', the timeseries are saved as a validity bitmask plus the valid values only (see src.sparse_storage).
+    With px_format 'sharded', they are saved to a single container file with an offset index (see src.sharded_storage).
     """
+    check_px_format(px_format)
+
     # Check if band in eopatch
     if band not in eopatch.data.keys():
         raise ValueError(f"Band {band} not in eopatch")
@@ -64,26 +171,56 @@ def extract_px_timeseries(eopatch:EOPatch, outpath:str = None, band:str='LAI') -
 
     del eopatch
 
-    # Get x and y coordinates
-    xs, ys = np.meshgrid(np.arange(arr.shape[1]), np.arange(arr.shape[2]))
+    return extract_px_array(arr, ts, outpath=outpath, mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed,
+                            px_format=px_format)
 
-    # Turn xs into "x0 x1 x2 ... xn" and ys into "y0 y1 y2 ... yn
-    xs = np.char.add(xs.ravel().astype(str), "_")
-    ys = ys.ravel().astype(str)
-    cols = np.char.add(xs, ys)
+
+def extract_px_array(arr:np.ndarray, ts:list, outpath:str = None, mask:np.ndarray = None,
+                     min_valid_ratio:float = None, sample_n:int = None, seed = 0, px_format:str = "csv") -> Union[None, pd.DataFrame]:
+    """
+    Extract the pixel timeseries of a (t, h, w) array with the given timestamps, see extract_px_timeseries.
+    """
+    # Get the "x_y" pixel ids
+    cols = get_px_columns(arr.shape[1], arr.shape[2])
 
     # Flatten image (t, w, h) -> (t, w*h)
     arr = arr.reshape(arr.shape[0], -1)
 
+    # Filter the pixels before building the dataframe
+    if mask is not None or min_valid_ratio is not None or sample_n is not None:
+        idxs = select_pixels(arr, mask=mask, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed)
+        arr = arr[:, idxs]
+        cols = cols[idxs]
+
+        if len(idxs) == 0 and outpath is not None:
+            print(f"No pixels selected, skipping {outpath}")
+            return None
+
+    # Drop rows with only negative values
+    keep = (arr >= 0).any(axis=1)
+    arr = arr[keep]
+    ts = [t for t, k in zip(ts, keep) if k]
+
+    # Save as sparse bitmask + valid values
+    if outpath is not None and px_format == "sparse":
+        if not outpath.endswith(SPARSE_EXTENSION):
+            outpath += SPARSE_EXTENSION
+        save_sparse_px(outpath, arr, [t.date() for t in ts], cols)
+        return None
+
+    # Save as a container of per-pixel series with an offset index
+    if outpath is not None and px_format == "sharded":
+        if not outpath.endswith(SHARD_EXTENSION):
+            outpath += SHARD_EXTENSION
+        save_shard_px(outpath, arr, [t.date() for t in ts], cols)
+        return None
+
     # Turn into column-wise dataframe (i.e. each column is a pixel)
-    df = pd.DataFrame(arr, columns=cols, index=ts)
+    df = pd.DataFrame(arr, columns=cols, index=pd.DatetimeIndex(ts))
 
     # Make sure index is date only
     df.index = df.index.date
 
-    # Drop rows with only negative values
-    df = df.loc[(df >= 0).any(axis=1)]
-
     if outpath is None:
         return df
 
@@ -97,14 +234,28 @@ def extract_px_timeseries(eopatch:EOPatch, outpath:str = None, band:str='LAI') -
     df_to_csv_manual(df, outpath, index=True, mode=wmode, header=(wmode=="w"))
 
 
-def lai_to_csv_px(eop_paths:list, patchlet_dir:str, outdir:str, n_jobs:int=16, delete_patchlets:bool=True):
+def lai_to_csv_px(eop_paths:list, patchlet_dir:str, outdir:str, n_jobs:int=16, delete_patchlets:bool=True,
+                  roi_path:str = None, min_valid_ratio:float = None, sample_n:int = None, seed:int = 0, px_format:str = "csv",
+                  bands:list = None):
     """
     This function extracts the timeseries of a given band for each pixel and saves it as a csv file.
     It does this by doing the following:
     1. We break up each image into a series of patchlets.
     2. We combine the data for each patchlet into a single eopatch.
     3. We convert the eopatch into a timeseries of LAI values for each pixel.
+    Optionally, only the pixels inside the polygons of roi_path, the pixels with at least min_valid_ratio valid observations,
+    and/or a random sample of sample_n pixels per patchlet are extracted.
+    With px_format 'sparse', each patchlet is saved as a compact npz file instead of a csv file (see src.sparse_storage),
+    with px_format 'sharded' as a container file of per-pixel series with an offset index (see src.sharded_storage).
+    If bands are given, the timeseries of all these bands are extracted in the same pass over every patchlet and saved to outdir/<band>.
     """
+    check_px_format(px_format)
+
+    roi = None
+    if roi_path is not None:
+        print("Loading pixel mask polygons", end="\r")
+        roi = load_fields(roi_path)
+
     patchlet_size = (1128,1128)
     buffer = 0
     for eop_path in tqdm.tqdm(eop_paths, total=len(eop_paths), desc="1. Splitting tiles into patchlets"):
@@ -130,8 +281,24 @@ def lai_to_csv_px(eop_paths:list, patchlet_dir:str, outdir:str, n_jobs:int=16, d
     # 3. Extracting time series from each patchlet
     patchlet_paths = glob.glob(os.path.join(patchlet_dir, "patchlet_*"))
     patchlet_paths.sort()
+    index_entries = []
+    band_entries = {band: [] for band in (bands or [])}
     for ppath in tqdm.tqdm(patchlet_paths, total=len(patchlet_paths), desc="3. Extracting timeseries per patchlet"):
-        extract_px_timeseries_wrapper(eop_path=ppath, outdir = outdir)
+        if bands is None:
+            entry = extract_px_timeseries_wrapper(eop_path=ppath, outdir = outdir, roi=roi, min_valid_ratio=min_valid_ratio, sample_n=sample_n, seed=seed,
+                                                  px_format=px_format)
+            index_entries.append(entry)
+        else:
+            entries = extract_px_timeseries_bands_wrapper(eop_path=ppath, outdir=outdir, bands=bands, roi=roi, min_valid_ratio=min_valid_ratio,
+                                                          sample_n=sample_n, seed=seed, px_format=px_format)
+            for band, entry in entries.items():
+                band_entries[band].append(entry)
+
+    # Index the output files for fast reading (see src.reader)
+    if bands is None:
+        write_index(outdir, index_entries)
+    for band, entries in band_entries.items():
+        write_index(os.path.join(outdir, band), entries)
 
     # 4. Deleting the patchlets
     if delete_patchlets:
@@ -140,6 +307,76 @@ def lai_to_csv_px(eop_paths:list, patchlet_dir:str, outdir:str, n_jobs:int=16, d
             shutil.rmtree(p)
 
 
+def get_grid_csv_path(outdir:str, level:int, band:str='LAI'):
+    return os.path.join(outdir, f"{band}_grid_{level}x{level}.csv")
+
+
+def extract_grid_timeseries(eopatch:EOPatch, levels:list, outdir:str = None, band:str='LAI') -> Union[None, dict]:
+    """
+    This function block-reduces the given band of an eopatch to coarser grids and extracts the timeseries of every grid cell.
+    Each cell holds the mean of the valid (>= 0) pixels it covers; the timeseries of every level are saved as a separate csv file.
+    """
+    # Check if band in eopatch
+    if band not in eopatch.data.keys():
+        raise ValueError(f"Band {band} not in eopatch")
+
+    # Get the array (t, h, w) and reduce it to all levels
+    arr = eopatch.data[band][...,0]
+    ts = eopatch.timestamp
+    pyramid = grid_pyramid(arr, levels)
+
+    del eopatch, arr
+
+    return write_grid_pyramid(pyramid, ts, outdir=outdir, band=band)
+
+
+def write_grid_pyramid(pyramid:dict, ts:list, outdir:str = None, band:str='LAI') -> Union[None, dict]:
+    """
+    Save the timeseries of every cell of every level of a grid pyramid (level -> (t, h, w) array), see extract_grid_timeseries.
+    """
+    dfs = {}
+    for level, grid in pyramid.items():
+        # Turn into column-wise dataframe (i.e. each column is a grid cell)
+        cols = get_px_columns(grid.shape[1], grid.shape[2])
+        df = pd.DataFrame(grid.reshape(grid.shape[0], -1), columns=cols, index=ts)
+
+        # Make sure index is date only
+        df.index = df.index.date
+
+        # Drop rows without any valid cell
+        df = df.loc[df.notna().any(axis=1)]
+
+        if outdir is None:
+            dfs[level] = df
+            continue
+
+        outpath = get_grid_csv_path(outdir, level, band)
+        fs = get_filesystem(outpath)
+        exists = fs.exists(outpath)
+        wmode = "w" if not exists else "a"
+        df_to_csv_manual(df, outpath, index=True, mode=wmode, header=(wmode=="w"))
+
+    if outdir is None:
+        return dfs
+
+
+def lai_to_csv_grid(eop_paths:list, outdir:str, levels:list = DEFAULT_GRID_LEVELS, band:str='LAI'):
+    """
+    This function extracts the timeseries of coarser grids (e.g. 2x2, 4x4 and 10x10 pixel blocks) and saves them as csv files.
+    The eopatches are processed in chronological order, so that the timeseries of later partitions are appended to the same files.
+    """
+    levels = check_grid_levels(levels)
+    os.makedirs(outdir, exist_ok=True)
+
+    # Sort the partitions by their first date
+    eops = [EOPatch.load(eop_path, lazy_loading=True) for eop_path in eop_paths]
+    order = np.argsort([min(eop.timestamp) for eop in eops])
+
+    for i in tqdm.tqdm(order, total=len(order), desc=f"Extracting timeseries for grid levels {levels}"):
+        extract_grid_timeseries(eops[i], levels, outdir=outdir, band=band)
+        eops[i] = None
+
+
 def lai_to_csv_px_append(npy_path:str, outdir:str):
     timestamp = dt.datetime.strptime(os.path.basename(npy_path).replace(".npy",""), "%Y_%m_%d")
 
@@ -186,10 +423,77 @@ def long_to_wide_ts_dict(csv_path: str, startdate: dt.datetime, enddate: dt.date
      return df.iloc[0].to_dict()
 
 
+def is_shard_paths(paths:list) -> bool:
+    return len(paths) > 0 and all(str(p).endswith(SHARD_EXTENSION) for p in paths)
+
+
+def read_shard_wide(data:tuple, startdate: dt.datetime, enddate: dt.datetime) -> pd.DataFrame:
+    """
+    Read the given pixels of a shard as a (n_pixels, n_dates) dataframe indexed by patch, x and y.
+    """
+    path, columns = data
+    df = load_shard_px(path, columns=columns, startdate=startdate, enddate=enddate).T
+
+    patch = os.path.basename(path)[:-len(SHARD_EXTENSION)]
+    xys = [c.split("_") for c in df.index]
+    df.index = pd.MultiIndex.from_tuples([(patch, int(x), int(y)) for x, y in xys], names=["patch", "x", "y"])
+    return df
+
+
+def read_shard_series(shard_paths:list, startdate: dt.datetime, enddate: dt.datetime, n: int, n_jobs:int = 8) -> pd.DataFrame:
+    """
+    Read the first n pixel series of several shards into one (n, n_dates) dataframe indexed by patch, x and y.
+    Only the offset indices and the byte ranges of the requested series are read.
+    """
+    requests = []
+    for path in shard_paths:
+        if n <= 0:
+            break
+        columns = get_shard_columns(path)[:n]
+        requests.append((path, columns))
+        n -= len(columns)
+
+    print("Reading shards into a dataframe", end="\r")
+    dfs = multiprocess_map(func=read_shard_wide, object_list=requests, startdate=startdate, enddate=enddate, n_jobs=n_jobs)
+    return pd.concat(dfs, axis=0)
+
+
+def pack_px_csvs(csv_paths:list, outdir:str, n_jobs:int = 8) -> list:
+    """
+    Pack per-pixel csv files (see get_px_csv_path) into one shard per patch (see get_px_shard_path),
+    so that the series of a patch can be listed, appended to and read without opening a file per pixel.
+    Dates that are missing for a pixel are set to NaN. Returns the paths of the shards.
+    """
+    patches = {}
+    for path in csv_paths:
+        path_parts = path.split(os.sep)
+        patches.setdefault(path_parts[-3], []).append(path)
+
+    shard_paths = []
+    for patch, paths in tqdm.tqdm(patches.items(), total=len(patches), desc="Packing pixel csvs into shards"):
+        xys = [(p.split(os.sep)[-2], p.split(os.sep)[-1].replace(".csv", "")) for p in paths]
+        dicts = multiprocess_map(func=long_to_wide_ts_dict, object_list=paths, startdate=None, enddate=None, n_jobs=n_jobs)
+        df = pd.DataFrame(dicts).sort_index(axis=1)
+
+        shard_path = get_px_shard_path(outdir, patch)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        save_shard_px(shard_path, df.to_numpy(dtype=np.float32).T, list(df.columns), [f"{x}_{y}" for x, y in xys], append=False)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
 def combine_timeseries(csv_paths:list, startdate: dt.datetime, enddate: dt.datetime, n: int, n_jobs:int = 8, out_path: str = None) -> pd.DataFrame:
     """
     Combines the timeseries of several csvs into one dataframe.
+    Shards (see src.sharded_storage) are read as well; each of their pixels counts as one timeseries.
     """
+    if is_shard_paths(csv_paths):
+        df = read_shard_series(csv_paths, startdate, enddate, n, n_jobs).reset_index(drop=True)
+        if out_path is None:
+            return df
+        df.to_csv(out_path, index=True)
+        return None
+
     if len(csv_paths) < n:
         n = len(csv_paths)    
     path_view = csv_paths[:n]
@@ -209,24 +513,31 @@ def combine_timeseries(csv_paths:list, startdate: dt.datetime, enddate: dt.datet
 
 
 def combine_timeseries_px(csv_paths:list, startdate: dt.datetime, enddate: dt.datetime, n: int, n_jobs:int = 8, out_path: str = None) -> pd.DataFrame:
-    df = combine_timeseries(csv_paths, startdate, enddate, n, n_jobs)
+    """
+    Combines the first n pixel timeseries of per-pixel csv files (see get_px_csv_path) or of shards (see get_px_shard_path)
+    into one dataframe indexed by patch, x and y.
+    """
+    if is_shard_paths(csv_paths):
+        df = read_shard_series(csv_paths, startdate, enddate, n, n_jobs)
+    else:
+        df = combine_timeseries(csv_paths, startdate, enddate, n, n_jobs)
 
-    pnames = []
-    x_coords = []
-    y_coords = []
+        pnames = []
+        x_coords = []
+        y_coords = []
 
-    for path in csv_paths[:n]:
-        path_parts = path.split(os.sep)
-        pnames.append(path_parts[-3])
-        x_coords.append(int(path_parts[-2]))
-        y_coords.append(int(path_parts[-1].replace(".csv","")))
+        for path in csv_paths[:n]:
+            path_parts = path.split(os.sep)
+            pnames.append(path_parts[-3])
+            x_coords.append(int(path_parts[-2]))
+            y_coords.append(int(path_parts[-1].replace(".csv","")))
 
-    df["patch"] = pnames
-    df["x"] = x_coords
-    df["y"] = y_coords
+        df["patch"] = pnames
+        df["x"] = x_coords
+        df["y"] = y_coords
 
-    # Set the index to the patch name and the x and y coordinates
-    df.set_index(["patch", "x", "y"], inplace=True)
+        # Set the index to the patch name and the x and y coordinates
+        df.set_index(["patch", "x", "y"], inplace=True)
 
     # Sort the columns by date
     df.sort_index(axis=1, inplace=True)
@@ -243,16 +554,15 @@ def load_fields(field_path:str, nrows:int = None, min_area:int = 0, max_area:int
     # Get the filesystem
     filesystem = get_filesystem(field_path)
 
-    # Copy and read the fields with geopandas
-    tmpdir = os.environ.get("TMPDIR", "/tmp")
-    tmp_fieldpath = os.path.join(tmpdir, os.path.basename(field_path))
-
-    if not os.path.exists(tmp_fieldpath):
-        # Download the file if it is on a remote filesystem
+    # Copy the file to a fresh temporary folder (so that a changed file or another file with the same name is never
+    # read from an earlier copy) and read the fields with geopandas
+    tmpdir = tempfile.mkdtemp(dir=os.environ.get("TMPDIR", "/tmp"))
+    try:
+        tmp_fieldpath = os.path.join(tmpdir, os.path.basename(field_path))
         filesystem.get(field_path, tmp_fieldpath)
-
-    # Read the fields with geopandas
-    df = gpd.read_file(tmp_fieldpath, rows=nrows)
+        df = gpd.read_file(tmp_fieldpath, rows=nrows)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
     # Filter the fields by area
     if min_area > 0:
@@ -308,65 +618,74 @@ def get_field_csv_path(outdir:str, prefix:str, field_id:str):
                 return os.path.join(outdir, dirname, prefix, field_id + '.csv')
         
 
-def field_to_ts(field: Polygon, src: rasterio.DatasetReader):
-    # Mask the array
-    try:
-        mask_array = mask_field(field, src)
-    except Exception as e:
-        print(f"Error masking field: {e}")
-        return np.ones((src.count,)) * np.nan  # Return an array of nans if the mask fails
-
-#     Check if the mask is empty
-    if mask_array.shape[0] == 0:
-        print(f"Empty mask for field")
-        return None
-
-    # Flatten the images -> (w*h, n_times)
-    mask_array = mask_array.reshape(mask_array.shape[0], -1).astype(np.float16)
+def read_field_pixels(field: Polygon, src: rasterio.DatasetReader) -> np.ndarray:
+    """
+    Read the values of all pixels inside a field as a (n_times, n_pixels) array, in the dtype of the raster.
+    """
+    shape_mask, _, window = raster_geometry_mask(src, [field], crop=True)
+    data = src.read(window=window)
+    return data[:, ~shape_mask]
 
-    # Get median of correct values per date
-    mask_array[mask_array <= 0] = np.nan
-    return np.nanmedian(mask_array, axis=1)
 
 import warnings
 warnings.filterwarnings("ignore")
 
 from typing import Tuple
 
-def field_to_df(data:Tuple[int,Polygon], tiff_path:str, datetimes:list):
+def field_to_partials(data:Tuple[int,Polygon], tiff_path:str, datetimes:list):
+    """
+    Compute the mergeable partial aggregates (see src.field_aggregation) of the pixels of a field in a tiff.
+    """
     field_id, field = data
 
     # Open the raster
-    src = rasterio.open(tiff_path)
-
-    # Get the values
-    values = field_to_ts(field, src)
+    with rasterio.open(tiff_path) as src:
+        try:
+            values = read_field_pixels(field, src)
+        except Exception as e:
+            print(f"Error masking field: {e}")
+            values = np.zeros((src.count, 0))  # No pixels if the mask fails
 
-    # Create df
-    df = pd.DataFrame(data=[values], columns=datetimes)
-
-    # Sort columns by date
-    df.sort_index(axis=1, inplace=True)
+    return field_id, field_partials(values, datetimes)
 
-    df.index = [field_id]
 
-    return df
+def tiff_to_field_partials(fields:gpd.GeoDataFrame, tiff_path:str, datetimes:list, n_jobs:int = 8) -> dict:
+    """
+    Compute the partial aggregates of every field in a tiff, as a dict mapping field ids to partials.
+    """
+    results = multiprocess_map(field_to_partials, list(fields.geometry.items()), tiff_path=tiff_path, datetimes=datetimes, n_jobs=n_jobs)
+    return dict(results)
 
 
-def field_to_csv(fields:gpd.GeoDataFrame, tiff_path:str,
-                 datetimes:list, outpath:str, n_jobs:int = 8, tile_id:str = None):
-    # Iteratively create df of field timeseries
-    dfs = multiprocess_map(field_to_df, list(fields.geometry.items()), tiff_path=tiff_path, datetimes=datetimes, n_jobs=n_jobs)
+def partials_to_df(partials:dict, stats:list = DEFAULT_FIELD_STATS) -> pd.DataFrame:
+    """
+    Finalize the partial aggregates of the fields into a dataframe with one row per field and statistic
+    (indexed by field id and statistic index) and one column per date.
+    """
+    dfs = []
+    for field_id, partial in partials.items():
+        values = finalize_field_partials(partial, stats)
+        df = pd.DataFrame(data=[values[s] for s in stats], columns=pd.DatetimeIndex(partial["dates"]).to_pydatetime())
+        df.sort_index(axis=1, inplace=True)
+        df.index = pd.MultiIndex.from_arrays([[field_id] * len(stats), list(range(len(stats)))])
+        dfs.append(df)
+    return pd.concat(dfs, axis=0)
 
-    # Concatenate the dfs
-    print(f"Concatenating timeseries", end="\r")
-    df = pd.concat(dfs, axis=0)
 
-    # Sort the index by field id
+def write_field_df(df:pd.DataFrame, outpath:str, stats:list = DEFAULT_FIELD_STATS):
+    """
+    Write (or append) a dataframe of field statistics, as created by partials_to_df, to the field csv.
+    """
+    # Sort the index by field id (and by the order of the requested statistics)
     df.sort_index(inplace=True)
 
-    # Remove columns with only nans
-    df = df.dropna(axis=1, how="all")
+    # Remove dates with only nans (count-like statistics are never nan, so only look at value statistics)
+    value_rows = np.array([is_value_stat(stats[i]) for _, i in df.index])
+    if value_rows.any():
+        df = df.loc[:, df[value_rows].notna().any(axis=0)]
+
+    # Write every statistic as a separate column
+    df.index = [field_stat_column(field_id, stats[i], stats) for field_id, i in df.index]
 
     # Remove rows with only nans
     # df = df.dropna(axis=0, how="all")
@@ -384,7 +703,28 @@ def field_to_csv(fields:gpd.GeoDataFrame, tiff_path:str,
     df_to_csv_manual(df, outpath, index=True, mode=wmode, header=(wmode=="w"))
 
 
-def lai_to_csv_field(eop_paths:list, fields_path:str, outpath:str, nfields:int = None, n_jobs:int = 8, delete_tmp:bool=False, tmpdir:str = "/tmp"):
+def field_to_csv(fields:gpd.GeoDataFrame, tiff_path:str,
+                 datetimes:list, outpath:str, n_jobs:int = 8, tile_id:str = None, stats:list = DEFAULT_FIELD_STATS):
+    stats = check_field_stats(stats)
+
+    # Compute the partial aggregates of every field and turn them into statistics
+    partials = tiff_to_field_partials(fields, tiff_path, datetimes, n_jobs=n_jobs)
+
+    print(f"Concatenating timeseries", end="\r")
+    write_field_df(partials_to_df(partials, stats), outpath, stats)
+
+
+def lai_to_csv_field(eop_paths:list, fields_path:str, outpath:str, nfields:int = None, n_jobs:int = 8, delete_tmp:bool=False, tmpdir:str = "/tmp",
+                     stats:list = DEFAULT_FIELD_STATS, fields:gpd.GeoDataFrame = None, partial_ids:list = None):
+        """
+        This function extracts the timeseries of each field in a shapefile and saves them in a single csv file.
+        All requested statistics (see src.field_aggregation) are computed in one pass and written as separate columns.
+        Already loaded fields can be given instead of a fields_path.
+        The fields in partial_ids (e.g. fields that span several tiles) are not written; instead, their partial aggregates
+        (merged over the eopatches) are returned, to be merged with those of the other tiles.
+        """
+        stats = check_field_stats(stats)
+
         # Make temporary tiff dir
         tif_dir = os.path.join(tmpdir, "tiffs")
         os.makedirs(tif_dir, exist_ok=True)
@@ -394,11 +734,14 @@ def lai_to_csv_field(eop_paths:list, fields_path:str, outpath:str, nfields:int =
         # minarea = 1000 # 1 km2
         # maxarea = 500_000 # 50 hectares
 
-        if nfields is None:
+        if fields is not None:
+                fields = fields if nfields is None else fields.iloc[:nfields]
+        elif nfields is None:
                 fields = load_fields(fields_path)
         else:
                 fields = load_fields(fields_path, nrows=nfields)
 
+        partials = {}
         for i, eop_path in enumerate(eop_paths):
                 print(f"Processing eopatch {i+1}/{len(eop_paths)}")
 
@@ -427,9 +770,18 @@ def lai_to_csv_field(eop_paths:list, fields_path:str, outpath:str, nfields:int =
                 print(f"Time taken: {time.time() - start} seconds")
 
                 start = time.time()
-                # 3. For each field, mask the tiff, get median and save timeseries as csv
+                # 3. For each field, mask the tiff, compute the partial aggregates and save the statistics as csv
                 print(f"2. Masking tiff and saving timeseries")
-                field_to_csv(fields, tiff_path, datetimes, outpath, n_jobs=n_jobs)
+                eop_partials = tiff_to_field_partials(fields, tiff_path, datetimes, n_jobs=n_jobs)
+
+                # Keep the partials of the fields that are merged elsewhere
+                if partial_ids is not None:
+                    for field_id in set(partial_ids).intersection(eop_partials):
+                        partial = eop_partials.pop(field_id)
+                        partials[field_id] = merge_field_partials([partials[field_id], partial]) if field_id in partials else partial
+
+                if len(eop_partials) > 0:
+                    write_field_df(partials_to_df(eop_partials, stats), outpath, stats)
                 print(f"Time taken: {time.time() - start} seconds")
                 
                 # 4. Delete the temporary tiff
@@ -437,8 +789,161 @@ def lai_to_csv_field(eop_paths:list, fields_path:str, outpath:str, nfields:int =
                         print(f"4. Deleting temporary tiff")
                         os.remove(tiff_path)
 
+        return partials
 
-def lai_to_csv_field_append(npy_path:str, bbox_path:str, fields_path:str, outpath:str, n_jobs:int=8):
+
+def combine_field_csvs(csv_paths:list, outpath:str):
+    """
+    Combine field csv files with different fields (e.g. of different tiles) into a single field csv, joining them by date.
+    Columns that occur in several files (e.g. of different date ranges) are combined into one.
+    """
+    dfs = []
+    for csv_path in csv_paths:
+        with get_filesystem(csv_path).open(csv_path, "r") as f:
+            dfs.append(pd.read_csv(f, index_col=0, parse_dates=True))
+    df = pd.concat(dfs, axis=1).sort_index()
+    if df.columns.duplicated().any():
+        df = df.T.groupby(level=0, sort=False).first().T
+
+    fs = get_filesystem(outpath)
+    wmode = "w" if not fs.exists(outpath) else "a"
+    df_to_csv_manual(df, outpath, index=True, mode=wmode, header=(wmode=="w"))
+
+
+def cube_field_partials(cube:np.ndarray, row_start:int, window_fields:list, dates:list, bbox, shape:Tuple[int, int]) -> dict:
+    """
+    Compute the partial aggregates of the parts of the given (field id, geometry) fields that fall within a (t, rows, w)
+    band of rows of an image with the given bbox and (h, w) shape, starting at row_start.
+    """
+    h, w = shape
+    row_stop = row_start + cube.shape[1]
+    xmin, ymin, xmax, ymax = list(bbox)
+    res_x, res_y = (xmax - xmin) / w, (ymax - ymin) / h
+
+    partials = {}
+    for field_id, field in window_fields:
+        # Only rasterize the field over its own bounds within the window
+        fxmin, fymin, fxmax, fymax = field.bounds
+        col_start, col_stop = max(0, math.floor((fxmin - xmin) / res_x)), min(w, math.ceil((fxmax - xmin) / res_x))
+        row_min, row_max = max(row_start, math.floor((ymax - fymax) / res_y)), min(row_stop, math.ceil((ymax - fymin) / res_y))
+        if col_stop <= col_start or row_max <= row_min:
+            continue
+
+        transform = from_origin(xmin + col_start * res_x, ymax - row_min * res_y, res_x, res_y)
+        mask = geometry_mask([field], out_shape=(row_max - row_min, col_stop - col_start), transform=transform, invert=True)
+        if not mask.any():
+            continue
+
+        values = cube[:, row_min - row_start:row_max - row_start, col_start:col_stop][:, mask]
+        partials[field_id] = field_partials(values, dates)
+    return partials
+
+
+def window_field_partials(window:Tuple[int, int, list], arrays:list, dates:list, bbox) -> dict:
+    """
+    Compute the partial aggregates of the parts of the given fields that fall within a band of rows of the eopatch.
+    Only the band of rows (with the full time axis) is read from the memory-mapped partitions (see open_eopatch_cube).
+    """
+    row_start, row_stop, window_fields = window
+    cube = read_rows(arrays, row_start, row_stop)
+    return cube_field_partials(cube, row_start, window_fields, dates, bbox, arrays[0].shape[1:3])
+
+
+def assign_fields_to_windows(fields:gpd.GeoDataFrame, bbox, h:int, windows:List[Tuple[int, int]]):
+    """
+    Assign every field to the bands of rows that its bounds overlap.
+    Returns the (row start, row stop, [(field id, geometry)]) bands that hold any field, and the number of bands per field.
+    """
+    ymax, res_y = list(bbox)[3], (list(bbox)[3] - list(bbox)[1]) / h
+    bounds = fields.bounds
+    first_rows = np.clip(np.floor((ymax - bounds.maxy.values) / res_y), 0, h - 1).astype(int)
+    last_rows = np.clip(np.ceil((ymax - bounds.miny.values) / res_y) - 1, 0, h - 1).astype(int)
+    window_starts = np.array([start for start, _ in windows])
+    first_windows = np.searchsorted(window_starts, first_rows, side="right") - 1
+    last_windows = np.searchsorted(window_starts, last_rows, side="right") - 1
+
+    items = [(start, stop, []) for start, stop in windows]
+    for (field_id, field), first, last in zip(fields.geometry.items(), first_windows, last_windows):
+        for i in range(first, last + 1):
+            items[i][2].append((field_id, field))
+    remaining = dict(zip(fields.index, last_windows - first_windows + 1))
+    return items, remaining
+
+
+def collect_field_partials(window_fields:list, partials:dict, pending:dict, remaining:dict, dates:list) -> list:
+    """
+    Collect the partials of the fields of a processed band of rows, and return the (field id, merged partial)
+    of the fields whose last band this was. Fields without any pixel get empty partials.
+    """
+    finished = []
+    for field_id, _ in window_fields:
+        if field_id in partials:
+            pending.setdefault(field_id, []).append(partials[field_id])
+        remaining[field_id] -= 1
+        if remaining[field_id] > 0:
+            continue
+
+        parts = pending.pop(field_id, [])
+        partial = merge_field_partials(parts) if len(parts) > 0 else field_partials(np.zeros((len(dates), 0)), dates)
+        finished.append((field_id, partial))
+    return finished
+
+
+def lai_to_csv_field_windowed(eop_paths:list, outpath:str, fields_path:str = None, fields:gpd.GeoDataFrame = None,
+                              stats:list = DEFAULT_FIELD_STATS, max_ram:int = int(2e9), n_jobs:int = 8, band:str = 'LAI',
+                              partial_ids:list = None, tmpdir:str = None) -> dict:
+    """
+    This function extracts the timeseries of each field like lai_to_csv_field, but without exporting the eopatches to tiff.
+    The eopatch partitions are opened once (memory-mapped, compressed ones decoded into tmpdir, see open_eopatch_cube)
+    and read once, in bands of rows with the full time axis that fit into max_ram together with the bands of the other
+    worker threads. Every band only processes the fields that overlap it; fields that span several bands are combined
+    through their partial aggregates, so the work scales with pixels x dates.
+    The fields in partial_ids are not written; their partial aggregates are returned instead.
+    """
+    stats = check_field_stats(stats)
+
+    if fields is None:
+        fields = load_fields(fields_path)
+
+    dates, arrays, bbox = open_eopatch_cube(eop_paths, band, tmpdir=tmpdir)
+    n_times, (h, w) = len(dates), arrays[0].shape[1:3]
+    windows = get_row_windows((n_times, h, w), arrays[0].dtype.itemsize, max_ram // n_jobs)
+
+    # Make sure the fields are in the same coordinate system as the eopatch and only keep those that intersect it
+    if fields.crs != bbox.crs:
+        fields = fields.to_crs(bbox.crs.ogc_string())
+    fields = fields[fields.intersects(box(*bbox))]
+    if len(fields) == 0:
+        print(f"No fields intersect with the eopatch, skipping")
+        return {}
+
+    items, remaining = assign_fields_to_windows(fields, bbox, h, windows)
+    items = [item for item in items if len(item[2]) > 0]
+
+    print(f"Extracting {len(fields)} fields from {len(items)} bands of rows")
+
+    # Process the bands in batches, so that only the partials of unfinished fields are kept in memory
+    # The workers are threads that share the opened arrays, so that the cube is never opened (or decoded) again
+    pending, out_partials, dfs = {}, {}, []
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for batch_start in tqdm.tqdm(range(0, len(items), n_jobs), desc="Extracting field timeseries"):
+            batch = items[batch_start:batch_start + n_jobs]
+            results = executor.map(window_field_partials, batch, [arrays] * len(batch), [dates] * len(batch), [bbox] * len(batch))
+
+            for (_, _, window_fields), partials in zip(batch, results):
+                for field_id, partial in collect_field_partials(window_fields, partials, pending, remaining, dates):
+                    if partial_ids is not None and field_id in partial_ids:
+                        out_partials[field_id] = partial
+                    else:
+                        dfs.append(partials_to_df({field_id: partial}, stats))
+    del arrays
+
+    if len(dfs) > 0:
+        write_field_df(pd.concat(dfs, axis=0), outpath, stats)
+    return out_partials
+
+
+def lai_to_csv_field_append(npy_path:str, bbox_path:str, fields_path:str, outpath:str, n_jobs:int=8, stats:list = DEFAULT_FIELD_STATS):
     tmp_eop_path = "tmp_eop"
     timestamp = dt.datetime.strptime(os.path.basename(npy_path).replace(".npy",""), "%Y_%m_%d")
 
@@ -452,7 +957,7 @@ def lai_to_csv_field_append(npy_path:str, bbox_path:str, fields_path:str, outpat
     eop.save(tmp_eop_path, overwrite_permission=OverwritePermission.OVERWRITE_FEATURES)
 
     # 2. Process the eopatch with the lai_to_csv_field function
-    lai_to_csv_field([tmp_eop_path], fields_path, outpath=outpath, n_jobs=n_jobs)
+    lai_to_csv_field([tmp_eop_path], fields_path, outpath=outpath, n_jobs=n_jobs, stats=stats)
 
     # 3. Remove the temporarily saved eopatch
     print(f"Removing temporarily saved eopatch")
@@ -2,33 +2,159 @@ from stelar_spatiotemporal.lib import check_types, save_bbox, get_filesystem
 import numpy as np
 import pandas as pd
 import os
+import io
 import glob
+import zipfile
+import datetime as dt
 from sentinelhub import BBox, CRS
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src.preprocessing import get_roi_window
+from src.frames import DEFAULT_MERGE_RULE, save_frame, clear_merge_state
+from src.codec import DEFAULT_CODEC
+
+def read_into(stream, buffer: np.ndarray) -> int:
+    """
+    Fill a numpy buffer with bytes from a (possibly streaming) file object, without intermediate copies.
+    Returns the number of bytes read, which is only smaller than the buffer at the end of the stream.
+    """
+    view = memoryview(buffer).cast('B')
+    n_read = 0
+    while n_read < len(view):
+        n = stream.readinto(view[n_read:])
+        if not n:
+            break
+        n_read += n
+    return n_read
+
+
+def select_frames(timestamps: List[str], start_date: dt.datetime = None, end_date: dt.datetime = None) -> List[int]:
+    """
+    Get the indices of the frames (with YYYY_MM_DD timestamps) that fall within the date range (inclusive).
+    """
+    frames = []
+    for i, ts in enumerate(timestamps):
+        date = dt.datetime.strptime(ts, '%Y_%m_%d')
+        if start_date is not None and date < start_date:
+            continue
+        if end_date is not None and date > end_date:
+            continue
+        frames.append(i)
+    return frames
+
+
+def skip_bytes(stream, n_bytes: int, buffer: np.ndarray):
+    """
+    Skip bytes of a stream, seeking if possible and reading into a scratch buffer otherwise.
+    """
+    if n_bytes == 0:
+        return
+    if stream.seekable():
+        stream.seek(n_bytes, io.SEEK_CUR)
+        return
+
+    view = memoryview(buffer).cast('B')
+    while n_bytes > 0:
+        n = stream.readinto(view[:min(n_bytes, len(view))])
+        if not n:
+            raise ValueError("Could not skip frames, might be out of bounds")
+        n_bytes -= n
+
+
+def unpack_ras_stream(ras_file, outdir:str, timestamps: List[str], img_w: int, img_h: int, name:str = "RAS file",
+                      start_date: dt.datetime = None, end_date: dt.datetime = None, window: Tuple[int, int, int, int] = None,
+                      merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC):
+    """
+    Unpack the images of an open RAS file object (a local file, a MinIO object or a ZIP archive member)
+    and save them as .npy files. The frames are decoded directly into a single reusable buffer.
+    If a date range is given, only the frames within the range are read; since frames have a fixed size,
+    the others are skipped by seeking (a ranged read for MinIO objects).
+    If a pixel window (row offset, column offset, height, width) is given, only the rows of the window are read from each frame.
+    Images of a date that was already unpacked (e.g. from another RAS file) are merged with the merge_rule (see src.frames).
+    The frames are encoded with the given codec (see src.codec).
+    """
+    if window is None:
+        window = (0, 0, img_h, img_w)
+    row_off, col_off, height, width = window
+
+    # Define the data type; each frame is a row-major (img_h, img_w) image, of which we read full rows
+    data_type = np.int16
+    rows = np.empty((height, img_w), dtype=data_type)
+    row_bytes = img_w * rows.itemsize
+    frame_bytes = img_h * row_bytes
+
+    # Read the data in chunks (one chunk of rows per image)
+    frames = select_frames(timestamps, start_date, end_date)
+    n = len(frames)
+    position = 0
+    for j, i in enumerate(frames):
+        start = i * frame_bytes + row_off * row_bytes
+        skip_bytes(ras_file, start - position, rows)
+        if read_into(ras_file, rows) < rows.nbytes:
+            raise ValueError(f"Could not read image {i+1}/{len(timestamps)} of {name}, might be out of bounds")
+        position = start + rows.nbytes
+
+        # Save as .npy
+        print(f"Saving image {j+1}/{n}", end='\r')
+        ts = timestamps[i]
+        save_frame(outdir, ts, rows[:, col_off:col_off+width], rule=merge_rule, codec=codec)
 
-def unpack_ras(ras_path: str, outdir:str, timestamps: List[str], img_w: int, img_h: int):
-    filesystem = get_filesystem(ras_path)
 
-    img_len = img_w*img_h
+def unpack_ras(ras_path: str, outdir:str, timestamps: List[str], img_w: int, img_h: int,
+               start_date: dt.datetime = None, end_date: dt.datetime = None, window: Tuple[int, int, int, int] = None,
+               merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC):
+    filesystem = get_filesystem(ras_path)
 
     with filesystem.open(ras_path, 'rb') as ras_file:
-        # Define the data type and element size
-        data_type = np.int16
-        data_size = np.dtype(data_type).itemsize
+        unpack_ras_stream(ras_file, outdir, timestamps, img_w, img_h, name=ras_path, start_date=start_date, end_date=end_date, window=window,
+                          merge_rule=merge_rule, codec=codec)
+
+
+def parse_rhd(rhd: List[str], rhd_path: str, crs: CRS = CRS('32630')):
+    """
+    Parse the lines of an RHD header into the image dimensions, timestamps and bounding box.
+    """
+    # Get image dimensions from 3rd line
+    try:
+        dims = [int(i) for i in rhd[2].strip().split(" ") if i.isdigit()]
+        img_h, img_w = dims
+    except:
+        raise ValueError(f"Could not get image dimensions from {rhd_path}")
+
+    # Get the bounding box from the 4th line
+    try:
+        fields = [float(i) for i in rhd[3].strip().split(" ") if i != ""]
+        resolution = fields[0]
+        xmin = fields[1]
+        ymax = fields[2]
+        bbox = BBox((xmin, ymax - img_h*resolution, xmin + img_w*resolution, ymax), crs=crs)
+    except:
+        raise ValueError(f"Could not get bounding box from {rhd_path}")
+
+    # Get timestamps from 5+ lines
+    try:
+        lines = rhd[5:]
+
+        # Trip left and right whitespaces
+        lines = [line.strip() for line in lines]
+
+        # Split by whitespaces
+        lines = [line.split() for line in lines]
 
-        # Read the data in chunks (one chunk per image) and load it into a numpy array
-        n = len(timestamps)
-        for i in range(n):
-            chunk = ras_file.read(img_len*data_size)
-            if not chunk:
-                raise ValueError(f"Could not read image {i+1}/{n}, might be out of bounds")
+        # Convert to dataframe
+        times_df = pd.DataFrame(lines)
 
-            img = np.frombuffer(chunk, dtype=data_type).reshape(img_w, img_h)
+        # Join first 3 columns to one datetime string
+        times_df["datetime"] = pd.to_datetime(times_df[1] + '_' + times_df[2] + '_' + times_df[3], format='%Y_%m_%d')
+
+        # Get datetimes
+        timestamps = times_df.datetime.dt.strftime(date_format='%Y_%m_%d').values.tolist()
+    except:
+        raise ValueError(f"Could not get timestamps from {rhd_path}")
+
+    return img_h, img_w, timestamps, bbox
 
-            # Save as .npy
-            print(f"Saving image {i+1}/{n}", end='\r')
-            ts = timestamps[i]
-            np.save(os.path.join(outdir, ts + '.npy'), img)       
 
 def get_rhd_info(rhd_path: str, crs: CRS = CRS('32630')):
     filesystem = get_filesystem(rhd_path)
@@ -36,47 +162,23 @@ def get_rhd_info(rhd_path: str, crs: CRS = CRS('32630')):
     # Read the RHD file
     with filesystem.open(rhd_path, "r") as rhdfile:
         rhd = rhdfile.readlines()
-        # Get image dimensions from 3rd line
-        try:
-            dims = [int(i) for i in rhd[2].strip().split(" ") if i.isdigit()]
-            img_h, img_w = dims
-        except:
-            raise ValueError(f"Could not get image dimensions from {rhd_path}")
-
-        # Get the bounding box from the 4th line
-        try:
-            fields = [float(i) for i in rhd[3].strip().split(" ") if i != ""]
-            resolution = fields[0]
-            xmin = fields[1]
-            ymax = fields[2]
-            bbox = BBox((xmin, ymax - img_h*resolution, xmin + img_w*resolution, ymax), crs=crs)
-        except:
-            raise ValueError(f"Could not get bounding box from {rhd_path}")
-
-        # Get timestamps from 5+ lines
-        try:
-            lines = rhd[5:]
-
-            # Trip left and right whitespaces
-            lines = [line.strip() for line in lines]
-
-            # Split by whitespaces
-            lines = [line.split() for line in lines]
-
-            # Convert to dataframe
-            times_df = pd.DataFrame(lines)
-
-            # Join first 3 columns to one datetime string
-            times_df["datetime"] = pd.to_datetime(times_df[1] + '_' + times_df[2] + '_' + times_df[3], format='%Y_%m_%d')
-
-            # Get datetimes
-            timestamps = times_df.datetime.dt.strftime(date_format='%Y_%m_%d').values.tolist()
-        except:
-            raise ValueError(f"Could not get timestamps from {rhd_path}")
-        
-    return img_h, img_w, timestamps, bbox
 
-def unpack_vista_unzipped(ras_path: str, rhd_path:str, outdir:str, delete_after:bool = False, crs:CRS = CRS('32630')):
+    return parse_rhd(rhd, rhd_path, crs=crs)
+
+
+def get_ras_window(img_h: int, img_w: int, bbox: BBox, roi: tuple = None):
+    """
+    Get the pixel window and bbox of the part of a RAS image within the region of interest (or the full image).
+    """
+    if roi is None:
+        return None, bbox
+    row_off, col_off, height, width, window_bbox = get_roi_window(bbox, img_h, img_w, roi)
+    return (row_off, col_off, height, width), window_bbox
+
+
+def unpack_vista_unzipped(ras_path: str, rhd_path:str, outdir:str, delete_after:bool = False, crs:CRS = CRS('32630'),
+                          start_date: dt.datetime = None, end_date: dt.datetime = None, roi: tuple = None,
+                          merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC):
     if outdir.startswith("s3://"):
         raise ValueError("outdir must be a local directory")
 
@@ -86,13 +188,17 @@ def unpack_vista_unzipped(ras_path: str, rhd_path:str, outdir:str, delete_after:
     # Get image dimensions and timestamps from RHD
     img_h, img_w, timestamps, bbox = get_rhd_info(rhd_path, crs=crs)
 
+    # Only read the part of the images within the region of interest
+    window, bbox = get_ras_window(img_h, img_w, bbox, roi)
+
     # Save bbox separately 
     bbox_path = os.path.join(outdir, 'bbox.pkl')
     save_bbox(bbox, bbox_path)
 
     # Unpack all images from ras file and save as .npy files
     print(f"Unpacking {len(timestamps)} images from {ras_path}")
-    unpack_ras(ras_path, outdir, timestamps, img_w, img_h)
+    unpack_ras(ras_path, outdir, timestamps, img_w, img_h, start_date=start_date, end_date=end_date, window=window, merge_rule=merge_rule,
+               codec=codec)
 
     # Delete RAS and RHD files
     if delete_after:
@@ -101,29 +207,118 @@ def unpack_vista_unzipped(ras_path: str, rhd_path:str, outdir:str, delete_after:
         os.remove(rhd_path)
 
     
-def unpack_vista(datadir: str, bands: list = ['B2', 'B3', 'B4', 'B8A'], delete_ras:bool = True):
+def get_zip_ras_pairs(archive: zipfile.ZipFile, zip_path: str) -> List[Tuple[str, str]]:
+    """
+    Get the (RAS, RHD) member pairs of a ZIP archive.
+    """
+    members = archive.namelist()
+    rhd_members = set(m for m in members if m.endswith(".RHD"))
+
+    pairs = []
+    for ras_member in sorted(m for m in members if m.endswith(".RAS")):
+        rhd_member = ras_member[:-len(".RAS")] + ".RHD"
+        if rhd_member not in rhd_members:
+            raise FileNotFoundError(f"RHD file {rhd_member} not found in {zip_path}")
+        pairs.append((ras_member, rhd_member))
+    return pairs
+
+
+def unpack_vista_zip(zip_path: str, outdir: str, crs: CRS = CRS('32630'),
+                     start_date: dt.datetime = None, end_date: dt.datetime = None, roi: tuple = None,
+                     members: List[str] = None, merge_rule: str = DEFAULT_MERGE_RULE,
+                     codec: str = DEFAULT_CODEC):
+    """
+    Unpack all RAS files of a (local or MinIO) ZIP archive without extracting the archive to disk.
+    Only the central directory and the required members are read; stored members are read as plain byte ranges
+    and deflated members are decompressed while streaming. If members is given, only those RAS members are unpacked.
+    """
+    if outdir.startswith("s3://"):
+        raise ValueError("outdir must be a local directory")
+
+    # Create output directory
+    os.makedirs(outdir, exist_ok=True)
+
+    filesystem = get_filesystem(zip_path)
+    with filesystem.open(zip_path, 'rb') as zip_file, zipfile.ZipFile(zip_file) as archive:
+        for ras_member, rhd_member in get_zip_ras_pairs(archive, zip_path):
+            if members is not None and ras_member not in members:
+                continue
+
+            # Get image dimensions and timestamps from RHD
+            with archive.open(rhd_member) as rhdfile:
+                rhd = io.TextIOWrapper(rhdfile).readlines()
+            img_h, img_w, timestamps, bbox = parse_rhd(rhd, f"{zip_path}/{rhd_member}", crs=crs)
+
+            # Only read the part of the images within the region of interest
+            window, bbox = get_ras_window(img_h, img_w, bbox, roi)
+
+            # Save bbox separately
+            save_bbox(bbox, os.path.join(outdir, 'bbox.pkl'))
+
+            # Stream all images from the RAS member into .npy files
+            print(f"Unpacking {len(timestamps)} images from {zip_path}/{ras_member}")
+            with archive.open(ras_member) as ras_file:
+                unpack_ras_stream(ras_file, outdir, timestamps, img_w, img_h, name=f"{zip_path}/{ras_member}",
+                                  start_date=start_date, end_date=end_date, window=window, merge_rule=merge_rule,
+                                  codec=codec)
+
+
+def unpack_vista_band(datadir: str, band: str, outdir: str, delete_ras:bool = True, crs:CRS = CRS('32630'),
+                      start_date: dt.datetime = None, end_date: dt.datetime = None, roi: tuple = None,
+                      merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC) -> str:
+    """
+    Unpack all RAS files of a single band into outdir/<band>, with the same date range, region of interest,
+    merge rule and codec options as unpack_vista_unzipped.
+    The RAS files are streamed directly from the band's ZIP archive, unless the band was already unzipped.
+    Returns the directory with the .npy files of the band.
+    """
+    band_dir = os.path.join(datadir, band)
+    band_outdir = os.path.join(outdir, band)
+    options = dict(start_date=start_date, end_date=end_date, roi=roi, merge_rule=merge_rule, codec=codec)
+    if not os.path.exists(band_dir):
+        # Read the band directly from its archive
+        print(f"Reading {band} from its archive")
+        unpack_vista_zip(os.path.join(datadir, f'{band}.zip'), band_outdir, crs=crs, **options)
+        clear_merge_state(band_outdir)
+        return band_outdir
+
+    print(f"Band {band} already unzipped")
+
+    # Unpack all RAS files into the band's own directory
+    ras_paths = glob.glob(os.path.join(band_dir, "*.RAS"))
+    for ras_path in ras_paths:
+        # Check if RHD variant also exists
+        rhd_path = ras_path.replace('.RAS', '.RHD')
+        if not os.path.exists(rhd_path):
+            raise FileNotFoundError(f"RHD file {rhd_path} not found")
+        unpack_vista_unzipped(ras_path, rhd_path, band_outdir, delete_after=delete_ras, crs=crs, **options)
+    clear_merge_state(band_outdir)
+    return band_outdir
+
+
+def unpack_vista(datadir: str, outdir: str = None, bands: list = ['B2', 'B3', 'B4', 'B8A'], delete_ras:bool = True,
+                 crs:CRS = CRS('32630'), n_jobs:int = None, start_date: dt.datetime = None, end_date: dt.datetime = None,
+                 roi: tuple = None, merge_rule: str = DEFAULT_MERGE_RULE, codec: str = DEFAULT_CODEC) -> Dict[str, str]:
+    """
+    Unpack the band archives of a VISTA data directory concurrently, see unpack_vista_band.
+    The .npy files of every band are written to their own directory outdir/<band>, so that the bands can be
+    combined into a single eopatch with one data feature per band (see combine_band_npys_into_eopatches).
+    Returns a dict mapping each band to its directory.
+    """
+    if outdir is None:
+        outdir = os.path.join(datadir, "npys")
+
     # Check if all bands are present
     for band in bands:
         if not os.path.exists(os.path.join(datadir, f"{band}.zip")):
             raise FileNotFoundError(f"Band {band} missing in {datadir}")
-        
-    for band in bands:
-        # Skip if already unzipped
-        if os.path.exists(os.path.join(datadir, band)):
-            print(f"Band {band} already unzipped")
-        else:
-            # Unzip band
-            print(f"Unzipping {band}")
-            os.system(f"unzip {os.path.join(datadir, f'{band}.zip')} -d {os.path.join(datadir, band)}")
-
-        # Unpack all RAS files
-        ras_paths = glob.glob(os.ath.join(datadir, band, "*.RAS"))
-        for ras_path in ras_paths:
-            # Check if RHD variant also exists
-            rhd_path = ras_path.replace('.RAS', '.RHD')
-            if not os.path.exists(rhd_path):
-                raise FileNotFoundError(f"RHD file {rhd_path} not found")
-            unpack_vista_unzipped(ras_path, rhd_path, delete_after=delete_ras)
+
+    # Unpack the bands in parallel; the work is dominated by file I/O
+    n_jobs = len(bands) if n_jobs is None else n_jobs
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {band: executor.submit(unpack_vista_band, datadir, band, outdir, delete_ras, crs, start_date=start_date,
+                                         end_date=end_date, roi=roi, merge_rule=merge_rule, codec=codec) for band in bands}
+        return {band: future.result() for band, future in futures.items()}
 
 
 def get_scl_from_lai(lai_path: str):
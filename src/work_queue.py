@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import List
+
+# Shards whose worker did not renew its claim within this many seconds are handed out again
+DEFAULT_LEASE = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS task (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    spec TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    shard_id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+"""
+
+
+@contextmanager
+def connect(queue_path:str):
+    """
+    Open a work queue: a SQLite database that stands in for a durable queue service.
+    With workers on several nodes, it should be on a shared filesystem with working file locks.
+    Every statement runs in autocommit mode unless it is part of an explicit transaction.
+    """
+    conn = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def create_queue(queue_path:str, task:dict, shards:List[dict]):
+    """
+    Write a task and its shards (dicts with a unique 'shard_id') to a work queue.
+    If the queue already exists for the same task, shards that are already in it keep their status, so that
+    planning again after a failure does not redo the finished shards.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+    with connect(queue_path) as conn:
+        conn.executescript(SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT spec FROM task").fetchone()
+        if row is not None and json.loads(row["spec"]) != task:
+            conn.execute("ROLLBACK")
+            raise ValueError(f"Work queue {queue_path} belongs to another task; remove it or choose another path")
+
+        conn.execute("INSERT OR IGNORE INTO task (id, spec, created) VALUES (0, ?, ?)", (json.dumps(task), time.time()))
+        conn.executemany("INSERT OR IGNORE INTO shards (shard_id, position, spec) VALUES (?, ?, ?)",
+                         [(shard["shard_id"], i, json.dumps(shard)) for i, shard in enumerate(shards)])
+        conn.execute("COMMIT")
+
+
+def load_task(queue_path:str) -> dict:
+    if not os.path.exists(queue_path):
+        raise ValueError(f"No work queue found at {queue_path}")
+    with connect(queue_path) as conn:
+        row = conn.execute("SELECT spec, created FROM task").fetchone()
+    return dict(spec=json.loads(row["spec"]), created=row["created"])
+
+
+def claim_shard(queue_path:str, worker:str, lease:float = DEFAULT_LEASE, max_attempts:int = DEFAULT_MAX_ATTEMPTS) -> dict:
+    """
+    Claim the next pending shard for a worker, or a shard whose worker let its lease expire (e.g. because its node died).
+    Returns the spec of the shard, or None if there is nothing to claim.
+    """
+    now = time.time()
+    with connect(queue_path) as conn:
+        # The write lock is taken before reading, so that two workers never claim the same shard
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("""
+            SELECT shard_id, spec FROM shards
+            WHERE (status = 'pending' OR (status = 'running' AND claimed < ?)) AND attempts < ?
+            ORDER BY position LIMIT 1
+        """, (now - lease, max_attempts)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute("UPDATE shards SET status = 'running', worker = ?, attempts = attempts + 1, claimed = ? WHERE shard_id = ?",
+                     (worker, now, row["shard_id"]))
+        conn.execute("COMMIT")
+    return json.loads(row["spec"])
+
+
+def renew_lease(queue_path:str, shard_id:str, worker:str) -> bool:
+    """
+    Renew the claim of a worker on a shard; returns False if the shard was handed to another worker in the meantime.
+    """
+    with connect(queue_path) as conn:
+        cursor = conn.execute("UPDATE shards SET claimed = ? WHERE shard_id = ? AND worker = ? AND status = 'running'",
+                              (time.time(), shard_id, worker))
+    return cursor.rowcount > 0
+
+
+def complete_shard(queue_path:str, shard_id:str, worker:str, result:dict):
+    with connect(queue_path) as conn:
+        conn.execute("UPDATE shards SET status = 'done', finished = ?, result = ?, error = NULL WHERE shard_id = ? AND worker = ?",
+                     (time.time(), json.dumps(result), shard_id, worker))
+
+
+def fail_shard(queue_path:str, shard_id:str, worker:str, error:str, max_attempts:int = DEFAULT_MAX_ATTEMPTS):
+    """
+    Record the failure of a shard; it is handed out again until it failed max_attempts times.
+    """
+    with connect(queue_path) as conn:
+        conn.execute("""
+            UPDATE shards SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, finished = ?, error = ?
+            WHERE shard_id = ? AND worker = ?
+        """, (max_attempts, time.time(), error, shard_id, worker))
+
+
+def get_queue_status(queue_path:str, lease:float = DEFAULT_LEASE, max_attempts:int = DEFAULT_MAX_ATTEMPTS) -> dict:
+    """
+    Count the shards per status; running shards whose lease expired count as pending again
+    (or as failed, if they cannot be retried).
+    """
+    with connect(queue_path) as conn:
+        rows = conn.execute("""
+            SELECT CASE
+                WHEN status = 'running' AND claimed < ? AND attempts < ? THEN 'pending'
+                WHEN status = 'running' AND claimed < ? THEN 'failed'
+                ELSE status END AS state, COUNT(*) AS n
+            FROM shards GROUP BY state
+        """, (time.time() - lease, max_attempts, time.time() - lease)).fetchall()
+    status = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+    status.update({row["state"]: row["n"] for row in rows})
+    return status
+
+
+def load_shards(queue_path:str) -> List[dict]:
+    """
+    Load the shards of a queue in planning order, with their status, result and error.
+    """
+    with connect(queue_path) as conn:
+        rows = conn.execute("SELECT * FROM shards ORDER BY position").fetchall()
+    shards = []
+    for row in rows:
+        shard = dict(row)
+        shard["spec"] = json.loads(shard["spec"])
+        shard["result"] = json.loads(shard["result"]) if shard["result"] is not None else None
+        shards.append(shard)
+    return shards
@@ -0,0 +1,134 @@
+import zipfile
+import datetime as dt
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+pytest.importorskip("sentinelhub")
+pytest.importorskip("rasterio")
+
+from src import catalog
+from src.catalog import find_tile_name, get_tile_crs, update_catalog, validate_alignment, group_by_tile, group_by_band, \
+    get_image_band, estimate_resources, record_run
+
+
+def make_rhd(h:int = 6, w:int = 5, timestamps=("2022_01_01", "2022_01_06"), xmin:float = 500000.0, ymax:float = 4800000.0) -> str:
+    lines = ["RHD", "LAI", f"{h} {w}", f"10.0 {xmin} {ymax}", "dates"]
+    lines += [f"{i} {ts.replace('_', ' ')}" for i, ts in enumerate(timestamps)]
+    return "\n".join(lines) + "\n"
+
+
+def test_get_tile_crs():
+    assert find_tile_name("/data/T30TXM/LAI.RHD") == "T30TXM"
+    assert find_tile_name("/data/T30TXM/LAI_T31TCJ.RHD") == "T31TCJ"
+    assert find_tile_name("/data/LAI.RHD") is None
+
+    assert get_tile_crs("/data/LAI_T30TXM.RHD").epsg == 32630
+    assert get_tile_crs("s3://bucket/T05NQF/B4.zip/LAI.RHD").epsg == 32605
+    assert get_tile_crs("/data/LAI_T56HLH.RHD").epsg == 32756
+    with pytest.raises(ValueError):
+        get_tile_crs("/data/LAI.RHD")
+    with pytest.raises(ValueError):
+        get_tile_crs("/data/LAI_T61TXM.RHD")
+
+
+def test_scan_crs(tmp_path):
+    catalog_path = str(tmp_path / "catalog.json")
+    rhd_path = tmp_path / "LAI_T56HLH.RHD"
+    rhd_path.write_text(make_rhd())
+    zip_path = tmp_path / "T31TCJ_B4.zip"
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        archive.writestr("LAI.RAS", b"")
+        archive.writestr("LAI.RHD", make_rhd())
+
+    images = update_catalog([str(rhd_path), str(zip_path)], catalog_path=catalog_path)
+    assert [image["crs"] for image in images] == [32756, 32631]
+
+    # RAS files without a tile name have an unknown crs
+    unknown_path = tmp_path / "LAI.RHD"
+    unknown_path.write_text(make_rhd())
+    with pytest.raises(ValueError):
+        update_catalog([str(unknown_path)], catalog_path=catalog_path)
+
+
+def make_image(name:str, xmin:float = 500000.0, ymax:float = 4800000.0, shape=(6, 5), crs:int = 32630,
+               dates=("2022_01_01", "2022_01_06")) -> dict:
+    return {"name": name, "file": name, "bbox": [xmin, ymax - 10 * shape[0], xmin + 10 * shape[1], ymax], "crs": crs,
+            "shape": list(shape), "dtype": "int16", "dates": list(dates), "size": 2 * shape[0] * shape[1] * len(dates)}
+
+
+def test_update_catalog_rescans_modified_files(tmp_path, monkeypatch):
+    catalog_path = str(tmp_path / "catalog.json")
+    rhd_path = tmp_path / "LAI_T30TXM.RHD"
+    rhd_path.write_text(make_rhd())
+
+    scanned = []
+    scan_file = catalog.scan_file
+    monkeypatch.setattr(catalog, "scan_file", lambda path: scanned.append(path) or scan_file(path))
+
+    images = update_catalog([str(rhd_path)], catalog_path=catalog_path, infos={str(rhd_path): {"ETag": '"a"', "size": 10}})
+    assert images[0]["name"] == str(tmp_path / "LAI_T30TXM.RAS")
+    assert images[0]["shape"] == [6, 5] and images[0]["dates"] == ["2022_01_01", "2022_01_06"]
+    assert images[0]["bbox"] == [500000.0, 4799940.0, 500050.0, 4800000.0]
+    assert images[0]["size"] == 2 * 6 * 5 * 2
+
+    # The header is only read again once its ETag changes
+    update_catalog([str(rhd_path)], catalog_path=catalog_path, infos={str(rhd_path): {"ETag": '"a"', "size": 10}})
+    assert len(scanned) == 1
+    rhd_path.write_text(make_rhd(timestamps=("2022_01_01",)))
+    images = update_catalog([str(rhd_path)], catalog_path=catalog_path, infos={str(rhd_path): {"ETag": '"b"', "size": 10}})
+    assert len(scanned) == 2 and images[0]["dates"] == ["2022_01_01"]
+
+
+def test_validate_alignment():
+    validate_alignment([make_image("a"), make_image("b", xmin=500000.01)])
+    with pytest.raises(ValueError):
+        validate_alignment([make_image("a"), make_image("b", crs=32631)])
+    with pytest.raises(ValueError):
+        validate_alignment([make_image("a"), make_image("b", shape=(6, 6))])
+    with pytest.raises(ValueError):
+        validate_alignment([make_image("a"), make_image("b", xmin=500005.0)])
+
+
+def test_group_by_tile():
+    images = [make_image("LAI_T30TXM_1.RAS"), make_image("LAI_T30TXM_2.RAS"),
+              make_image("LAI_T30TYM.RAS", xmin=500040.0), make_image("LAI_T31TCJ.RAS", crs=32631)]
+    tiles = group_by_tile(images)
+    assert list(tiles.keys()) == ["T30TXM", "T30TYM", "T31TCJ"]
+    assert [image["name"] for image in tiles["T30TXM"]] == ["LAI_T30TXM_1.RAS", "LAI_T30TXM_2.RAS"]
+
+    # Images without a tile name are named after their crs and corner
+    assert list(group_by_tile([make_image("a.RAS")]).keys()) == ["EPSG32630_500000_4800000"]
+
+    # The same tile shifted by part of a pixel is rejected instead of run as a separate tile
+    with pytest.raises(ValueError):
+        group_by_tile([make_image("a.RAS"), make_image("b.RAS", xmin=500006.0)])
+
+
+def test_group_by_band():
+    images = [make_image("/data/B4/a.RAS"), make_image("/data/B2.zip/a.RAS"), make_image("/data/B4/b.RAS")]
+    groups = group_by_band(images, ["B2", "B4"])
+    assert [[image["name"] for image in groups[band]] for band in ["B2", "B4"]] == [["/data/B2.zip/a.RAS"], ["/data/B4/a.RAS", "/data/B4/b.RAS"]]
+
+    with pytest.raises(ValueError):
+        group_by_band(images, ["B2", "B4", "B8A"])
+    with pytest.raises(ValueError):
+        get_image_band(make_image("/data/a.RAS"), ["B2", "B4"])
+
+
+def test_estimate_resources(tmp_path):
+    catalog_path = str(tmp_path / "catalog.json")
+    images = [make_image("a", dates=("2022_01_01", "2022_01_06")), make_image("b", dates=("2022_01_06", "2022_01_11"))]
+
+    estimates = estimate_resources(images, start_date=dt.datetime(2022, 1, 6), catalog_path=catalog_path)
+    assert estimates["number_of_dates"] == 2
+    assert estimates["number_of_values"] == 2 * 6 * 5
+    assert estimates["cube_bytes"] == 2 * 6 * 5 * 2
+    assert estimates["read_bytes"] == 3 * 6 * 5 * 2
+    assert estimates["runtime_seconds"] is None
+
+    # Only the rows and columns within the roi are read
+    estimates = estimate_resources(images, roi=(500000.0, 4799960.0, 500020.0, 4800000.0), catalog_path=catalog_path)
+    assert estimates["number_of_values"] == 3 * 4 * 2
+
+    record_run(1000, 2.0, catalog_path=catalog_path)
+    assert estimate_resources(images, catalog_path=catalog_path)["runtime_seconds"] == pytest.approx(3 * 6 * 5 / 500)
@@ -0,0 +1,70 @@
+import json
+import zlib
+import numpy as np
+import pytest
+
+from src.codec import CODECS, FRAME_MAGIC, FRAME_BAND_ROWS, parse_codec, check_codec, get_eopatch_compress_level, \
+    save_frame_file, load_frame_file, load_frame_rows, is_encoded_frame
+
+
+def make_frame(h=FRAME_BAND_ROWS * 2 + 37, w=19, seed=0):
+    return np.random.default_rng(seed).integers(-1, 100, (h, w)).astype(np.int16)
+
+
+def test_parse_codec():
+    assert parse_codec(None) == ("none", 0)
+    assert parse_codec("GZIP") == ("gzip", 6)
+    assert parse_codec("gzip:1") == ("gzip", 1)
+    assert check_codec("gzip") == "gzip:6"
+    assert check_codec("none") == "none"
+    assert get_eopatch_compress_level("gzip:2") == 2
+    for codec in ["bogus", "gzip:fast"]:
+        with pytest.raises(ValueError):
+            parse_codec(codec)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_frame_round_trip(tmp_path, codec):
+    try:
+        parse_codec(codec)
+    except ValueError:
+        pytest.skip(f"The package of codec {codec} is not installed")
+
+    frame = make_frame()
+    path = str(tmp_path / "2022_01_01.npy")
+    save_frame_file(path, frame, codec)
+    assert is_encoded_frame(path) == (codec != "none")
+
+    loaded = load_frame_file(path)
+    assert loaded.dtype == frame.dtype
+    np.testing.assert_array_equal(loaded, frame)
+
+    for start, stop in [(0, 1), (FRAME_BAND_ROWS - 1, FRAME_BAND_ROWS + 1), (100, 400), (500, 10000), (0, None)]:
+        np.testing.assert_array_equal(load_frame_rows(path, start, stop), frame[start:stop])
+    assert load_frame_rows(path, 600, 700).shape == (0, frame.shape[1])
+
+
+def test_rows_only_decode_their_bands(tmp_path, monkeypatch):
+    import src.codec
+    decoded = []
+    decode = src.codec.decode
+    monkeypatch.setattr(src.codec, "decode", lambda payload, name: decoded.append(name) or decode(payload, name))
+
+    frame = make_frame()
+    path = str(tmp_path / "2022_01_01.npy")
+    save_frame_file(path, frame, "gzip")
+    for start in range(0, frame.shape[0], FRAME_BAND_ROWS):
+        load_frame_rows(path, start, start + FRAME_BAND_ROWS)
+    assert len(decoded) == 3
+
+
+def test_single_block_frames(tmp_path):
+    # Frames encoded as a single block by earlier versions are still read
+    frame = make_frame(seed=1)
+    header = json.dumps({"codec": "gzip", "dtype": frame.dtype.str, "shape": list(frame.shape)}).encode()
+    path = str(tmp_path / "2022_01_01.npy")
+    with open(path, "wb") as f:
+        f.write(FRAME_MAGIC + len(header).to_bytes(4, "little") + header + zlib.compress(frame.tobytes()))
+
+    np.testing.assert_array_equal(load_frame_file(path), frame)
+    np.testing.assert_array_equal(load_frame_rows(path, 300, 310), frame[300:310])
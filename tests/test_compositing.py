@@ -0,0 +1,52 @@
+import os
+import datetime as dt
+import numpy as np
+import pytest
+
+from src.codec import save_frame_file, load_frame_file
+from src.compositing import COMPOSITE_ANCHOR, check_composite, get_period_start, group_dates_by_period, \
+    composite_frames, composite_npys
+
+STACK = np.array([
+    [[1, -1, -1, 4]],
+    [[3, 2, -1, -1]],
+    [[2, -1, -2, 6]],
+], dtype=np.int16)
+
+
+def test_check_composite():
+    check_composite(10, "median")
+    for period_days, rule in [(0, "max"), ("10", "max"), (2.5, "max"), (True, "max"), (10, "mean")]:
+        with pytest.raises(ValueError):
+            check_composite(period_days, rule)
+
+
+def test_periods():
+    assert get_period_start(COMPOSITE_ANCHOR, 10) == COMPOSITE_ANCHOR
+    assert get_period_start(dt.datetime(2000, 1, 25), 10) == dt.datetime(2000, 1, 21)
+    assert get_period_start(dt.datetime(1999, 12, 31), 10) == dt.datetime(1999, 12, 22)
+
+    dates = [dt.datetime(2000, 1, 12), dt.datetime(2000, 1, 2), dt.datetime(2000, 1, 21), dt.datetime(2000, 1, 5)]
+    assert group_dates_by_period(dates, 10) == {
+        dt.datetime(2000, 1, 1): [1, 3],
+        dt.datetime(2000, 1, 11): [0],
+        dt.datetime(2000, 1, 21): [2],
+    }
+
+
+def test_composite_frames():
+    np.testing.assert_array_equal(composite_frames(STACK, "max"), [[3, 2, -1, 6]])
+    np.testing.assert_array_equal(composite_frames(STACK, "last"), [[2, 2, -1, 6]])
+    np.testing.assert_array_equal(composite_frames(STACK, "median"), [[2, 2, -1, 5]])
+    np.testing.assert_array_equal(composite_frames(STACK[:1], "median"), STACK[0])
+
+
+def test_composite_npys(tmp_path):
+    names = ["2000_01_02", "2000_01_05", "2000_01_09", "2000_01_12"]
+    for name, frame in zip(names, [STACK[0], STACK[1], STACK[2], STACK[0]]):
+        save_frame_file(str(tmp_path / f"{name}.npy"), frame, "gzip")
+
+    assert composite_npys(str(tmp_path), 10, rule="median", codec="gzip") == 2
+    assert sorted(os.listdir(tmp_path)) == ["2000_01_01.npy", "2000_01_11.npy"]
+    np.testing.assert_array_equal(load_frame_file(str(tmp_path / "2000_01_01.npy")), composite_frames(STACK, "median"))
+    np.testing.assert_array_equal(load_frame_file(str(tmp_path / "2000_01_11.npy")), STACK[0])
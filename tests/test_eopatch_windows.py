@@ -0,0 +1,51 @@
+import io
+import gzip
+import numpy as np
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+
+from src import eopatch_windows
+from src.eopatch_windows import decode_feature, get_row_windows, read_rows
+
+
+def write_gz_feature(path:str, arr:np.ndarray, truncate:int = 0):
+    buf = io.BytesIO()
+    np.save(buf, arr)
+    data = buf.getvalue()
+    with gzip.open(path, "wb") as f:
+        f.write(data[:len(data) - truncate])
+
+
+def test_decode_feature(tmp_path, monkeypatch):
+    arr = np.random.default_rng(0).integers(-1, 80, (7, 30, 20, 1)).astype(np.int16)
+    gz_path = str(tmp_path / "LAI.npy.gz")
+    write_gz_feature(gz_path, arr)
+
+    # Decode in several small chunks
+    monkeypatch.setattr(eopatch_windows, "DECODE_CHUNK_BYTES", 1000)
+    tmpdir = tmp_path / "tmp"
+    tmpdir.mkdir()
+    decoded = decode_feature(gz_path, str(tmpdir))
+    assert isinstance(decoded, np.memmap)
+    np.testing.assert_array_equal(decoded, arr)
+    # The temporary file is unlinked right away
+    assert list(tmpdir.iterdir()) == []
+
+
+def test_decode_truncated_feature(tmp_path):
+    gz_path = str(tmp_path / "LAI.npy.gz")
+    write_gz_feature(gz_path, np.zeros((3, 4, 5, 1), dtype=np.int16), truncate=10)
+    with pytest.raises(ValueError):
+        decode_feature(gz_path, str(tmp_path))
+
+
+def test_row_windows():
+    # Two rows of 3 dates x 5 int16 columns fit into 60 bytes
+    assert get_row_windows((3, 5, 5), 2, 60) == [(0, 2), (2, 4), (4, 5)]
+    assert get_row_windows((3, 5, 5), 2, 1) == [(r, r + 1) for r in range(5)]
+
+    arrays = [np.arange(2 * 5 * 4).reshape(2, 5, 4, 1), np.arange(5 * 4).reshape(1, 5, 4, 1)]
+    rows = read_rows(arrays, 1, 3)
+    assert rows.shape == (3, 2, 4)
+    np.testing.assert_array_equal(rows[2], arrays[1][0, 1:3, :, 0])
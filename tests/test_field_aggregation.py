@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from src.field_aggregation import DEFAULT_FIELD_STATS, check_field_stats, field_stat_column, field_partials, \
+    merge_field_partials, finalize_field_partials
+
+STATS = ["median", "p10", "p97.5", "mean", "std", "min", "max", "count", "valid_fraction", "cloud_fraction"]
+
+
+def make_field(n_times=6, n_pixels=300, seed=0):
+    rng = np.random.default_rng(seed)
+    arr = rng.integers(1, 80, (n_times, n_pixels)).astype(np.int16)
+    # Nodata (0) and clouds (negative) are invalid
+    arr[rng.random(arr.shape) < 0.3] = 0
+    arr[rng.random(arr.shape) < 0.1] = -1
+    # A fully cloudy date
+    arr[2] = -1
+    dates = np.arange(np.datetime64("2022-01-01"), np.datetime64("2022-01-01") + n_times)
+    return arr, dates
+
+
+def reference_stats(arr):
+    expected = {s: [] for s in STATS}
+    for row in arr:
+        valid = row[row > 0].astype(np.float64)
+        empty = len(valid) == 0
+        expected["median"].append(np.nan if empty else np.percentile(valid, 50))
+        expected["p10"].append(np.nan if empty else np.percentile(valid, 10))
+        expected["p97.5"].append(np.nan if empty else np.percentile(valid, 97.5))
+        expected["mean"].append(np.nan if empty else valid.mean())
+        expected["std"].append(np.nan if empty else valid.std())
+        expected["min"].append(np.nan if empty else valid.min())
+        expected["max"].append(np.nan if empty else valid.max())
+        expected["count"].append(len(valid))
+        expected["valid_fraction"].append(len(valid) / len(row))
+        expected["cloud_fraction"].append(1 - len(valid) / len(row))
+    return {s: np.array(v, dtype=np.float64) for s, v in expected.items()}
+
+
+def assert_stats_equal(result, expected):
+    assert list(result) == list(expected)
+    for stat in expected:
+        np.testing.assert_allclose(result[stat].astype(np.float64), expected[stat], equal_nan=True, err_msg=stat)
+
+
+def test_check_field_stats():
+    assert check_field_stats("median") == ["median"]
+    assert check_field_stats(["p10", "mean", "p10", "p97.5", "p100"]) == ["p10", "mean", "p97.5", "p100"]
+    for stats in [None, [], ["mode"], ["p101"], ["p-1"]]:
+        with pytest.raises(ValueError):
+            check_field_stats(stats)
+
+
+def test_field_stat_column():
+    assert field_stat_column(7, "median", DEFAULT_FIELD_STATS) == 7
+    assert field_stat_column(7, "median", ["median", "p10"]) == "7_median"
+
+
+def test_partials_match_numpy():
+    arr, dates = make_field()
+    result = finalize_field_partials(field_partials(arr, dates), STATS)
+    assert_stats_equal(result, reference_stats(arr))
+    assert result["count"][2] == 0 and np.isnan(result["median"][2])
+
+
+def test_merged_partials_match_numpy():
+    arr, dates = make_field(seed=1)
+
+    # Split the pixels of the field into uneven parts, e.g. the parts of a field in several tiles or windows
+    bounds = [0, 1, 120, 121, 300]
+    partials = [field_partials(arr[:, start:stop], dates) for start, stop in zip(bounds[:-1], bounds[1:])]
+    result = finalize_field_partials(merge_field_partials(partials), STATS)
+    assert_stats_equal(result, reference_stats(arr))
+
+
+def test_merge_partials_with_different_dates():
+    arr, dates = make_field(n_times=8, seed=2)
+
+    # One part only covers the first dates, the other one the last dates, and they share the dates in between
+    left = field_partials(arr[:6, :100], dates[:6])
+    right = field_partials(arr[3:, 100:], dates[3:])
+    merged = merge_field_partials([right, left])
+    np.testing.assert_array_equal(merged["dates"], dates)
+
+    result = finalize_field_partials(merged, ["median", "count"])
+    for t in range(len(dates)):
+        values = np.concatenate([arr[t, :100] if t < 6 else [], arr[t, 100:] if t >= 3 else []])
+        valid = values[values > 0]
+        assert result["count"][t] == len(valid)
+        np.testing.assert_allclose(result["median"][t], np.percentile(valid, 50) if len(valid) > 0 else np.nan, equal_nan=True)
+
+
+def test_empty_field():
+    arr = np.zeros((3, 0), dtype=np.int16)
+    dates = np.arange(np.datetime64("2022-01-01"), np.datetime64("2022-01-04"))
+    result = finalize_field_partials(field_partials(arr, dates), ["median", "count", "valid_fraction"])
+    np.testing.assert_array_equal(result["count"], [0, 0, 0])
+    assert np.isnan(result["median"]).all() and np.isnan(result["valid_fraction"]).all()
+
+
+@pytest.mark.parametrize("scale", [1, 400])
+def test_histogram_keeps_dtype(scale):
+    # A wide value range is counted over the unique keys instead of a dense grid
+    arr, dates = make_field(seed=3)
+    arr = np.where(arr > 0, arr * scale, arr).astype(np.int16)
+    partials = [field_partials(arr[:, :150], dates), field_partials(arr[:, 150:], dates), field_partials(np.zeros((len(dates), 0)), dates)]
+    merged = merge_field_partials(partials)
+    assert merged["hist_values"].dtype == np.int16 and merged["hist_counts"].dtype == np.int64
+    assert_stats_equal(finalize_field_partials(merged, STATS), reference_stats(arr))
+
+    # Float values (e.g. from float TIF images) are sorted instead
+    result = finalize_field_partials(field_partials(arr.astype(np.float32) / 10, dates), STATS)
+    assert_stats_equal(result, reference_stats(arr.astype(np.float32) / 10))
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+
+from src.codec import load_frame_file
+from src.frames import check_merge_rule, merge_frames, save_frame, clear_merge_state, MERGE_STATE_EXTENSION
+
+OLD = np.array([[5, -1, 3], [-1, -1, 8]], dtype=np.int16)
+NEW = np.array([[2, 4, 7], [-1, 6, -1]], dtype=np.int16)
+
+
+def test_check_merge_rule():
+    assert check_merge_rule("mean") == "mean"
+    with pytest.raises(ValueError):
+        check_merge_rule("min")
+
+
+def test_merge_frames():
+    np.testing.assert_array_equal(merge_frames(OLD, NEW, "max"), [[5, 4, 7], [-1, 6, 8]])
+    np.testing.assert_array_equal(merge_frames(OLD, NEW, "first"), [[5, 4, 3], [-1, 6, 8]])
+    with pytest.raises(ValueError):
+        merge_frames(OLD, NEW[:, :2])
+    with pytest.raises(ValueError):
+        merge_frames(OLD, NEW, "mean")
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_save_frame_mean(tmp_path, codec):
+    third = np.array([[3, -1, -1], [-1, 9, -1]], dtype=np.int16)
+    for frame in [OLD, NEW, third]:
+        save_frame(str(tmp_path), "2022_01_01", frame, rule="mean", codec=codec)
+
+    # The mean of the valid values of all frames, also after merging more than two
+    expected = np.array([[3, 4, 5], [-1, 8, 8]], dtype=np.int16)
+    np.testing.assert_array_equal(load_frame_file(str(tmp_path / "2022_01_01.npy")), expected)
+
+    clear_merge_state(str(tmp_path))
+    assert os.listdir(tmp_path) == ["2022_01_01.npy"]
+
+
+def test_save_frame_max(tmp_path):
+    save_frame(str(tmp_path), "2022_01_01", OLD)
+    save_frame(str(tmp_path), "2022_01_01", NEW)
+    np.testing.assert_array_equal(load_frame_file(str(tmp_path / "2022_01_01.npy")), merge_frames(OLD, NEW))
+    assert not any(name.endswith(MERGE_STATE_EXTENSION) for name in os.listdir(tmp_path))
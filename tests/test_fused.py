@@ -0,0 +1,90 @@
+import os
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("rasterio")
+
+from shapely.geometry import box
+from sentinelhub import BBox, CRS
+
+from src.field_aggregation import finalize_field_partials
+from src.grid_aggregation import grid_pyramid
+from src.reader import load_index, read_px_matrix
+from src.fused import PATCH_SIZE, get_fused_windows, fused_cube_extraction
+
+# A 12 x 10 image of 10 m pixels
+BBOX = BBox((500000.0, 4799880.0, 500100.0, 4800000.0), crs=CRS(32630))
+DATES = [dt.datetime(2022, 1, 1) + dt.timedelta(days=5 * i) for i in range(5)]
+
+
+def make_cube(seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    cube = rng.integers(1, 80, (len(DATES), 12, 10)).astype(np.int16)
+    cube[rng.random(cube.shape) < 0.2] = -1
+    return cube
+
+
+def split_partitions(cube:np.ndarray) -> list:
+    # Two time partitions of (t, h, w, 1) arrays, as read from the eopatches
+    return [cube[:3, ..., np.newaxis], cube[3:, ..., np.newaxis]]
+
+
+def test_get_fused_windows():
+    assert get_fused_windows((5, 12, 10), 2, 10 ** 9) == [(0, 12)]
+    # Bands of rows that fit the budget, a multiple of the grid levels
+    assert get_fused_windows((5, 12, 10), 2, 5 * 10 * 2 * 5) == [(0, 5), (5, 10), (10, 12)]
+    assert get_fused_windows((5, 12, 10), 2, 5 * 10 * 2 * 5, levels=[2]) == [(0, 4), (4, 8), (8, 12)]
+    # Bands are at most one patch high
+    assert get_fused_windows((1, 3 * PATCH_SIZE, 1), 1, 10 ** 9)[0] == (0, PATCH_SIZE)
+
+
+@pytest.mark.parametrize("px_format", ["csv", "sparse"])
+def test_fused_px_and_grid(tmp_path, px_format):
+    cube = make_cube()
+    px_out, grid_out = str(tmp_path / "px"), str(tmp_path / "grid")
+
+    # A small budget splits the cube into several bands of rows
+    fused_cube_extraction(DATES, split_partitions(cube), BBOX, str(tmp_path / "tmp"), px_out=px_out, px_selection={"px_format": px_format},
+                          grid_out_path=grid_out, grid_levels=[2], max_ram=2 * len(DATES) * 10 * 2 * 4)
+
+    index = load_index(px_out)
+    assert len(index) == 3
+    df = read_px_matrix(px_out, bbox=list(BBOX), n_jobs=1)
+    assert len(df) == 12 * 10
+    for (patch, x, y), row in df.iterrows():
+        row_start = int(patch.split("_")[1])
+        values = cube[:, row_start + y, x]
+        np.testing.assert_array_equal(row.dropna().to_numpy() if px_format == "sparse" else row.to_numpy(),
+                                      values[values >= 0] if px_format == "sparse" else values)
+
+    grid = pd.read_csv(os.path.join(grid_out, os.listdir(grid_out)[0]), index_col=0)
+    expected = grid_pyramid(cube, [2])[2]
+    assert grid.shape[0] == len(DATES)
+    np.testing.assert_allclose(grid.to_numpy().reshape(expected.shape), expected, rtol=1e-5)
+
+
+def test_fused_field_partials(tmp_path):
+    cube = make_cube(seed=1)
+    # Fields of whole pixels: rows 1-8 and columns 2-5, and rows 9-11 and columns 0-9
+    fields = gpd.GeoDataFrame(geometry=[box(500020.0, 4799910.0, 500060.0, 4799990.0), box(500000.0, 4799880.0, 500100.0, 4799910.0)],
+                              index=[7, 8], crs="EPSG:32630")
+    field_out = str(tmp_path / "fields.csv")
+
+    partials = fused_cube_extraction(DATES, split_partitions(cube), BBOX, str(tmp_path / "tmp"), fields=fields, field_out_path=field_out,
+                                     field_stats=["median", "count"], max_ram=2 * len(DATES) * 10 * 2 * 3, partial_ids=[7])
+
+    # The partial aggregates of field 7 are returned, merged over all bands of rows, instead of being written
+    assert list(partials.keys()) == [7]
+    values = cube[:, 1:9, 2:6].reshape(len(DATES), -1)
+    stats = finalize_field_partials(partials[7], ["median", "count"])
+    np.testing.assert_array_equal(stats["count"], (values > 0).sum(axis=1))
+    np.testing.assert_allclose(stats["median"], [np.median(row[row > 0]) for row in values])
+
+    df = pd.read_csv(field_out, index_col=0)
+    assert list(df.columns) == ["8_median", "8_count"]
+    values = cube[:, 9:, :].reshape(len(DATES), -1)
+    np.testing.assert_array_equal(df["8_count"].to_numpy(), (values > 0).sum(axis=1))
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from src.grid_aggregation import check_grid_levels, grid_sums, grid_pyramid
+
+
+def brute_force_grid(arr, level):
+    t, h, w = arr.shape
+    out = np.full((t, -(-h // level), -(-w // level)), np.nan)
+    for i in range(out.shape[1]):
+        for j in range(out.shape[2]):
+            block = arr[:, i * level:(i + 1) * level, j * level:(j + 1) * level].reshape(t, -1)
+            for k in range(t):
+                valid = block[k][block[k] >= 0]
+                if len(valid) > 0:
+                    out[k, i, j] = valid.mean()
+    return out
+
+
+def test_check_grid_levels():
+    assert check_grid_levels(4) == [4]
+    assert check_grid_levels([10, 2, 4, 2]) == [2, 4, 10]
+    for levels in [None, [], [0, 2], [-4]]:
+        with pytest.raises(ValueError):
+            check_grid_levels(levels)
+
+
+@pytest.mark.parametrize("shape", [(3, 40, 40), (2, 23, 37), (1, 5, 3)])
+def test_pyramid_matches_brute_force(shape):
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 100, shape).astype(np.int16)
+    arr[rng.random(shape) < 0.4] = -1
+
+    levels = [2, 3, 4, 6, 10]
+    pyramid = grid_pyramid(arr, levels)
+    assert list(pyramid) == levels
+    for level in levels:
+        np.testing.assert_allclose(pyramid[level], brute_force_grid(arr, level), equal_nan=True, err_msg=str(level))
+
+
+def test_grid_counts():
+    arr = np.array([[[1, -1, 2, 3], [-1, -1, 4, -1]]], dtype=np.int16)
+    sums, counts = grid_sums(arr, [2])[2]
+    np.testing.assert_array_equal(sums, [[[1, 9]]])
+    np.testing.assert_array_equal(counts, [[[1, 3]]])
+
+
+def test_float_values():
+    arr = np.array([[[0.5, 0.25], [-1.0, 1.0]]], dtype=np.float32)
+    np.testing.assert_allclose(grid_pyramid(arr, [2])[2], [[[0.5833333]]], rtol=1e-6)
@@ -0,0 +1,71 @@
+import os
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("dask")
+pytest.importorskip("stelar_spatiotemporal")
+pytest.importorskip("geopandas")
+pytest.importorskip("rasterio")
+
+from sentinelhub import BBox, CRS
+from stelar_spatiotemporal.lib import save_bbox
+
+from src.codec import save_frame_file
+from src.fused import fused_cube_extraction
+from src.lazy_cube import open_frames_cube, lazy_extraction
+
+BBOX = BBox((500000.0, 4799880.0, 500100.0, 4800000.0), crs=CRS(32630))
+DATES = [dt.datetime(2022, 1, 1) + dt.timedelta(days=5 * i) for i in range(5)]
+
+
+def make_cube(seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    cube = rng.integers(1, 80, (len(DATES), 12, 10)).astype(np.int16)
+    cube[rng.random(cube.shape) < 0.2] = -1
+    return cube
+
+
+def write_frames(npy_dir:str, cube:np.ndarray, codec:str):
+    os.makedirs(npy_dir, exist_ok=True)
+    for date, frame in zip(DATES, cube):
+        save_frame_file(os.path.join(npy_dir, date.strftime("%Y_%m_%d") + ".npy"), frame, codec)
+    save_bbox(BBOX, os.path.join(npy_dir, "bbox.pkl"))
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_open_frames_cube(tmp_path, codec):
+    cube = make_cube()
+    write_frames(str(tmp_path), cube, codec)
+
+    # A budget of 4 rows per worker, rounded down to a multiple of the grid level
+    dates, lazy, bbox = open_frames_cube(str(tmp_path), max_ram=2 * 2 * len(DATES) * 10 * 2 * 4, n_workers=2, levels=[3])
+    assert dates == DATES and list(bbox) == list(BBOX)
+    assert lazy.chunks[1] == (3, 3, 3, 3)
+    np.testing.assert_array_equal(lazy.compute(scheduler="threads"), cube)
+
+
+def test_lazy_matches_fused(tmp_path):
+    cube = make_cube(seed=1)
+    npy_dir = str(tmp_path / "npys")
+    write_frames(npy_dir, cube, "none")
+
+    outputs = {}
+    for backend in ["lazy", "fused"]:
+        px_out, grid_out = str(tmp_path / backend / "px"), str(tmp_path / backend / "grid")
+        if backend == "lazy":
+            dates, lazy, bbox = open_frames_cube(npy_dir, max_ram=2 * len(DATES) * 10 * 2 * 4, n_workers=1, levels=[2])
+            lazy_extraction(dates, lazy, bbox, str(tmp_path / backend / "tmp"), px_out=px_out, grid_out_path=grid_out, grid_levels=[2],
+                            n_workers=1)
+        else:
+            fused_cube_extraction(DATES, [cube[..., np.newaxis]], BBOX, str(tmp_path / backend / "tmp"), px_out=px_out,
+                                  grid_out_path=grid_out, grid_levels=[2], max_ram=2 * len(DATES) * 10 * 2 * 4)
+        outputs[backend] = {name: pd.read_csv(os.path.join(out, name), index_col=0)
+                            for out in [px_out, grid_out] for name in sorted(os.listdir(out)) if name.endswith(".csv")}
+
+    assert list(outputs["lazy"].keys()) == list(outputs["fused"].keys())
+    for name, df in outputs["lazy"].items():
+        pd.testing.assert_frame_equal(df, outputs["fused"][name])
+    # The temporary grids are removed
+    assert not os.path.exists(tmp_path / "lazy" / "tmp")
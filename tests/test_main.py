@@ -0,0 +1,37 @@
+import pytest
+
+from main import parse_task, image2ts_pipeline
+
+
+def make_task(parameters:dict = None, field_path:str = None) -> dict:
+    task = {
+        "input": {"images": ["/data/LAI"]},
+        "output": {"pixel_timeseries": "/out/px"},
+        "parameters": dict(parameters or {}, extension="RAS"),
+    }
+    if field_path is not None:
+        task["input"]["field_path"] = field_path
+        task["output"]["field_timeseries"] = "/out/fields.csv"
+    return task
+
+
+def test_parse_task_roi():
+    assert parse_task(make_task({"roi": [0, 0, 10, 10]}))["roi"] == [0, 0, 10, 10]
+    assert parse_task(make_task({"roi": "fields"}, field_path="/data/fields.gpkg"))["roi"] == "fields"
+
+    # The roi cannot be derived from the fields without a field layer
+    with pytest.raises(ValueError):
+        parse_task(make_task({"roi": "fields"}))
+    with pytest.raises(ValueError):
+        image2ts_pipeline(["/data/LAI"], "RAS", "/out/px", None, None, False, roi="fields")
+    with pytest.raises(ValueError):
+        image2ts_pipeline(["/data/LAI"], "RAS", "/out/px", None, None, False, roi=[10, 0, 0, 10])
+
+
+def test_parse_task_max_ram():
+    assert parse_task(make_task())["max_ram"] == int(4e9)
+    assert parse_task(make_task({"max_ram": 1e9}))["max_ram"] == 1e9
+    with pytest.raises(ValueError):
+        image2ts_pipeline(["/data/LAI"], "RAS", "/out/px", None, None, False, max_ram=0)
+    with pytest.raises(ValueError):
+        image2ts_pipeline(["/data/LAI"], "RAS", "/out/px", None, None, False, max_ram="4GB")
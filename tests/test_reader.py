@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+
+from src.sparse_storage import save_sparse_px
+from src.reader import INDEX_NAME, write_index, load_index, bbox_to_px_ids, read_px_matrix, read_field_matrix
+
+DATES = pd.date_range("2022-01-01", periods=4, freq="5D")
+COLUMNS = [f"{x}_{y}" for y in range(3) for x in range(2)]
+
+
+def make_px(seed:int) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 100, (len(DATES), len(COLUMNS))).astype(np.int16)
+
+
+def index_entry(file:str, fmt:str, xmin:float, start:str = "2022-01-01", end:str = "2022-01-16") -> dict:
+    # Patchlets of 3 rows and 2 columns of 10 m pixels
+    return {"file": file, "patch": file.split(".")[0], "format": fmt, "bbox": [xmin, 0.0, xmin + 20.0, 30.0], "crs": 32630,
+            "shape": [3, 2], "start": start, "end": end}
+
+
+@pytest.fixture
+def outdir(tmp_path):
+    pd.DataFrame(make_px(0), index=DATES, columns=COLUMNS).to_csv(tmp_path / "patch_0.csv")
+    save_sparse_px(str(tmp_path / "patch_1.npz"), make_px(1), DATES.values, np.array(COLUMNS))
+    write_index(str(tmp_path), [index_entry("patch_0.csv", "csv", 0.0), index_entry("patch_1.npz", "sparse", 20.0)])
+    return str(tmp_path)
+
+
+def test_bbox_to_px_ids():
+    entry = index_entry("patch_0.csv", "csv", 0.0)
+    assert bbox_to_px_ids(entry, (0.0, 0.0, 20.0, 30.0)) == COLUMNS
+    # Only the pixels whose centers are inside the bbox
+    assert bbox_to_px_ids(entry, (6.0, 12.0, 20.0, 28.0)) == ["1_0", "1_1"]
+
+
+def test_read_px_matrix_pixels(outdir):
+    df = read_px_matrix(outdir, pixels=[("patch_0", 1, 2), ("patch_1", 0, 1), ("patch_1", 5, 5)], n_jobs=1)
+    assert list(df.index) == [("patch_0", 1, 2), ("patch_1", 0, 1)]
+    np.testing.assert_array_equal(df.to_numpy(), [make_px(0)[:, COLUMNS.index("1_2")], make_px(1)[:, COLUMNS.index("0_1")]])
+    assert list(df.columns) == list(DATES.date)
+
+
+def test_read_px_matrix_bbox_and_dates(outdir):
+    # The right column of patch_0 and the left column of patch_1, in the first two rows
+    df = read_px_matrix(outdir, bbox=(12.0, 12.0, 28.0, 30.0), startdate="2022-01-06", enddate="2022-01-11", n_jobs=1)
+    assert sorted(df.index) == [("patch_0", 1, 0), ("patch_0", 1, 1), ("patch_1", 0, 0), ("patch_1", 0, 1)]
+    assert list(df.columns) == list(DATES.date[1:3])
+    np.testing.assert_array_equal(df.loc[("patch_1", 0, 1)].to_numpy(), make_px(1)[1:3, COLUMNS.index("0_1")])
+
+    # Appended files widen the date range of their entry
+    write_index(outdir, [index_entry("patch_1.npz", "sparse", 20.0, start="2023-01-01", end="2023-02-01")])
+    assert [load_index(outdir)["patch_1.npz"][key] for key in ["start", "end"]] == ["2022-01-01", "2023-02-01"]
+
+    # Files outside of the date range are not opened
+    os.remove(os.path.join(outdir, INDEX_NAME))
+    write_index(outdir, [index_entry("patch_0.csv", "csv", 0.0), index_entry("patch_1.npz", "sparse", 20.0, start="2023-01-01", end="2023-02-01")])
+    df = read_px_matrix(outdir, bbox=(0.0, 0.0, 40.0, 30.0), startdate="2022-01-01", enddate="2022-12-31", n_jobs=1)
+    assert set(df.index.get_level_values("patch")) == {"patch_0"}
+
+
+def test_build_index(tmp_path):
+    pd.DataFrame(make_px(0), index=DATES, columns=COLUMNS).to_csv(tmp_path / "patch_0.csv")
+    index = load_index(str(tmp_path))
+    assert list(index.keys()) == ["patch_0.csv"] and index["patch_0.csv"]["bbox"] is None
+
+    df = read_px_matrix(str(tmp_path), pixels=[("patch_0", 0, 0)], n_jobs=1)
+    np.testing.assert_array_equal(df.to_numpy()[0], make_px(0)[:, 0])
+    with pytest.raises(ValueError):
+        read_px_matrix(str(tmp_path), bbox=(0.0, 0.0, 10.0, 10.0), n_jobs=1)
+
+
+def test_read_field_matrix(tmp_path):
+    csv_path = str(tmp_path / "fields.csv")
+    pd.DataFrame({"12": [1.0, 2.0, 3.0, 4.0], "7": [5.0, 6.0, 7.0, 8.0]}, index=DATES).to_csv(csv_path)
+
+    df = read_field_matrix(csv_path, field_ids=[7], startdate="2022-01-06")
+    assert list(df.index) == ["7"] and df.index.name == "field_id"
+    np.testing.assert_array_equal(df.to_numpy(), [[6.0, 7.0, 8.0]])
+    with pytest.raises(ValueError):
+        read_field_matrix(csv_path, field_ids=[99])
@@ -0,0 +1,55 @@
+import io
+import json
+
+from src import service
+from src.service import service_app
+
+
+def call(method:str, path:str, body:bytes = b"") -> tuple:
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    started = {}
+    def start_response(status, headers):
+        started["status"], started["headers"] = status, dict(headers)
+
+    chunks = service_app(environ, start_response)
+    body = b"".join(chunks)
+    assert started["headers"]["Content-Type"] == "application/json"
+    assert int(started["headers"]["Content-Length"]) == len(body)
+    return started["status"], json.loads(body)
+
+
+def test_health():
+    assert call("GET", "/health") == ("200 OK", {"status": "ok"})
+
+
+def test_unknown_endpoint():
+    status, response = call("GET", "/run")
+    assert status == "404 Not Found" and response["status"] == "failed"
+
+
+def test_run(monkeypatch):
+    tasks = []
+    def run_task(input_json):
+        tasks.append(input_json)
+        return {"status": "success"}
+    monkeypatch.setattr(service, "run_task", run_task)
+
+    task = {"input": {"images": ["/data/LAI"]}, "output": {"pixel_timeseries": "/out/px"}}
+    assert call("POST", "/run", json.dumps(task).encode()) == ("200 OK", {"status": "success"})
+    assert tasks == [task]
+
+    # Bodies that are not JSON are rejected without running a task
+    status, response = call("POST", "/run", b"{not json")
+    assert status == "400 Bad Request" and response["status"] == "failed"
+    assert len(tasks) == 1
+
+
+def test_run_invalid_task():
+    # Errors of the task are reported in the output JSON
+    status, response = call("POST", "/run", json.dumps({"parameters": {}}).encode())
+    assert status == "200 OK" and response["status"] == "failed"
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+
+from src.sharded_storage import encode_pixels, decode_pixels, save_shard_px, load_shard_arrays, load_shard_px, \
+    get_shard_columns, MAX_GAP
+
+
+def get_columns(h, w):
+    return np.array([f"{x}_{y}" for y in range(h) for x in range(w)])
+
+
+def test_encode_pixels():
+    columns = get_columns(3, 4)
+    assert encode_pixels(columns) == {"shape": [3, 4]}
+    np.testing.assert_array_equal(decode_pixels(encode_pixels(columns)), columns)
+
+    subset = columns[[0, 5, 11]]
+    assert encode_pixels(subset) == {"shape": [3, 4], "pixels": [0, 5, 11]}
+    np.testing.assert_array_equal(decode_pixels(encode_pixels(subset)), subset)
+
+    other = np.array(["a", "b_c"])
+    np.testing.assert_array_equal(decode_pixels(encode_pixels(other)), other)
+
+
+def test_save_append_and_load(tmp_path):
+    rng = np.random.default_rng(0)
+    arr = rng.integers(-1, 100, (9, 20)).astype(np.int16)
+    dates = np.arange(np.datetime64("2022-01-01"), np.datetime64("2022-01-10"))
+    columns = get_columns(4, 5)
+    path = str(tmp_path / "patchlet.pxs")
+
+    save_shard_px(path, arr[:4], dates[:4], columns)
+    save_shard_px(path, arr[4:], dates[4:], columns)
+    np.testing.assert_array_equal(get_shard_columns(path), columns)
+
+    loaded_dates, loaded_columns, loaded = load_shard_arrays(path)
+    np.testing.assert_array_equal(loaded_dates, dates)
+    np.testing.assert_array_equal(loaded_columns, columns)
+    np.testing.assert_array_equal(loaded, arr)
+
+    # A subset of the pixels over the boundary of the segments
+    df = load_shard_px(path, columns=["4_3", "0_0", "2_1"], startdate="2022-01-03", enddate="2022-01-06")
+    assert list(df.columns) == ["4_3", "0_0", "2_1"]
+    np.testing.assert_array_equal(df.values, arr[2:6][:, [19, 0, 7]])
+
+    with pytest.raises(ValueError):
+        save_shard_px(path, arr[:1, :3], dates[:1], columns[:3])
+    with pytest.raises(ValueError):
+        load_shard_arrays(path, columns=["9_9"])
+    assert load_shard_arrays(path, columns=["9_9", "1_0"], ignore_missing=True)[1].tolist() == ["1_0"]
+
+
+def test_distant_pixels(tmp_path):
+    # Pixels that are further apart than MAX_GAP are read with separate requests
+    n_times = 2
+    n_pixels = MAX_GAP // (n_times * 2) * 3
+    arr = np.arange(n_times * n_pixels, dtype=np.int16).reshape(n_times, n_pixels)
+    columns = np.array([f"{x}_0" for x in range(n_pixels)])
+    path = str(tmp_path / "wide.pxs")
+    save_shard_px(path, arr, np.arange(np.datetime64("2022-01-01"), np.datetime64("2022-01-03")), columns)
+
+    pixels = [n_pixels - 1, 0, n_pixels // 2, 1]
+    _, _, loaded = load_shard_arrays(path, columns=columns[pixels])
+    np.testing.assert_array_equal(loaded, arr[:, pixels])
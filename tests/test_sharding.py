@@ -0,0 +1,61 @@
+import datetime as dt
+import pytest
+
+from src.work_queue import create_queue, claim_shard, complete_shard
+from src.sharding import get_shard_blocks, get_date_ranges, merge_shards
+
+TASK = {"input": {"images": ["/data/LAI"]}, "output": {"pixel_timeseries": "/out/px"}, "parameters": {"extension": "RAS"}}
+
+
+def test_get_shard_blocks():
+    # A 5 x 4 image of 10 m pixels, in blocks of 3 x 3 pixels
+    image = {"shape": (5, 4), "bbox": (0.0, 0.0, 40.0, 50.0)}
+    blocks = get_shard_blocks(image, 3)
+    assert [block_id for block_id, _ in blocks] == ["0_0", "0_3", "3_0", "3_3"]
+    # The bounds lie a quarter pixel within the edges of the block
+    assert blocks[0][1] == (2.5, 22.5, 27.5, 47.5)
+    assert blocks[3][1] == (32.5, 2.5, 37.5, 17.5)
+
+    # Blocks outside the region of interest are skipped, the others are cut to it
+    blocks = get_shard_blocks(image, 3, roi=(0.0, 25.0, 20.0, 50.0))
+    assert blocks == [("0_0", (2.5, 25.0, 20.0, 47.5))]
+
+
+def test_get_date_ranges():
+    assert get_date_ranges(["2022_01_05"]) == [(None, None)]
+
+    # Ranges of 10 days from 2000-01-01 that contain images, cut to the date range of the task
+    ranges = get_date_ranges(["2000_01_03", "2000_01_05", "2000_01_25"], 10, start_date=dt.datetime(2000, 1, 2))
+    assert ranges == [(dt.datetime(2000, 1, 2), dt.datetime(2000, 1, 10)), (dt.datetime(2000, 1, 21), dt.datetime(2000, 1, 30))]
+
+
+def shard_result(n_images:int) -> dict:
+    return {"metrics": {"number_of_images": n_images, "partial_runtimes": {"unpacking": 1.0}}}
+
+
+def test_merge_shards(tmp_path):
+    queue_path = str(tmp_path / "queue.db")
+    specs = [{"shard_id": f"T30TXM_{block}", "tile_id": "T30TXM", "image_shape": [20, 10], "start_date": None}
+             for block in ["0_0", "10_0"]]
+    create_queue(queue_path, TASK, specs)
+
+    claim_shard(queue_path, "a")
+    complete_shard(queue_path, specs[0]["shard_id"], "a", shard_result(3))
+    # Shards that are not done cannot be merged
+    with pytest.raises(ValueError):
+        merge_shards(queue_path)
+
+    claim_shard(queue_path, "b")
+    complete_shard(queue_path, specs[1]["shard_id"], "b", shard_result(3))
+    output = merge_shards(queue_path)
+
+    assert output["status"] == "success"
+    assert output["output"] == {"pixel_timeseries": "/out/px"}
+    metrics = output["metrics"]
+    # Blocks of the same tile and date range share their images
+    assert metrics["number_of_images"] == 3
+    assert (metrics["image_height"], metrics["image_width"]) == (20, 10)
+    assert (metrics["number_of_tiles"], metrics["number_of_shards"], metrics["shard_attempts"]) == (1, 2, 2)
+    assert metrics["workers"] == {"a": 1, "b": 1}
+    assert metrics["partial_runtimes"] == {"unpacking": 2.0}
+    assert list(metrics["shards"].keys()) == [spec["shard_id"] for spec in specs]
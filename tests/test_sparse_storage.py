@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+
+from src.sparse_storage import to_sparse, from_sparse, save_sparse_px, load_sparse_arrays, load_sparse_px
+
+
+def make_px(n_times=11, n_pixels=25, seed=0):
+    rng = np.random.default_rng(seed)
+    arr = rng.integers(0, 100, (n_times, n_pixels)).astype(np.int16)
+    arr[rng.random(arr.shape) < 0.5] = -1
+    return arr
+
+
+def test_sparse_round_trip():
+    arr = make_px()
+    bitmask, values = to_sparse(arr)
+    assert bitmask.shape == (arr.shape[1], 2)
+    assert len(values) == (arr >= 0).sum()
+
+    dense = from_sparse(bitmask, values, arr.shape[0], fill_value=-1)
+    np.testing.assert_array_equal(dense, arr)
+
+    dense = from_sparse(bitmask, values, arr.shape[0])
+    np.testing.assert_array_equal(dense, np.where(arr >= 0, arr, np.nan))
+
+
+def test_sparse_pixel_subset():
+    arr = make_px(seed=1)
+    bitmask, values = to_sparse(arr)
+    pixels = np.array([24, 3, 0, 17])
+    dense = from_sparse(bitmask, values, arr.shape[0], pixels=pixels, fill_value=-1)
+    np.testing.assert_array_equal(dense, arr[:, pixels])
+
+
+def test_save_append_and_load(tmp_path):
+    arr = make_px(seed=2)
+    dates = np.arange(np.datetime64("2022-01-01"), np.datetime64("2022-01-01") + arr.shape[0])
+    columns = np.array([f"{x}_{y}" for y in range(5) for x in range(5)])
+    path = str(tmp_path / "patchlet.npz")
+
+    save_sparse_px(path, arr[:6], dates[:6], columns)
+    save_sparse_px(path, arr[6:], dates[6:], columns)
+    loaded_dates, loaded_columns, loaded = load_sparse_arrays(path, fill_value=-1)
+    np.testing.assert_array_equal(loaded_dates, dates)
+    np.testing.assert_array_equal(loaded_columns, columns)
+    np.testing.assert_array_equal(loaded, arr)
+
+    df = load_sparse_px(path, columns=["4_4", "1_0"], startdate="2022-01-03", enddate="2022-01-05", fill_value=-1)
+    assert list(df.columns) == ["4_4", "1_0"]
+    np.testing.assert_array_equal(df.values, arr[2:5][:, [24, 1]])
+
+    with pytest.raises(ValueError):
+        save_sparse_px(path, arr[:1, :3], dates[:1], columns[:3])
+    with pytest.raises(ValueError):
+        load_sparse_arrays(path, columns=["9_9"])
@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+import pytest
+
+from src.storage import create_storage, add_artifact, artifact_ready, consume, remove_artifacts, storage_metrics, get_dir_size
+
+
+def write_artifact(path:str, n_bytes:int):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "data.bin"), "wb") as f:
+        f.write(b"\0" * n_bytes)
+
+
+def test_create_storage():
+    assert create_storage()["quota"] is None
+    for quota in [0, -1, 1.5, True, "1GB"]:
+        with pytest.raises(ValueError):
+            create_storage(quota)
+
+
+def test_consume_deletes_after_last_consumer(tmp_path):
+    storage = create_storage()
+    path = str(tmp_path / "eopatches")
+    add_artifact(storage, path, ["pixels", "fields"], 100, owner="a")
+    write_artifact(path, 300)
+    artifact_ready(storage, path)
+    assert get_dir_size(path) == 300
+
+    consume(storage, path, "pixels")
+    assert os.path.exists(path)
+    consume(storage, path, "fields")
+    assert not os.path.exists(path)
+    metrics = storage_metrics(storage)
+    assert metrics["quota_bytes"] is None and metrics["peak_disk_bytes"] == 300
+
+    # Consuming an unknown or deleted artifact does nothing
+    consume(storage, path, "fields")
+
+
+def test_quota_backpressure(tmp_path):
+    storage = create_storage(quota_bytes=500)
+    first, second = str(tmp_path / "a"), str(tmp_path / "b")
+    add_artifact(storage, first, ["pixels"], 400, owner="a")
+    write_artifact(first, 400)
+    artifact_ready(storage, first)
+
+    # The second artifact does not fit until the first is consumed
+    done = threading.Event()
+    def produce():
+        add_artifact(storage, second, ["pixels"], 200, owner="b")
+        done.set()
+    thread = threading.Thread(target=produce)
+    thread.start()
+    assert not done.wait(0.2)
+
+    consume(storage, first, "pixels")
+    thread.join(5)
+    assert done.is_set()
+    assert storage_metrics(storage)["peak_disk_bytes"] <= 500
+    assert storage_metrics(storage)["wait_time"] > 0
+
+
+def test_no_deadlock_without_other_owners(tmp_path):
+    storage = create_storage(quota_bytes=100)
+    path = str(tmp_path / "a")
+
+    # An artifact that exceeds the quota on its own is granted, as nothing can be freed for it
+    start = time.time()
+    add_artifact(storage, path, ["pixels"], 1000, owner="a")
+    add_artifact(storage, path + "2", ["pixels"], 1000, owner="a")
+    assert time.time() - start < 1
+
+
+def test_remove_artifacts(tmp_path):
+    storage = create_storage()
+    paths = {owner: str(tmp_path / owner) for owner in ["a", "b"]}
+    for owner, path in paths.items():
+        add_artifact(storage, path, ["pixels"], 10, owner=owner)
+        write_artifact(path, 10)
+        artifact_ready(storage, path)
+
+    remove_artifacts(storage, owner="a")
+    assert not os.path.exists(paths["a"]) and os.path.exists(paths["b"])
+    assert list(storage["artifacts"].keys()) == [paths["b"]]
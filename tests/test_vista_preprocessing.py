@@ -0,0 +1,146 @@
+import io
+import os
+import zipfile
+import datetime as dt
+import numpy as np
+import pytest
+
+pytest.importorskip("stelar_spatiotemporal")
+pytest.importorskip("sentinelhub")
+
+from sentinelhub import BBox, CRS
+
+from src.codec import load_frame_file
+from src.preprocessing import get_image_date, filter_images_by_date, get_roi_window
+from src.vista_preprocessing import unpack_ras_stream, unpack_vista_zip, get_zip_ras_pairs, select_frames
+
+TIMESTAMPS = ["2022_01_01", "2022_01_06", "2022_01_11", "2022_01_16"]
+
+
+def make_ras(n_times=len(TIMESTAMPS), h=6, w=5, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.integers(-1, 100, (n_times, h, w)).astype(np.int16)
+
+
+def make_rhd(h:int, w:int, timestamps=TIMESTAMPS) -> str:
+    lines = ["RHD", "LAI", f"{h} {w}", f"10.0 500000.0 4800000.0", "dates"]
+    lines += [f"{i} {ts.replace('_', ' ')}" for i, ts in enumerate(timestamps)]
+    return "\n".join(lines) + "\n"
+
+
+def write_zip(path:str, arr:np.ndarray, compression:int, name:str = "LAI_T30TXM"):
+    with zipfile.ZipFile(path, "w", compression=compression) as archive:
+        archive.writestr(f"{name}.RAS", arr.tobytes())
+        archive.writestr(f"{name}.RHD", make_rhd(*arr.shape[1:]))
+
+
+def load_frames(outdir:str, timestamps=TIMESTAMPS) -> np.ndarray:
+    return np.stack([load_frame_file(os.path.join(outdir, f"{ts}.npy")) for ts in timestamps])
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_unpack_vista_zip(tmp_path, compression):
+    arr = make_ras()
+    zip_path = str(tmp_path / "B4.zip")
+    write_zip(zip_path, arr, compression)
+
+    outdir = str(tmp_path / "npys")
+    unpack_vista_zip(zip_path, outdir)
+    np.testing.assert_array_equal(load_frames(outdir), arr)
+    assert os.path.exists(os.path.join(outdir, "bbox.pkl"))
+
+
+def test_unpack_vista_zip_members(tmp_path):
+    zip_path = str(tmp_path / "B4.zip")
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for name, seed in [("a", 1), ("b", 2)]:
+            arr = make_ras(seed=seed)
+            archive.writestr(f"{name}.RAS", arr.tobytes())
+            archive.writestr(f"{name}.RHD", make_rhd(*arr.shape[1:]))
+
+    with zipfile.ZipFile(zip_path) as archive:
+        assert get_zip_ras_pairs(archive, zip_path) == [("a.RAS", "a.RHD"), ("b.RAS", "b.RHD")]
+
+    outdir = str(tmp_path / "npys")
+    unpack_vista_zip(zip_path, outdir, members=["b.RAS"])
+    np.testing.assert_array_equal(load_frames(outdir), make_ras(seed=2))
+
+
+def test_zip_missing_rhd(tmp_path):
+    zip_path = str(tmp_path / "B4.zip")
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        archive.writestr("a.RAS", make_ras().tobytes())
+
+    with pytest.raises(FileNotFoundError):
+        unpack_vista_zip(zip_path, str(tmp_path / "npys"))
+
+
+def test_unpack_truncated_stream(tmp_path):
+    arr = make_ras()
+    with pytest.raises(ValueError):
+        unpack_ras_stream(io.BytesIO(arr.tobytes()[:-1]), str(tmp_path), TIMESTAMPS, arr.shape[2], arr.shape[1])
+
+
+class NonSeekable(io.RawIOBase):
+    """
+    A stream that can only be read forward, like a deflated ZIP member.
+    """
+    def __init__(self, data:bytes):
+        self.stream = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+
+def test_select_frames():
+    assert select_frames(TIMESTAMPS) == [0, 1, 2, 3]
+    assert select_frames(TIMESTAMPS, start_date=dt.datetime(2022, 1, 6), end_date=dt.datetime(2022, 1, 11)) == [1, 2]
+    assert select_frames(TIMESTAMPS, start_date=dt.datetime(2022, 1, 17)) == []
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_unpack_date_range(tmp_path, seekable):
+    arr = make_ras()
+    stream = io.BytesIO(arr.tobytes()) if seekable else NonSeekable(arr.tobytes())
+    unpack_ras_stream(stream, str(tmp_path), TIMESTAMPS, arr.shape[2], arr.shape[1],
+                      start_date=dt.datetime(2022, 1, 6), end_date=dt.datetime(2022, 1, 11))
+
+    assert sorted(os.listdir(tmp_path)) == ["2022_01_06.npy", "2022_01_11.npy"]
+    np.testing.assert_array_equal(load_frames(str(tmp_path), TIMESTAMPS[1:3]), arr[1:3])
+
+
+def test_filter_images_by_date():
+    assert get_image_date("LAI_2022_06_22.tif") == dt.datetime(2022, 6, 22)
+    assert get_image_date("S2_20220622_T30TXM.tif") == dt.datetime(2022, 6, 22)
+    assert get_image_date("lai.tif") is None
+
+    paths = ["a_2022_01_01.tif", "b_2022_02_01.tif", "c_2022_03_01.tif", "undated.tif"]
+    assert filter_images_by_date(paths) == paths
+    assert filter_images_by_date(paths, start_date=dt.datetime(2022, 1, 15), end_date=dt.datetime(2022, 2, 15)) == ["b_2022_02_01.tif", "undated.tif"]
+
+
+def test_get_roi_window():
+    bbox = BBox((500000.0, 4799940.0, 500050.0, 4800000.0), crs=CRS(32630))
+    row_off, col_off, height, width, window_bbox = get_roi_window(bbox, 6, 5, (500012.0, 4799961.0, 500031.0, 4799990.0))
+    assert (row_off, col_off, height, width) == (1, 1, 3, 3)
+    assert list(window_bbox) == [500010.0, 4799960.0, 500040.0, 4799990.0]
+
+    # The window is clipped to the image
+    assert get_roi_window(bbox, 6, 5, (499000.0, 4799000.0, 500015.0, 4799995.0))[:4] == (0, 0, 6, 2)
+    with pytest.raises(ValueError):
+        get_roi_window(bbox, 6, 5, (600000.0, 4799000.0, 600100.0, 4799100.0))
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_unpack_row_window(tmp_path, compression):
+    arr = make_ras()
+    zip_path = str(tmp_path / "B4.zip")
+    write_zip(zip_path, arr, compression)
+
+    # Rows 1-3 and columns 2-3 of the 10 m grid, see make_rhd
+    outdir = str(tmp_path / "npys")
+    unpack_vista_zip(zip_path, outdir, roi=(500020.0, 4799960.0, 500040.0, 4799990.0), start_date=dt.datetime(2022, 1, 11))
+    np.testing.assert_array_equal(load_frames(outdir, TIMESTAMPS[2:]), arr[2:, 1:4, 2:4])
@@ -0,0 +1,83 @@
+import time
+import pytest
+
+from src import work_queue
+from src.work_queue import create_queue, load_task, claim_shard, renew_lease, complete_shard, fail_shard, get_queue_status, \
+    load_shards
+
+TASK = {"input": {"images": ["/data/LAI"]}, "output": {"pixel_timeseries": "/out/px"}, "parameters": {"extension": "RAS"}}
+
+
+def make_queue(tmp_path, n_shards:int = 2) -> str:
+    queue_path = str(tmp_path / "queue.db")
+    create_queue(queue_path, TASK, [{"shard_id": f"s{i}"} for i in range(n_shards)])
+    return queue_path
+
+
+def test_create_queue(tmp_path):
+    queue_path = make_queue(tmp_path)
+    assert load_task(queue_path)["spec"] == TASK
+    assert get_queue_status(queue_path) == {"pending": 2, "running": 0, "done": 0, "failed": 0}
+
+    # Planning again keeps the finished shards and adds the new ones
+    claim_shard(queue_path, "a")
+    complete_shard(queue_path, "s0", "a", {"status": "success"})
+    create_queue(queue_path, TASK, [{"shard_id": f"s{i}"} for i in range(3)])
+    assert [shard["status"] for shard in load_shards(queue_path)] == ["done", "pending", "pending"]
+
+    # A queue belongs to a single task
+    with pytest.raises(ValueError):
+        create_queue(queue_path, dict(TASK, parameters={}), [])
+    with pytest.raises(ValueError):
+        load_task(str(tmp_path / "missing.db"))
+
+
+def test_claim(tmp_path):
+    queue_path = make_queue(tmp_path)
+    assert claim_shard(queue_path, "a") == {"shard_id": "s0"}
+    assert claim_shard(queue_path, "b") == {"shard_id": "s1"}
+    assert claim_shard(queue_path, "c") is None
+    assert get_queue_status(queue_path)["running"] == 2
+
+    # Only the worker that holds the claim can renew it or complete the shard
+    assert renew_lease(queue_path, "s0", "a")
+    assert not renew_lease(queue_path, "s0", "b")
+    complete_shard(queue_path, "s0", "b", {})
+    complete_shard(queue_path, "s1", "b", {"status": "success"})
+    assert get_queue_status(queue_path) == {"pending": 0, "running": 1, "done": 1, "failed": 0}
+
+    shards = load_shards(queue_path)
+    assert [(shard["status"], shard["worker"], shard["attempts"]) for shard in shards] == [("running", "a", 1), ("done", "b", 1)]
+    assert shards[1]["result"] == {"status": "success"}
+
+
+def test_lease_expiry(tmp_path, monkeypatch):
+    queue_path = make_queue(tmp_path, 1)
+    assert claim_shard(queue_path, "a", lease=60) is not None
+    assert claim_shard(queue_path, "b", lease=60) is None
+
+    # The worker of the shard stops renewing its claim; the shard is handed to another worker after the lease
+    now = time.time()
+    monkeypatch.setattr(work_queue.time, "time", lambda: now + 61)
+    assert get_queue_status(queue_path, lease=60)["pending"] == 1
+    assert claim_shard(queue_path, "b", lease=60) == {"shard_id": "s0"}
+    assert not renew_lease(queue_path, "s0", "a")
+    assert renew_lease(queue_path, "s0", "b")
+
+    # Once it ran out of attempts, an expired shard counts as failed
+    monkeypatch.setattr(work_queue.time, "time", lambda: now + 200)
+    assert get_queue_status(queue_path, lease=60, max_attempts=2)["failed"] == 1
+    assert claim_shard(queue_path, "c", lease=60, max_attempts=2) is None
+
+
+def test_fail_and_retry(tmp_path):
+    queue_path = make_queue(tmp_path, 1)
+    for attempt in range(1, 3):
+        assert claim_shard(queue_path, "a", max_attempts=2) == {"shard_id": "s0"}
+        fail_shard(queue_path, "s0", "a", f"error {attempt}", max_attempts=2)
+
+    # The shard is retried until it failed max_attempts times
+    shard = load_shards(queue_path)[0]
+    assert (shard["status"], shard["attempts"], shard["error"]) == ("failed", 2, "error 2")
+    assert claim_shard(queue_path, "a", max_attempts=2) is None
+    assert get_queue_status(queue_path)["failed"] == 1